@@ -1,11 +1,21 @@
 __all__ = [
     "Manifest",
+    "ColumnarManifest",
     "ManifestFileParser", "ManifestFileWriter",
     "ManifestDirWalker",
-    "ManifestTarWalker"
+    "ManifestTarWalker",
+    "ManifestZipWalker",
+    "PathFilter",
+    "HashCache",
+    "TarIndex",
 ]
 
 from manifest import Manifest
+from manifest_columnar import ColumnarManifest
 from manifest_file import ManifestFileParser, ManifestFileWriter
 from manifest_dir import ManifestDirWalker
 from manifest_tar import ManifestTarWalker
+from manifest_zip import ManifestZipWalker
+from manifest_builder import PathFilter
+from manifest_cache import HashCache
+from manifest_tarindex import TarIndex
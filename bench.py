@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+"""Ad-hoc performance benchmarks.
+
+Usage: bench.py [benchmark ...]
+
+Run the named benchmarks (or all of them, if none are given), and print the
+results to stdout. Benchmarks that measure peak memory usage run each
+measurement in a fresh child process, so that the numbers are not polluted by
+earlier measurements.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import hashlib
+import resource
+import tempfile
+import subprocess
+
+MiB = 1024 * 1024
+
+def peak_rss_kib():
+    """Return the peak resident set size of this process, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_child(*args):
+    """Run a child measurement in a fresh process; return its stdout fields."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--child"]
+    cmd.extend(str(a) for a in args)
+    return subprocess.check_output(cmd).decode("ascii").split()
+
+def make_file(path, size):
+    chunk = os.urandom(min(size, MiB)) or b""
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            f.write(chunk[:left])
+            left -= len(chunk)
+
+def child_hash_file(path, method, bufsize):
+    """Hash 'path' with the given method; print elapsed time and peak RSS."""
+    from manifest_digest import hash_stream
+    t = time.time()
+    if method == "read":
+        with open(path, "rb") as f:
+            hashlib.sha1(f.read()).hexdigest()
+    else:
+        with open(path, "rb") as f:
+            hash_stream(f, [hashlib.sha1()], int(bufsize))
+    print(time.time() - t, peak_rss_kib())
+
+def bench_hash_file():
+    """Peak RSS and throughput of whole-file vs. streamed SHA1 hashing."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("%10s %-8s %9s %12s %10s" % (
+            "size", "method", "bufsize", "peak RSS", "MiB/s"))
+        for size in (1 * MiB, 16 * MiB, 128 * MiB, 512 * MiB):
+            path = os.path.join(tmpdir, "data")
+            make_file(path, size)
+            for method, bufsize in [("read", 0), ("stream", 4096),
+                                    ("stream", 64 * 1024), ("stream", MiB)]:
+                elapsed, rss = run_child("hash_file", path, method, bufsize)
+                print("%8dMi %-8s %9d %9dKiB %10.1f" % (
+                    size // MiB, method, bufsize, int(rss),
+                    size / MiB / max(float(elapsed), 1e-9)))
+            os.unlink(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def make_tar(path, size, compression = ""):
+    """Create a tar file at 'path' holding a single member of 'size' bytes."""
+    import tarfile
+    class Zeros(object):
+        def __init__(self, size):
+            self.left = size
+        def read(self, n = -1):
+            n = self.left if n < 0 else min(n, self.left)
+            self.left -= n
+            return b"\0" * n
+    tf = tarfile.open(path, "w:" + compression)
+    ti = tarfile.TarInfo("./member")
+    ti.size = size
+    tf.addfile(ti, Zeros(size))
+    tf.close()
+
+def child_tar_member(path, method, bufsize):
+    """Hash the members of tar at 'path'; print elapsed time and peak RSS."""
+    import tarfile
+    from manifest_tar import ManifestTarWalker
+    t = time.time()
+    if method == "read":
+        tf = tarfile.open(path)
+        for ti in tf:
+            data = tf.extractfile(ti).read()
+            hashlib.sha1(data).hexdigest()
+            hashlib.sha256(data).hexdigest()
+        tf.close()
+    else:
+        ManifestTarWalker(bufsize = int(bufsize)).build(
+            path, attrkeys = ["sha1", "sha256"], stream = method == "stream")
+    print(time.time() - t, peak_rss_kib())
+
+def bench_tar_member():
+    """Peak RSS and throughput vs. member size when hashing tar members."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("%10s %-8s %9s %12s %10s" % (
+            "size", "method", "bufsize", "peak RSS", "MiB/s"))
+        for size in (1 * MiB, 16 * MiB, 128 * MiB, 512 * MiB):
+            path = os.path.join(tmpdir, "data.tar")
+            make_tar(path, size)
+            for method, bufsize in [("read", 0), ("random", 64 * 1024),
+                                    ("stream", 64 * 1024), ("stream", MiB)]:
+                elapsed, rss = run_child("tar_member", path, method, bufsize)
+                print("%8dMi %-8s %9d %9dKiB %10.1f" % (
+                    size // MiB, method, bufsize, int(rss),
+                    size / MiB / max(float(elapsed), 1e-9)))
+            os.unlink(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_tar_pipeline():
+    """Throughput of ManifestTarWalker on a .tar.gz with N hashing threads."""
+    import tarfile
+    from manifest_tar import ManifestTarWalker
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "data.tar.gz")
+        nfiles, size = 32, 8 * MiB
+        tf = tarfile.open(path, "w:gz", compresslevel = 1)
+        for i in range(nfiles):
+            src = os.path.join(tmpdir, "src")
+            make_file(src, size)
+            tf.add(src, "./f%03d" % (i))
+        tf.close()
+        attrkeys = ["sha1", "sha256"]
+        print("%6s %-8s %10s %10s" % ("jobs", "mode", "seconds", "MiB/s"))
+        for stream in (False, True):
+            for jobs in (1, 2, 4):
+                t = time.time()
+                ManifestTarWalker(jobs = jobs).build(
+                    path, attrkeys = attrkeys, stream = stream)
+                elapsed = time.time() - t
+                print("%6d %-8s %10.3f %10.1f" % (
+                    jobs, "stream" if stream else "random", elapsed,
+                    nfiles * size / MiB / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def make_tree(top, nfiles, size, fanout = 16):
+    """Create 'nfiles' files of 'size' bytes spread across subdirs."""
+    for i in range(nfiles):
+        d = os.path.join(top, "d%02d" % (i % fanout))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        make_file(os.path.join(d, "f%06d" % (i)), size)
+
+def bench_dir_jobs():
+    """Throughput of ManifestDirWalker.build() with N hashing threads."""
+    from manifest_dir import ManifestDirWalker
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nfiles, size = 256, 4 * MiB
+        make_tree(tmpdir, nfiles, size)
+        ManifestDirWalker().build(tmpdir) # warm up the page cache
+        print("%6s %10s %10s" % ("jobs", "seconds", "MiB/s"))
+        for jobs in (1, 2, 4, 8):
+            t = time.time()
+            ManifestDirWalker(jobs = jobs).build(tmpdir)
+            elapsed = time.time() - t
+            print("%6d %10.3f %10.1f" % (
+                jobs, elapsed, nfiles * size / MiB / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_dir_walk():
+    """Entries/s of ManifestDirWalker.build() on many empty files."""
+    from manifest_dir import ManifestDirWalker
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nfiles = 100000
+        make_tree(tmpdir, nfiles, 0, fanout = 100)
+        print("%-20s %10s %12s" % ("attrkeys", "seconds", "entries/s"))
+        for attrkeys in ([], ["mode"], ["mode", "size", "uid", "gid"]):
+            t = time.time()
+            ManifestDirWalker().build(tmpdir, attrkeys)
+            elapsed = time.time() - t
+            print("%-20s %10.3f %12.0f" % (
+                ",".join(attrkeys) or "-", elapsed, nfiles / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_dir_processes():
+    """Entries/s of ManifestDirWalker.build() with N worker processes."""
+    from manifest_dir import ManifestDirWalker
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nfiles = 100000
+        make_tree(tmpdir, nfiles, 100, fanout = 64)
+        print("%10s %10s %12s" % ("processes", "seconds", "entries/s"))
+        for processes in (1, 2, 4, 8):
+            t = time.time()
+            ManifestDirWalker(processes = processes).build(tmpdir)
+            elapsed = time.time() - t
+            print("%10d %10.3f %12.0f" % (processes, elapsed, nfiles / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def child_manifest_memory(nentries, with_attrs, backend = "dict",
+                          method = "add"):
+    """Build a Manifest of 'nentries' entries; print seconds and bytes/entry."""
+    import gc
+    from manifest import Manifest
+    from manifest_columnar import ColumnarManifest
+    fanout = 1000
+    ndirs = int(nentries) // fanout
+    sha1 = "0123456789abcdef0123456789abcdef01234567"
+    def records():
+        for d in range(ndirs):
+            yield "d%06d" % (d), None
+            for f in range(fanout - 1):
+                attrs = None
+                if with_attrs == "attrs":
+                    attrs = {"mode": 0o100644, "size": f, "sha1": sha1}
+                yield "d%06d/f%06d" % (d, f), attrs
+    gc.collect()
+    before = peak_rss_kib()
+    t = time.time()
+    top = ColumnarManifest() if backend == "columnar" else Manifest()
+    n = ndirs * fanout
+    if method == "add_many":
+        top.add_many(records())
+    else:
+        for d in range(ndirs):
+            sub = top.add(["d%06d" % (d)])
+            for f in range(fanout - 1):
+                attrs = None
+                if with_attrs == "attrs":
+                    attrs = {"mode": 0o100644, "size": f, "sha1": sha1}
+                sub.add(["f%06d" % (f)], attrs)
+    if backend == "columnar":
+        top.compact()
+    elapsed = time.time() - t
+    print(elapsed, (peak_rss_kib() - before) * 1024.0 / n)
+
+def bench_manifest_memory():
+    """Memory per entry and build time of large in-memory Manifests."""
+    print("%10s %-8s %-9s %-9s %10s %12s" % (
+        "entries", "attrs", "backend", "method", "seconds", "bytes/entry"))
+    for nentries in (1000000, 10000000):
+        for with_attrs in ("none", "attrs"):
+            for backend in ("dict", "columnar"):
+                for method in ("add", "add_many"):
+                    elapsed, per_entry = run_child("manifest_memory",
+                        nentries, with_attrs, backend, method)
+                    print("%10d %-8s %-9s %-9s %10.3f %12.1f" % (
+                        nentries, with_attrs, backend, method,
+                        float(elapsed), float(per_entry)))
+
+def bench_manifest_insert():
+    """Entries/s of inserting full paths with add() vs. add_many()."""
+    from manifest import Manifest
+    from manifest_columnar import ColumnarManifest
+    print("%-6s %-17s %-9s %10s %12s" % (
+        "depth", "backend", "method", "seconds", "entries/s"))
+    for depth in (1, 8, 32):
+        prefix = ["p%d" % (i) for i in range(depth - 1)]
+        paths = ["/".join(prefix[:i + 1]) for i in range(len(prefix))]
+        top = "/".join(prefix + [""]) # depth-first order, as in a tar file
+        for d in range(100):
+            paths.append("%sd%d" % (top, d))
+            paths.extend("%sd%d/f%d" % (top, d, f) for f in range(1000))
+        for cls in (Manifest, ColumnarManifest):
+            for method in ("add", "add_many"):
+                m = cls()
+                t = time.time()
+                if method == "add":
+                    for path in paths:
+                        m.add(path.split("/"))
+                else:
+                    m.add_many((path, None) for path in paths)
+                elapsed = time.time() - t
+                print("%-6d %-17s %-9s %10.3f %12.0f" % (
+                    depth + 1, cls.__name__, method, elapsed,
+                    len(paths) / elapsed))
+
+def bench_manifest_walk():
+    """Per-entry overhead of walk() and paths() on a 50-level-deep tree."""
+    from manifest import Manifest
+    from manifest_columnar import ColumnarManifest
+    nentries, depth = 1000000, 50
+    per_level = nentries // depth
+    sha1 = "0123456789abcdef0123456789abcdef01234567"
+    def records():
+        prefix = ""
+        for level in range(depth):
+            for f in range(per_level - 1):
+                yield prefix + "f%06d" % (f), {"size": f, "sha1": sha1}
+            prefix += "d%02d" % (level)
+            yield prefix, {"mode": 0o40755}
+            prefix += "/"
+    walks = [
+        ("walk", lambda m: m.walk()),
+        ("walk(attrs_view)", lambda m: m.walk(attrs_view = True)),
+        ("paths", lambda m: m.paths()),
+        ("diff(self)", lambda m: Manifest.diff(m, m)),
+    ]
+    print("%-17s %-17s %10s %12s" % ("backend", "method", "seconds",
+                                     "ns/entry"))
+    for cls in (Manifest, ColumnarManifest):
+        m = cls()
+        m.add_many(records())
+        for name, func in walks:
+            t = time.time()
+            for x in func(m):
+                pass
+            elapsed = time.time() - t
+            print("%-17s %-17s %10.3f %12.0f" % (
+                cls.__name__, name, elapsed, elapsed * 1e9 / nentries))
+        del m
+
+def bench_manifest_merge():
+    """Tuples/s of Manifest.merge() across N mostly identical manifests."""
+    from manifest import Manifest
+    nentries = 20000
+    print("%10s %10s %12s %12s" % ("manifests", "seconds", "tuples/s",
+                                   "key calls"))
+    for nmanifests in (2, 8, 32):
+        ms = []
+        for h in range(nmanifests):
+            m = Manifest()
+            records = []
+            for d in range(nentries // 100):
+                records.append(("d%03d" % (d), None))
+                for f in range(99): # every 7th file differs between hosts
+                    suffix = "-h%d" % (h) if f % 7 == 0 else ""
+                    records.append(("d%03d/f%03d%s" % (d, f, suffix), None))
+            m.add_many(records)
+            ms.append(m)
+        calls = [0]
+        def key(px):
+            calls[0] += 1
+            return px
+        t = time.time()
+        n = 0
+        for x in Manifest.merge(*ms, key = key):
+            n += 1
+        elapsed = time.time() - t
+        print("%10d %10.3f %12.0f %12d" % (nmanifests, elapsed, n / elapsed,
+                                           calls[0]))
+
+def bench_manifest_diff():
+    """Seconds to diff two near-identical 1M-entry Manifests by digests."""
+    from manifest import Manifest
+    sha1 = "0123456789abcdef0123456789abcdef01234567"
+    def build():
+        m = Manifest()
+        m.add_many(("d%03d" % (i // 1000) if i % 1000 == 0 else
+                    "d%03d/f%03d" % (i // 1000, i % 1000),
+                    {"size": i, "sha1": sha1}) for i in range(1000000))
+        return m
+    m1, m2 = build(), build()
+    def timed(label, func):
+        t = time.time()
+        ret = func()
+        print("%-30s %10.3f" % (label, time.time() - t))
+        return ret
+    print("%-30s %10s" % ("step", "seconds"))
+    timed("diff (no digests)", lambda: list(Manifest.diff(m1, m2)))
+    timed("m1 == m2 (no digests)", lambda: m1 == m2)
+    timed("digest() x2", lambda: (m1.digest(), m2.digest()))
+    timed("m1 == m2 (digests)", lambda: m1 == m2)
+    m2.resolve("d500/f500").setattr("size", 0)
+    timed("digest() after setattr()", m2.digest)
+    timed("diff (digests)", lambda: list(Manifest.diff(m1, m2)))
+    m2.resolve("d100").add(["new"])
+    timed("digest() after add()", m2.digest)
+    timed("diff (digests) after add()", lambda: list(Manifest.diff(m1, m2)))
+
+def bench_manifest_diff_attrs():
+    """Seconds and lazy digests computed to find changed entries."""
+    from manifest import Manifest, LazyAttr
+    calls = [0]
+    def lazy_sha1(i):
+        def func():
+            calls[0] += 1
+            return "%040x" % (i)
+        return LazyAttr(func)
+    def build(changed):
+        m = Manifest()
+        m.add_many(("d%03d" % (i // 1000) if i % 1000 == 0 else
+                    "d%03d/f%03d" % (i // 1000, i % 1000),
+                    {"mode": 0o100644, "size": i + (i in changed),
+                     "sha1": lazy_sha1(i + (i in changed))})
+                   for i in range(200000))
+        return m
+    def resolve_and_compare(m1, m2):
+        """Find modified entries the old way: merge(), then resolve()."""
+        for p1, p2 in Manifest.merge(m1, m2):
+            if p1 is not None and p2 is not None:
+                a1, a2 = m1.resolve(p1).getattrs(), m2.resolve(p2).getattrs()
+                if a1 != a2:
+                    yield p1, sorted(k for k in a1 if a1[k] != a2.get(k))
+    changed = set(range(1, 200000, 100))
+    print("%-22s %10s %10s %14s" % ("method", "seconds", "changes",
+                                    "lazy computed"))
+    for name, func in [("merge()+resolve()", resolve_and_compare),
+                       ("diff_attrs()", Manifest.diff_attrs)]:
+        m1, m2 = build(()), build(changed)
+        calls[0] = 0
+        t = time.time()
+        n = len(list(func(m1, m2)))
+        elapsed = time.time() - t
+        print("%-22s %10.3f %10d %14d" % (name, elapsed, n, calls[0]))
+
+def bench_manifest_merge_nodes():
+    """Seconds to get the attrs of merged entries via resolve() vs. nodes."""
+    from manifest import Manifest
+    ms = []
+    for h in range(2):
+        records = []
+        for d in range(20):
+            records.append(("d%02d" % (d), None))
+            for sub in range(100):
+                records.append(("d%02d/s%02d" % (d, sub), None))
+                for f in range(100): # every 7th file differs
+                    suffix = "x" * h if f % 7 == 0 else ""
+                    records.append(("d%02d/s%02d/f%02d%s" % (d, sub, f, suffix),
+                                    {"size": f}))
+        m = Manifest()
+        m.add_many(records)
+        ms.append(m)
+    def with_resolve():
+        for paths in Manifest.merge(*ms):
+            [p and m.resolve(p).getattrs() for m, p in zip(ms, paths)]
+    def with_nodes():
+        for path, nodes in Manifest.merge_nodes(*ms):
+            [n and n.getattrs() for n in nodes]
+    print("%-20s %10s" % ("method", "seconds"))
+    for name, func in [("merge()+resolve()", with_resolve),
+                       ("merge_nodes()", with_nodes)]:
+        t = time.time()
+        func()
+        print("%-20s %10.3f" % (name, time.time() - t))
+
+def bench_manifest_lookup():
+    """Lookups/s of full paths in a 1M-entry Manifest."""
+    import random
+    from manifest import Manifest
+    m = Manifest()
+    paths = []
+    for a in range(100):
+        paths.append("usr%02d" % (a))
+        for b in range(100):
+            paths.append("usr%02d/lib%02d" % (a, b))
+            paths.extend("usr%02d/lib%02d/file%02d" % (a, b, c)
+                         for c in range(98))
+    m.add_many((path, None) for path in paths)
+    random.seed(0)
+    queries = random.sample(paths, 200000)
+    def timed(label, func):
+        t = time.time()
+        func()
+        elapsed = time.time() - t
+        print("%-20s %10.3f %12.0f" % (label, elapsed,
+                                       len(queries) / elapsed))
+    print("%-20s %10s %12s" % ("method", "seconds", "lookups/s"))
+    def consume(it):
+        for x in it:
+            pass
+    timed("resolve()", lambda: consume(m.resolve(p) for p in queries))
+    t = time.time()
+    m.build_index()
+    print("%-20s %10.3f" % ("build_index()", time.time() - t))
+    timed("lookup()", lambda: consume(m.lookup(p) for p in queries))
+    timed("lookup_many()", lambda: consume(m.lookup_many(queries)))
+    m.drop_index()
+
+benchmarks = {
+    "hash_file": bench_hash_file,
+    "dir_jobs": bench_dir_jobs,
+    "dir_walk": bench_dir_walk,
+    "dir_processes": bench_dir_processes,
+    "tar_member": bench_tar_member,
+    "tar_pipeline": bench_tar_pipeline,
+    "manifest_memory": bench_manifest_memory,
+    "manifest_insert": bench_manifest_insert,
+    "manifest_walk": bench_manifest_walk,
+    "manifest_merge": bench_manifest_merge,
+    "manifest_merge_nodes": bench_manifest_merge_nodes,
+    "manifest_lookup": bench_manifest_lookup,
+    "manifest_diff": bench_manifest_diff,
+    "manifest_diff_attrs": bench_manifest_diff_attrs,
+}
+
+children = {
+    "hash_file": child_hash_file,
+    "tar_member": child_tar_member,
+    "manifest_memory": child_manifest_memory,
+}
+
+def main(args):
+    if args and args[0] == "--child":
+        return children[args[1]](*args[2:])
+    for name in args or sorted(benchmarks):
+        print("=== %s: %s" % (name, benchmarks[name].__doc__))
+        benchmarks[name]()
+        print()
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main(sys.argv[1:])
@@ -1,58 +1,209 @@
-import weakref
+import heapq
+import hashlib
+import functools
 
-class Manifest(dict):
-    """Encapsulate a description of a file hierarchy.
+try:
+    from types import MappingProxyType as attrs_proxy
+except ImportError: # Python 2 has no read-only dict view; copy instead
+    attrs_proxy = dict
 
-    This is equivalent to a hierarchical dictionary, where each key is an entry
-    (i.e. file or direcotry) in the file hierarchy, and the corresponding value
-    is the Manifest object representing the children of that entry.
+class LazyAttr(object):
+    """A deferred attribute value that is computed on first access.
 
-    In addition to merely wrapping a dict of Manifest objects, each Manifest
-    also has a ._parent member that (weakly) references the Manifest object of
-    the parent (or None for a toplevel Manifest object).
+    Builders may store LazyAttr objects in place of attribute values. The
+    wrapped 'func' is called (without arguments) the first time the attribute
+    is accessed, and its return value then replaces the LazyAttr. A return
+    value of None means that the attribute is not present.
+    """
 
-    Finally, each Manifest also has a ._attrs member which is a dictionary of
-    attributes that apply to that Manifest. The dictionary is fundamentally
-    open/free-form, but there are some attributes (e.g. 'size' and 'sha1') that
-    carry special meaning.
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+def lazy_attrs(func, attrkeys):
+    """Return a dict of LazyAttrs for 'attrkeys' that share a single func().
+
+    The given 'func' returns a dict of attributes, and is called at most once,
+    when the first of the returned LazyAttrs is accessed.
     """
+    result = []
+    def get(k):
+        if not result:
+            result.append(func())
+        return result[0].get(k)
+    return dict((k, LazyAttr(functools.partial(get, k))) for k in attrkeys)
 
-    def __init__(self):
-        dict.__init__(self)
-        self._parent = None
-        self._attrs = {}
+# Attributes that are cheap to compare, in the order diff_attrs() tries them
+CHEAP_ATTRS = ("size", "mode", "uid", "gid", "mtime_ns")
 
-    def add(self, path, attrs = None):
-        """Add the given path (a list of components) to this manifest."""
-        try:
-            component = path.pop(0)
-        except IndexError:
-            raise ValueError("Cannot add null path")
-        if not component:
-            raise ValueError("Cannot add empty path component")
+def child_pairs(a, b):
+    """Generate (name, child of a, child of b) for the union of their names.
+
+    The names are generated in sorted order, and a missing child is None.
+    """
+    names_a, get_a = a._listing()
+    names_b, get_b = b._listing()
+    i = j = 0
+    while i < len(names_a) and j < len(names_b):
+        na, nb = names_a[i], names_b[j]
+        if na == nb:
+            yield na, get_a(na), get_b(nb)
+            i += 1
+            j += 1
+        elif na < nb:
+            yield na, get_a(na), None
+            i += 1
+        else:
+            yield nb, None, get_b(nb)
+            j += 1
+    for na in names_a[i:]:
+        yield na, get_a(na), None
+    for nb in names_b[j:]:
+        yield nb, None, get_b(nb)
+
+class ManifestInserter(object):
+    """Add many entries below a (Columnar)Manifest in amortized O(1) each.
+
+    The inserter remembers the parent node of the last added entry, and the
+    last added entry itself, so entries arriving in depth-first order (as from
+    a directory walk, a tar file, or a manifest file) find their parent node
+    without walking down from the top. Other orders work too, at the cost of
+    walking down from the top whenever the parent changes.
+    """
+
+    def __init__(self, top):
+        self.top = top
+        self.parent_key, self.parent = None, top # None: path has no parent
+        self.last_key, self.last = None, None
 
-        if path: # not a leaf entry
-            if component not in self: # non-leafs must already exist in manifest
+    def find(self, key):
+        """Return the node at 'key' (a "/"-separated string or a tuple)."""
+        node = self.top
+        for component in (key.split("/") if hasattr(key, "split") else key):
+            if not component:
+                raise ValueError("Cannot add empty path component")
+            node = node.get(component)
+            if node is None: # non-leafs must already exist in manifest
                 raise ValueError("Cannot add child before parent")
-            return self[component].add(path, attrs)
-        assert component not in self
-        new = self.setdefault(component, self.__class__())
-        new.setparent(self)
-        if attrs:
-            new._attrs = attrs
-        return new
+        return node
 
-    def getparent(self):
-        return self._parent() if self._parent is not None else None
+    def add(self, path, attrs = None):
+        """Add 'path' (a "/"-separated string or a sequence of components).
 
-    def setparent(self, manifest):
-        self._parent = weakref.ref(manifest) if manifest is not None else None
+        Return the new node. Raise ValueError if its parent does not exist,
+        or if it already exists.
+        """
+        if hasattr(path, "split"):
+            key = path
+            i = path.rfind("/")
+            if i < 0:
+                parent_key, name = None, path
+            else:
+                parent_key, name = path[:i], path[i + 1:]
+        else:
+            if not path:
+                raise ValueError("Cannot add null path")
+            key = tuple(path)
+            parent_key, name = key[:-1] or None, key[-1]
+        if parent_key != self.parent_key:
+            if parent_key is None:
+                parent = self.top
+            elif parent_key == self.last_key: # first child of the last entry
+                parent = self.last
+            else:
+                parent = self.find(parent_key)
+            self.parent_key, self.parent = parent_key, parent
+        if name in self.parent:
+            raise ValueError("Cannot add existing entry %s" % (name))
+        self.last = self.parent.add((name,), attrs)
+        self.last_key = key
+        return self.last
 
-    def getattrs(self):
-        return self._attrs.copy()
+# Shared ._attrs of all Manifests without attributes. Never modified in place.
+EMPTY_ATTRS = {}
 
-    def setattrs(self, attrs):
-        self._attrs = dict(attrs)
+# Subtree digest of a Manifest without children
+EMPTY_DIGEST = hashlib.sha1().hexdigest()
+
+def encode_name(s):
+    """Return the bytes to feed into a digest for the (unicode) string 's'."""
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8", "surrogateescape")
+
+class PathIndex(object):
+    """Index of all relative paths below a top-level Manifest (see lookup()).
+
+    Every node of the indexed tree refers to the same PathIndex through its
+    ._path_index, so add() can keep the index up to date without walking up
+    to the top. Once the tree is modified in ways the index does not follow,
+    the index is dropped, which empties it for all nodes at once.
+    """
+
+    __slots__ = ("nodes", "paths")
+
+    def __init__(self, top):
+        self.nodes, self.paths = {}, {} # path -> node, id(node) -> path
+        for path, node in top._path_nodes():
+            self.nodes[path] = node
+            self.paths[id(node)] = path
+            node._path_index = self
+        top._path_index = self
+
+    def added(self, node, name, new):
+        """Record 'new', the new child 'name' of the indexed 'node'."""
+        parent_path = self.paths.get(id(node))
+        if parent_path is None: # the top-level Manifest
+            path = name
+        else:
+            path = parent_path + "/" + name
+        self.nodes[path] = new
+        self.paths[id(new)] = path
+        new._path_index = self
+
+    def drop(self):
+        """Empty this index, so that no node uses it anymore."""
+        self.nodes = self.paths = None
+
+class ManifestBase(object):
+    """Methods shared by Manifest and ColumnarManifest.
+
+    The walks, merges and diffs below only use the node API that both
+    classes implement: get(), getparent(), getattr(), getattrs(), ._digest,
+    and the _listing(), _raw_attrs() and _attrs_view() helpers.
+    """
+
+    __slots__ = ()
+
+    def same_entries(self, other):
+        """Return True if 'other' has the same entries below it (like ==).
+
+        This takes O(1) time if both nodes have matching cached digests (see
+        Manifest.digest()), and compares the entries with == otherwise.
+        """
+        if self is other:
+            return True
+        digest = self._digest
+        if digest is not None and digest == getattr(other, "_digest", None):
+            return True
+        return self == other
+
+    def add_many(self, records):
+        """Add the entries given by an iterable of (path, attrs) records.
+
+        Each path is a "/"-separated string or a sequence of components,
+        relative to this manifest, and parents must be added before their
+        children. Consecutive records are inserted relative to each other
+        (see ManifestInserter), so each insert takes amortized O(1) time for
+        records in depth-first order. Return the number of added entries.
+        """
+        inserter = ManifestInserter(self)
+        n = 0
+        for path, attrs in records:
+            inserter.add(path, attrs)
+            n += 1
+        return n
 
     def resolve(self, path):
         """Resolve a relative pathspec against this Manifest."""
@@ -61,15 +212,15 @@ class Manifest(dict):
         except ValueError:
             name, rest = path, ""
 
-        special = {
-            "": self,
-            ".": self,
-            "..": self.getparent(),
-        }
-        m = special.get(name, self.get(name))
+        if name in ("", "."):
+            m = self
+        elif name == "..":
+            m = self.getparent()
+        else:
+            m = self.get(name)
         return m.resolve(rest) if (m is not None and rest) else m
 
-    def walk(self, path = None):
+    def walk(self, path = None, attrs_view = False):
         """Analogue to os.walk(). Yield (path, entries, attrs) recursively.
 
         The path is itself a list of path components navigating the manifest
@@ -78,14 +229,38 @@ class Manifest(dict):
         The entries list contains the immediate sub-entries located at the
         corresponding path. The list may be modified by the caller to affect
         further walking.
+        The attrs are a copy of each entry's attributes, unless 'attrs_view'
+        is true, in which case they are a read-only view that is not copied
+        (where supported), and must not be kept after the entry is modified.
+        """
+        for path, names, node in self._walk_nodes(path):
+            if attrs_view:
+                yield path, names, node._attrs_view()
+            else:
+                yield path, names, node.getattrs()
+
+    def _walk_nodes(self, path = None):
+        """Like walk(), but yield the Manifest node itself instead of attrs.
+
+        This allows walking without computing any lazy attributes. The walk
+        uses an explicit stack instead of one generator per level of depth.
         """
         if path is None:
             path = []
-        names = sorted(self.keys())
-        yield path, names, self.getattrs() # Caller may modify names
-        for name in names:
-            for x in self[name].walk(path + [name]):
-                yield x
+        names, get = self._listing()
+        yield path, names, self # Caller may modify names
+        stack = [(path, get, iter(names))]
+        while stack:
+            path, get, it = stack[-1]
+            for name in it:
+                node = get(name)
+                child_path = path + [name]
+                names, child_get = node._listing()
+                yield child_path, names, node # Caller may modify names
+                stack.append((child_path, child_get, iter(names)))
+                break
+            else:
+                stack.pop()
 
     def paths(self, recursive = True, never_stop = False):
         """Generate relative paths from this manifests and all its children.
@@ -100,61 +275,235 @@ class Manifest(dict):
         StopIteration. The caller is responsible for aborting the iteration at
         an appropriate time.
         """
-        for path, names, attrs in self.walk():
-            if not path: # skip top-level/empty path
-                continue
-            recurse = (yield "/".join(path))
-            if recurse is None:
-                recurse = recursive
-            if not recurse:
-                del names[:]
+        names, get = self._listing()
+        stack = [("", get, iter(names))] # (path prefix, get, names left)
+        while stack:
+            prefix, get, it = stack[-1]
+            for name in it:
+                path = prefix + name
+                recurse = (yield path)
+                if recurse is None:
+                    recurse = recursive
+                if recurse: # only list children when descending into them
+                    names, child_get = get(name)._listing()
+                    if names:
+                        stack.append((path + "/", child_get, iter(names)))
+                break
+            else:
+                stack.pop()
         if never_stop:
             while True:
                 yield None
 
+    def _path_nodes(self, recursive = True, components = False):
+        """Like paths(), but yield (path, node) tuples, and then stop.
+
+        If 'components' is true, each path is a tuple of path components.
+        """
+        names, get = self._listing()
+        stack = [(() if components else "", get, iter(names))]
+        while stack:
+            prefix, get, it = stack[-1]
+            for name in it:
+                node = get(name)
+                if components:
+                    path = prefix + (name,)
+                else:
+                    path = prefix + name
+                recurse = (yield path, node)
+                if recurse is None:
+                    recurse = recursive
+                if recurse:
+                    names, child_get = node._listing()
+                    if names:
+                        child_prefix = path if components else path + "/"
+                        stack.append((child_prefix, child_get, iter(names)))
+                break
+            else:
+                stack.pop()
+
     @classmethod
     def merge(cls, *args, **kwargs):
         """Merge walks across multiple manifests.
 
         The given args are one or more Manifests (ma, mb, mc, ...). For each
-        given manifest mx, we call .paths() to generate a sequence of relative
-        paths. Merge these paths across manifests (using the given 'key' as a
-        sort key), and generate a sorted sequence of tuples (pa, pb, pc, ...),
-        where each px is either a path from the corresponding Manifest mx, or
-        None if the corresponding mx did not provide a matching path (according
-        to the 'key'). For a given tuple in the result sequence, all present
-        items (i.e. those that are not None) will be equivalent (according to
-        'key'), and there will be at least one present item. The total length
-        of the resulting sequence is equal to the length of the superset of the
-        given Manifests (again, using 'key' to discern between nodes). All
-        elements from all manifests will occur exactly once in the generated
-        sequence, and in sorted order.
+        given manifest mx, we generate its sequence of relative paths (as
+        with .paths()). Merge these paths across manifests (using the given
+        'key' as a sort key), and generate a sorted sequence of tuples
+        (pa, pb, pc, ...), where each px is either a path from the
+        corresponding Manifest mx, or None if the corresponding mx did not
+        provide a matching path (according to the 'key'). For a given tuple
+        in the result sequence, all present items (i.e. those that are not
+        None) will be equivalent (according to 'key'), and there will be at
+        least one present item. The total length of the resulting sequence is
+        equal to the length of the superset of the given Manifests (again,
+        using 'key' to discern between nodes). All elements from all
+        manifests will occur exactly once in the generated sequence, and in
+        sorted order.
 
         If you need to change the default recursive behavior of the manifests'
         .paths() invocation, you can pass the 'recursive' keyword argument.
         You may also send() True/False to a yield to force recursion on/off for
         that set of nodes.
+
+        If the 'prune_equal' keyword argument is true, never recurse into a
+        set of nodes that is present in all manifests, and whose cached
+        digest()s all match, as their subtrees are known to be identical.
+
+        The 'key' is called once for each path, and the pending paths are
+        kept in a heap, so each round costs O(log N) in the number of
+        manifests, plus the number of winners.
         """
         key = kwargs.get("key", lambda px: px) # use path itself as default key
-        recursive = kwargs.get("recursive", True)
-
-        # prevent StopIteration: make all generators repeat None ad infinitum.
-        # detect end of overall iteration when _all_ generators return None.
-        gens = [m.paths(never_stop = True) for m in args]
-
-        paths = [next(gen) for gen in gens] # first line of contestants
-        while any(p is not None for p in paths): # there are contestants left
-            ticket = min(key(p) for p in paths if p is not None) # perform draw
-            winners = [(p if key(p) == ticket else None) for p in paths]
-            assert any(p is not None for p in winners) # at least one winner
-            recurse = (yield tuple(winners))
+        return cls._merge([m._path_nodes() for m in args], key,
+                          kwargs.get("recursive", True),
+                          kwargs.get("prune_equal", False))
+
+    @classmethod
+    def merge_nodes(cls, *args, **kwargs):
+        """Merge walks across multiple manifests, yielding their nodes.
+
+        This is like merge(), but generates (path, (na, nb, nc, ...)) tuples,
+        where each nx is the node of the corresponding manifest mx at 'path',
+        or None if mx has no matching entry. The nodes are those visited by
+        the walk, so there is no need to resolve() the paths again.
+
+        Each 'path' is a tuple of path components (from the first manifest
+        that has a matching entry), and the walks are merged by comparing
+        these tuples (or the given 'key' of them), so that entries are
+        ordered like in a walk() even if names sort before "/". The
+        'recursive' and 'prune_equal' keyword arguments, and send()ing
+        True/False to a yield, work as in merge().
+        """
+        key = kwargs.get("key", lambda px: px)
+        return cls._merge([m._path_nodes(components = True) for m in args],
+                          key, kwargs.get("recursive", True),
+                          kwargs.get("prune_equal", False), with_nodes = True)
+
+    @classmethod
+    def _merge(cls, gens, key, recursive, prune_equal, with_nodes = False):
+        """Merge the (path, node) walks from the given _path_nodes() 'gens'.
+
+        Generate the tuples described in merge(), or if 'with_nodes' is true,
+        those described in merge_nodes().
+        """
+        # heap of (key, index, path, node) for the next path of each
+        # generator. key() is called once per path, and the unique index
+        # breaks ties. A generator leaves the heap once it is exhausted.
+        heap = []
+        for i, gen in enumerate(gens):
+            for p, node in gen:
+                heap.append((key(p), i, p, node))
+                break
+        heapq.heapify(heap)
+        while heap: # there are contestants left
+            ticket, i, p, node = heapq.heappop(heap) # perform draw
+            winners = [None] * len(gens)
+            winners[i] = p
+            nodes = [(i, node)]
+            while heap and heap[0][0] == ticket: # collect other winners
+                _, i, p, node = heapq.heappop(heap)
+                winners[i] = p
+                nodes.append((i, node))
+            if with_nodes:
+                found = [None] * len(gens)
+                for i, node in nodes:
+                    found[i] = node
+                recurse = (yield winners[nodes[0][0]], tuple(found))
+            else:
+                recurse = (yield tuple(winners))
             if recurse is None:
                 recurse = recursive
-            next_round = []
-            for w, p, g in zip(winners, paths, gens):
-                # if p is a winner, get next round's player from g, else reuse p
-                next_round.append(p if w is None else g.send(recurse))
-            paths = next_round # prepare for next round
+            if recurse and prune_equal and len(nodes) == len(gens):
+                digest = nodes[0][1]._digest
+                if digest is not None and all(
+                        node._digest == digest for i, node in nodes):
+                    recurse = False # identical subtrees
+            for i, node in nodes: # get next round's player from each winner
+                try:
+                    p, node = gens[i].send(recurse)
+                except StopIteration:
+                    continue
+                heapq.heappush(heap, (key(p), i, p, node))
+
+    @classmethod
+    def changed_attrs(cls, old, new, attrkeys = None):
+        """Return the keys of the attributes that differ between two nodes.
+
+        Only the given 'attrkeys' (default: all present in either node) are
+        compared. Cheap attributes (CHEAP_ATTRS) are compared first, then
+        other attributes, and finally those that are not yet computed. When
+        both nodes have sizes, and they differ, content digests (as registered
+        in manifest_digest) are known to differ too, and are not computed for
+        the comparison.
+        The keys are returned in the order they were compared.
+        """
+        from manifest_digest import digests
+        raw_old, raw_new = old._raw_attrs(), new._raw_attrs()
+        if attrkeys is None:
+            if not raw_old and not raw_new:
+                return []
+            attrkeys = set(raw_old) | set(raw_new)
+
+        def cost(k):
+            if k in CHEAP_ATTRS:
+                return (0, CHEAP_ATTRS.index(k), k)
+            lazy = isinstance(raw_old.get(k), LazyAttr) or \
+                isinstance(raw_new.get(k), LazyAttr)
+            return (2 if lazy else 1, 0, k)
+
+        changed = []
+        size_differs = False
+        for k in sorted(attrkeys, key = cost):
+            if size_differs and k in digests and k in raw_old and k in raw_new:
+                changed.append(k) # different sizes have different digests
+                continue
+            v_old, v_new = old.getattr(k), new.getattr(k)
+            if v_old != v_new:
+                changed.append(k)
+                if k == "size" and v_old is not None and v_new is not None:
+                    size_differs = True
+        return changed
+
+    @classmethod
+    def diff_attrs(cls, old, new, attrkeys = None, recursive = False):
+        """Generate the entries that were added, removed or modified.
+
+        Walk the nodes of the manifests 'old' and 'new' side by side, and
+        generate (change, path, keys) tuples in sorted order, where 'change'
+        is "added", "removed" or "modified", and 'keys' lists the attributes
+        that differ (see changed_attrs()) for modified entries, or is empty.
+        Only the given 'attrkeys' (default: all) are compared.
+
+        As with diff(), 'recursive' determines whether the entries below an
+        added or removed entry are listed too. Subtrees whose cached
+        digest()s match are skipped.
+        """
+        if old._digest is not None and old._digest == new._digest:
+            return
+        stack = [("", child_pairs(old, new))]
+        while stack:
+            prefix, it = stack[-1]
+            for name, a, b in it:
+                path = prefix + name
+                if a is None or b is None:
+                    change, node = (("added", b) if a is None
+                                    else ("removed", a))
+                    yield change, path, []
+                    if recursive:
+                        for p, _ in node._path_nodes():
+                            yield change, path + "/" + p, []
+                    continue
+                keys = cls.changed_attrs(a, b, attrkeys)
+                if keys:
+                    yield "modified", path, keys
+                if a._digest is not None and a._digest == b._digest:
+                    continue # identical subtrees
+                if a or b:
+                    stack.append((path + "/", child_pairs(a, b)))
+                    break
+            else:
+                stack.pop()
 
     @classmethod
     def diff(cls, *args, **kwargs):
@@ -177,9 +526,16 @@ class Manifest(dict):
         As with .merge(), the 'key' keyword argument determines how entries are
         compared, and this very much controls what ends up in the resulting
         diff. The default key simply evaluates to the relative entry path,
-        which is probably what you want in most cases.
+        which is probably what you want in most cases. To also find entries
+        whose attributes differ, use .diff_attrs() instead.
+
+        Subtrees whose cached digest()s match across all manifests are not
+        walked (see the 'prune_equal' argument to .merge(), which defaults to
+        True here), so diffing manifests with known digests takes time
+        proportional to the differences.
         """
         kwargs.setdefault('recursive', False) # Default to minimal diff
+        kwargs.setdefault('prune_equal', True)
         try:
             merged_entries = cls.merge(*args, **kwargs)
             t = next(merged_entries)
@@ -191,3 +547,297 @@ class Manifest(dict):
                     t = merged_entries.send(True) # Recurse into this node/path
         except StopIteration:
             pass
+
+class Manifest(ManifestBase, dict):
+    """Encapsulate a description of a file hierarchy.
+
+    This is equivalent to a hierarchical dictionary, where each key is an entry
+    (i.e. file or direcotry) in the file hierarchy, and the corresponding value
+    is the Manifest object representing the children of that entry.
+
+    In addition to merely wrapping a dict of Manifest objects, each Manifest
+    also has a ._parent member that references the Manifest object of the
+    parent (or None for a toplevel Manifest object).
+
+    Finally, each Manifest also has a ._attrs member which is a dictionary of
+    attributes that apply to that Manifest. The dictionary is fundamentally
+    open/free-form, but there are some attributes (e.g. 'size' and 'sha1') that
+    carry special meaning. Attribute values may be LazyAttr objects, which are
+    computed (and memoized) when the attribute is first accessed.
+
+    As there is one Manifest object per entry, they are kept small: there is
+    no per-object __dict__, Manifests without attributes share EMPTY_ATTRS,
+    and ._parent is a plain reference. A Manifest tree is therefore a web of
+    reference cycles, which is freed by the cyclic garbage collector.
+
+    Each Manifest may also cache a ._digest of its subtree (see digest()).
+    Cached digests are invalidated by add(), setattrs(), setattr(), graft()
+    and the dict mutators (item assignment and deletion, pop(), popitem(),
+    clear(), update() and setdefault()). Whenever a Manifest has a cached
+    digest, so have all its descendants.
+
+    The nodes of a top-level Manifest may share a PathIndex of all their
+    paths (see lookup()), which is kept up to date by add(), and dropped by
+    graft() and the dict mutators.
+    """
+
+    __slots__ = ("_parent", "_attrs", "_digest", "_path_index", "__weakref__")
+
+    def __init__(self):
+        dict.__init__(self)
+        self._parent = None
+        self._attrs = EMPTY_ATTRS
+        self._digest = None
+        self._path_index = None
+
+    # The dict mutators drop the cached digests that cover this Manifest
+
+    def __setitem__(self, name, child):
+        dict.__setitem__(self, name, child)
+        self._changed()
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self._changed()
+
+    def pop(self, *args):
+        try:
+            return dict.pop(self, *args)
+        finally:
+            self._changed()
+
+    def popitem(self):
+        try:
+            return dict.popitem(self)
+        finally:
+            self._changed()
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        try:
+            dict.update(self, *args, **kwargs)
+        finally:
+            self._changed()
+
+    def setdefault(self, name, default = None):
+        try:
+            return dict.setdefault(self, name, default)
+        finally:
+            self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def _changed(self):
+        """Note that the entries of this Manifest were modified as a dict."""
+        self._invalidate()
+        self.drop_index()
+
+    def add(self, path, attrs = None):
+        """Add the given path (a sequence of components) to this manifest.
+
+        Return the new Manifest node. To add many entries, use add_many().
+        """
+        if not path:
+            raise ValueError("Cannot add null path")
+        node = self
+        for component in path[:-1]:
+            if not component:
+                raise ValueError("Cannot add empty path component")
+            node = dict.get(node, component)
+            if node is None: # non-leafs must already exist in manifest
+                raise ValueError("Cannot add child before parent")
+        component = path[-1]
+        if not component:
+            raise ValueError("Cannot add empty path component")
+        assert component not in node
+        new = node.__class__()
+        dict.__setitem__(node, component, new)
+        new._parent = node
+        if attrs:
+            new._attrs = attrs
+        if node._digest is not None:
+            node._invalidate()
+        index = node._path_index
+        if index is not None and index.nodes is not None:
+            index.added(node, component, new)
+        return new
+
+    def getparent(self):
+        return self._parent
+
+    def setparent(self, manifest):
+        self._parent = manifest
+
+    def getattr(self, key, default = None):
+        """Return the value of the attribute 'key', computing it if needed."""
+        v = self._attrs.get(key, default)
+        if isinstance(v, LazyAttr):
+            v = v.func()
+            if v is None:
+                del self._attrs[key]
+                v = default
+            else:
+                self._attrs[key] = v
+        return v
+
+    def getattrs(self):
+        for k, v in list(self._attrs.items()):
+            if isinstance(v, LazyAttr):
+                self.getattr(k)
+        return self._attrs.copy()
+
+    def setattrs(self, attrs):
+        self._attrs = dict(attrs) if attrs else EMPTY_ATTRS
+        if self._parent is not None:
+            self._parent._invalidate()
+
+    def setattr(self, key, value):
+        """Set the attribute 'key' without computing any lazy attributes."""
+        attrs = dict(self._attrs)
+        attrs[key] = value
+        self._attrs = attrs
+        if self._parent is not None:
+            self._parent._invalidate()
+
+    def digest(self):
+        """Return the (cached) SHA1 hex digest of the subtree below this node.
+
+        The digest covers the names and attributes of all descendants (but
+        not the attributes of this node itself), computing any lazy ones.
+        Manifests whose digests match thus have the same entries with the
+        same attributes. Only the children with changes below them are
+        re-hashed after an add(), setattrs() or setattr().
+        """
+        if self._digest is None:
+            parts = []
+            for name in sorted(self.keys()):
+                child = self[name]
+                attrs = child._attrs
+                if attrs:
+                    attrs = child.getattrs()
+                    parts.append("\0".join([name] + [
+                        "%s=%s" % (k, attrs[k]) for k in sorted(attrs)]))
+                else:
+                    parts.append(name)
+                digest = child._digest
+                if digest is None:
+                    if child:
+                        digest = child.digest()
+                    else: # leaf
+                        child._digest = digest = EMPTY_DIGEST
+                parts.append("\0%s\n" % (digest))
+            self._digest = hashlib.sha1(
+                encode_name("".join(parts))).hexdigest()
+        return self._digest
+
+    def restore_digest(self, digest = None):
+        """Set the cached digest() to a previously computed value.
+
+        This only succeeds (and returns True) if the digests of all children
+        with children of their own are cached, as cached digests must be
+        known all the way down. If 'digest' is None, it is computed from the
+        children (which is cheap, as their digests are known).
+        """
+        children = list(self.values())
+        if any(c._digest is None and c for c in children):
+            return False
+        for c in children:
+            if c._digest is None:
+                c._digest = EMPTY_DIGEST
+        if digest is None:
+            digest = self.digest()
+        self._digest = digest
+        return True
+
+    def _invalidate(self):
+        """Drop the cached digests of this node and its ancestors."""
+        node = self
+        while node is not None and node._digest is not None:
+            node._digest = None
+            node = node._parent
+
+    def graft(self, other):
+        """Move the entries of Manifest 'other' into this Manifest.
+
+        The entries must not already exist in this Manifest. The attributes
+        of 'other' itself are not moved.
+        """
+        for name, child in list(other.items()):
+            if name in self:
+                raise ValueError("Cannot graft existing entry %s" % (name))
+            self[name] = child
+            child.setparent(self)
+        other.clear()
+
+    def build_index(self):
+        """Build the path index of this top-level Manifest (see lookup())."""
+        assert self._parent is None
+        PathIndex(self)
+
+    def drop_index(self):
+        """Drop the path index covering this Manifest, if any."""
+        index = self._path_index
+        if index is not None:
+            index.drop()
+            self._path_index = None
+
+    def _live_index(self):
+        """Return the nodes of this top-level Manifest's index, or None."""
+        if self._parent is not None:
+            return None
+        index = self._path_index
+        if index is None or index.nodes is None:
+            PathIndex(self)
+            index = self._path_index
+        return index.nodes
+
+    def lookup(self, path):
+        """Return the node at the relative 'path', or None if there is none.
+
+        On a top-level Manifest, this is a single dict access in an index of
+        all paths (as generated by paths()), which is built on the first
+        call, kept up to date by add(), and dropped (to be rebuilt on the
+        next call) when entries are modified as a dict or grafted. Other
+        paths, and lookups below other Manifests, fall back to resolve().
+        """
+        nodes = self._live_index()
+        node = None if nodes is None else nodes.get(path)
+        return self.resolve(path) if node is None else node
+
+    def lookup_many(self, paths):
+        """Generate (path, node) for each of the given relative 'paths'.
+
+        This is like calling lookup() for each path, but faster.
+        """
+        nodes = self._live_index()
+        if nodes is None: # not a top-level Manifest
+            for path in paths:
+                yield path, self.resolve(path)
+            return
+        get, resolve = nodes.get, self.resolve
+        for path in paths:
+            node = get(path)
+            yield path, resolve(path) if node is None else node
+
+    def _attrs_view(self):
+        """Return a read-only view of the attributes, computing lazy ones."""
+        attrs = self._attrs
+        for v in attrs.values():
+            if isinstance(v, LazyAttr):
+                self.getattrs()
+                attrs = self._attrs
+                break
+        return attrs_proxy(attrs)
+
+    def _raw_attrs(self):
+        """Return the attributes as stored, without computing lazy ones."""
+        return self._attrs
+
+    def _listing(self):
+        """Return the sorted names of children, and a function to get them."""
+        return sorted(self.keys()), self.__getitem__
@@ -0,0 +1,70 @@
+import tarfile
+import zipfile
+
+# Archives are recognized by the suffix of their file name
+ARCHIVE_SUFFIXES = (
+    # suffix, archive type
+    (".tar", "tar"),
+    (".tar.gz", "tar"), (".tgz", "tar"),
+    (".tar.bz2", "tar"), (".tbz2", "tar"),
+    (".tar.xz", "tar"), (".txz", "tar"),
+    (".zip", "zip"), (".jar", "zip"), (".whl", "zip"),
+)
+
+# Default 'archive_max_size' of the walkers: nested archives are read into
+# memory, so larger ones are not walked into unless explicitly allowed
+ARCHIVE_MAX_SIZE = 64 * 1024 * 1024
+
+def archive_type(name):
+    """Return the type ("tar" or "zip") of the archive 'name', or None."""
+    lower = name.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES:
+        if lower.endswith(suffix):
+            return kind
+    return None
+
+def nested_archive(walker, name, size):
+    """Return the archive type of 'name' if 'walker' should walk into it.
+
+    The walker's 'archive_depth' must be positive, and 'size' must not exceed
+    its 'archive_max_size' (unless that is None).
+    """
+    if walker.archive_depth <= 0:
+        return None
+    if walker.archive_max_size is not None and size > walker.archive_max_size:
+        return None
+    return archive_type(name)
+
+def walk_archive(walker, node, kind, source, attrkeys):
+    """Graft the contents of a nested archive found by 'walker' below 'node'.
+
+    'source' is a filename or a seekable file object holding an archive of
+    the given 'kind'. It is walked by a builder with the same settings as
+    'walker', and one less level of 'archive_depth'. Of the given 'attrkeys',
+    those that are not supported by that builder are skipped. The archive is
+    built into a Manifest of its own, which is only grafted below 'node' once
+    complete. If the archive cannot be read (or holds entries the builder
+    cannot handle, such as duplicate members), 'node' is left alone, and
+    False is returned.
+    """
+    if kind == "tar":
+        from manifest_tar import ManifestTarWalker as cls
+        errors = (tarfile.TarError, EOFError, IOError, ValueError)
+    else:
+        from manifest_zip import ManifestZipWalker as cls
+        errors = (zipfile.BadZipfile, zipfile.LargeZipFile, EOFError, IOError,
+                  ValueError)
+    builder = cls(walker.manifest_class, walker.bufsize,
+                  archive_depth = walker.archive_depth - 1,
+                  archive_max_size = walker.archive_max_size)
+    supported = builder.supported_attrs()
+    attrkeys = [k for k in attrkeys if k in supported]
+    try:
+        if kind == "tar":
+            sub = builder.build(source, None, attrkeys)
+        else:
+            sub = builder.build(source, "", attrkeys)
+    except errors:
+        return False
+    node.graft(sub)
+    return True
@@ -1,10 +1,119 @@
+import os
+import fnmatch
+
 import manifest
 
+# python < 3.3 has no st_mtime_ns. Then, mtime_ns is derived from st_mtime
+# for all stat() results, including those of the scandir backport (which do
+# have st_mtime_ns), so that they compare equal.
+STAT_MTIME_NS = hasattr(os.stat_result, "st_mtime_ns")
+
+def mtime_ns_from_stat(statinfo):
+    if STAT_MTIME_NS:
+        return statinfo.st_mtime_ns
+    return int(statinfo.st_mtime * 1000000000)
+
+class PathFilter(object):
+    """Select the entries that a builder adds while traversing its source.
+
+    'include' and 'exclude' are sequences of patterns. A pattern is either a
+    glob string or a compiled regular expression. A glob without a '/' is
+    matched against the entry name, while a glob with a '/' is matched against
+    the entry's path relative to the top of the Manifest. Regular expressions
+    are searched for in the relative path.
+
+    An entry matching any 'exclude' pattern is skipped, along with everything
+    below it. If 'include' patterns are given, non-directory entries must also
+    match one of them. Directories are not subject to 'include' patterns, so
+    that their contents can be examined. Entries deeper than 'max_depth' are
+    skipped (entries directly in the top of the Manifest are at depth 1), and
+    directories at 'max_depth' are not traversed.
+
+    Builders apply the filter during traversal, so excluded entries are never
+    stat()ed, hashed, or listed.
+    """
+
+    def __init__(self, include = None, exclude = None, max_depth = None,
+                 prefix = "", base_depth = 0):
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.max_depth = max_depth
+        self.prefix = prefix
+        self.base_depth = base_depth
+
+    def subtree(self, rel_path, depth):
+        """Return a filter for a traversal starting at 'rel_path'/'depth'."""
+        return self.__class__(self.include, self.exclude, self.max_depth,
+                              self.prefix + rel_path + "/",
+                              self.base_depth + depth)
+
+    @staticmethod
+    def matches(pattern, rel_path, name):
+        if hasattr(pattern, "search"):
+            return pattern.search(rel_path) is not None
+        if "/" in pattern:
+            return fnmatch.fnmatchcase(rel_path, pattern)
+        return fnmatch.fnmatchcase(name, pattern)
+
+    def accept(self, rel_path, name, depth, is_dir):
+        """Return True if the given entry should be added to the Manifest."""
+        depth += self.base_depth
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        rel_path = self.prefix + rel_path
+        for p in self.exclude:
+            if self.matches(p, rel_path, name):
+                return False
+        if self.include and not is_dir:
+            for p in self.include:
+                if self.matches(p, rel_path, name):
+                    return True
+            return False
+        return True
+
+    def descend(self, depth):
+        """Return True if a directory at 'depth' should be traversed."""
+        depth += self.base_depth
+        return self.max_depth is None or depth < self.max_depth
+
 class ManifestBuilder(object):
     """Base class for creating Manifests from a specific input source."""
 
+    # Max number of outstanding hash jobs per worker thread
+    pending_per_job = 64
+
     def __init__(self, manifest_class = manifest.Manifest):
         self.manifest_class = manifest_class
+        self.lazy_sources = [] # open files needed by lazy attributes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the files kept open for lazy attributes of built Manifests.
+
+        Lazy attributes that have not been accessed yet can no longer be
+        computed afterwards.
+        """
+        while self.lazy_sources:
+            self.lazy_sources.pop().close()
+
+    def finish_attrs(self, node, future):
+        """Merge the result of a pooled hash job into 'node'; return it."""
+        found = future.result()
+        attrs = node.getattrs()
+        attrs.update(found)
+        node.setattrs(attrs)
+        return found
+
+    def finish_pending(self, pending, limit = 0):
+        """Pass the oldest entries of the 'pending' deque to finish_attrs()
+        until no more than 'limit' entries remain."""
+        while len(pending) > limit:
+            self.finish_attrs(*pending.popleft())
 
     def supported_attrs(self):
         """Return the set of attribute names that are supported."""
@@ -0,0 +1,112 @@
+import sqlite3
+
+from manifest_builder import mtime_ns_from_stat
+
+def stat_signature(statinfo):
+    """Return the (device, inode, size, mtime_ns) tuple for a stat() result."""
+    return (statinfo.st_dev, statinfo.st_ino, statinfo.st_size,
+            mtime_ns_from_stat(statinfo))
+
+class HashCache(object):
+    """Persistent on-disk cache of file content digests.
+
+    Digests are stored in an sqlite database, keyed by the stat() signature
+    (device, inode, size, mtime_ns) of the file they were computed from, and
+    by the name of the digest attribute (e.g. 'sha1'). A file whose signature
+    is unchanged since the last walk is assumed to have unchanged contents.
+
+    Every time a cache is opened, a new generation is started, and each entry
+    remembers the last generation in which it was used. compact() evicts the
+    entries that have not been used in the most recent generations.
+
+    The 'hits' and 'misses' members count lookups in this generation.
+
+    Several processes may use the same cache concurrently: pass the generation
+    of the first opener to the others, so that they join its generation, and
+    pending changes are committed every 'commit_every' writes so that no
+    process holds the database lock for long.
+    """
+
+    commit_every = 1000
+
+    def __init__(self, path, generation = None, timeout = 60):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.db = sqlite3.connect(path, timeout = timeout)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS digests (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                name TEXT, value TEXT, used INTEGER,
+                PRIMARY KEY (dev, ino, size, mtime_ns, name));
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value INTEGER);
+        """)
+        if generation is not None:
+            self.generation = generation
+            return
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        self.generation = (row[0] if row else 0) + 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)",
+                        (self.generation,))
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def get(self, statinfo, name):
+        """Return the cached 'name' digest for 'statinfo', or None."""
+        key = stat_signature(statinfo) + (name,)
+        row = self.db.execute(
+            "SELECT value FROM digests WHERE dev = ? AND ino = ? AND size = ? "
+            "AND mtime_ns = ? AND name = ?", key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute(
+            "UPDATE digests SET used = ? WHERE dev = ? AND ino = ? AND "
+            "size = ? AND mtime_ns = ? AND name = ?", (self.generation,) + key)
+        self.wrote()
+        return row[0]
+
+    def put(self, statinfo, name, value):
+        """Store the 'name' digest 'value' for 'statinfo'."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+            stat_signature(statinfo) + (name, value, self.generation))
+        self.wrote()
+
+    def wrote(self):
+        self.writes += 1
+        if self.writes % self.commit_every == 0:
+            self.db.commit()
+
+    def compact(self, keep = 1):
+        """Evict entries not used in the last 'keep' generations.
+
+        The default evicts everything that has not been used since this cache
+        was opened. Return the number of evicted entries.
+        """
+        n = self.db.execute("DELETE FROM digests WHERE used <= ?",
+                            (self.generation - keep,)).rowcount
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return n
+
+    def flush(self):
+        """Write pending changes to disk."""
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,662 @@
+import array
+import binascii
+
+from manifest import Manifest, ManifestBase, LazyAttr, EMPTY_ATTRS
+from manifest_digest import digests
+
+# Marks a missing value in the integer attribute columns
+MISSING = -(2 ** 63)
+
+# Attributes stored in columns of signed 64-bit integers
+INT_ATTRS = ("mode", "uid", "gid", "size", "mtime_ns")
+
+# Array typecode of signed 64-bit integers
+try:
+    array.array("q")
+    INT64 = "q"
+except ValueError: # python 2 has no "q"; use "l" where that is 64-bit
+    INT64 = "l"
+    if array.array(INT64).itemsize != 8:
+        raise ImportError("ColumnarManifest needs 64-bit integer arrays")
+
+# Number of entries whose attributes append_many() converts at a time
+COLUMN_BATCH = 1024
+
+# Marks an attribute missing from an entry in set_columns()
+ABSENT = object()
+
+# Types of values that set_columns() converts to integer columns in bulk
+INT_TYPES = set([int, type(ABSENT)])
+
+# Types of values that set_columns() converts to digest columns in bulk
+TEXT_TYPES = set([str, type(u"")])
+
+def no_child(name):
+    raise KeyError(name)
+
+class ColumnarStore(object):
+    """The parallel arrays holding all entries of a ColumnarManifest tree.
+
+    Entry i has parent parents[i] (-1 for children of the top-level entry)
+    and name name_list[names[i]], where names are interned in 'name_ids'.
+    Its integer attributes are in ints[k][i] (MISSING if not set), and its
+    digest attributes are packed as binary digests at offset i * width of
+    digests[k] = (buffer, width, present), where present[i] tells whether
+    the digest is set. Any other attributes (and the attributes of the
+    top-level entry itself) are kept in the 'extra' dict, keyed by entry.
+
+    Columns are only created for the attributes that are actually set.
+
+    The children of each entry are found through 'lookup', an open
+    addressing hash table (in an array) of entry indexes plus one, keyed by
+    (parent, name id), and through 'index', which lists the children of each
+    entry sorted by name. Both are rebuilt when needed, and can be dropped
+    with compact().
+    """
+
+    def __init__(self):
+        self.parents = array.array(INT64)
+        self.names = array.array(INT64)
+        self.name_list = []
+        self.name_ids = {}
+        self.ints = {}
+        self.digests = {}
+        self.extra = {}
+        self.lookup = array.array(INT64, [0]) * 8
+        self.index = None
+        self.last_parent = (None, None) # ((top, path), entry) of last add()
+
+    def __len__(self):
+        return len(self.parents)
+
+    def intern(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.name_list)
+            self.name_list.append(name)
+        return name_id
+
+    def slot(self, parent, name_id):
+        """Return the 'lookup' slot for (parent, name_id).
+
+        That is the slot holding its entry, or the empty slot where it
+        belongs.
+        """
+        lookup, parents, names = self.lookup, self.parents, self.names
+        mask = len(lookup) - 1
+        h = hash((parent, name_id)) & mask
+        while True:
+            i = lookup[h] - 1
+            if i < 0 or (names[i] == name_id and parents[i] == parent):
+                return h
+            h = (h + 1) & mask
+
+    def build_lookup(self, size = 8):
+        n = len(self.parents)
+        while size < 2 * n:
+            size *= 2
+        lookup = array.array(INT64, [0]) * size
+        mask = size - 1
+        for i, key in enumerate(zip(self.parents, self.names), 1):
+            h = hash(key) & mask
+            while lookup[h]: # entries are unique, so just find a free slot
+                h = (h + 1) & mask
+            lookup[h] = i
+        self.lookup = lookup
+
+    def child(self, parent, name):
+        """Return the entry called 'name' below 'parent', or None."""
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            return None
+        if self.lookup is None:
+            self.build_lookup()
+        lookup, parents, names = self.lookup, self.parents, self.names
+        mask = len(lookup) - 1
+        h = hash((parent, name_id)) & mask
+        while True:
+            i = lookup[h] - 1
+            if i < 0:
+                return None
+            if names[i] == name_id and parents[i] == parent:
+                return i
+            h = (h + 1) & mask
+
+    def append(self, parent, name):
+        """Add a new entry without attributes, and return its index.
+
+        Return None (and add nothing) if the entry already exists.
+        """
+        i = len(self.parents)
+        name_id = self.intern(name)
+        if self.lookup is None:
+            self.build_lookup()
+        if 2 * (i + 1) > len(self.lookup):
+            self.build_lookup(2 * len(self.lookup))
+        h = self.slot(parent, name_id)
+        if self.lookup[h]:
+            return None
+        self.lookup[h] = i + 1
+        self.parents.append(parent)
+        self.names.append(name_id)
+        for column in self.ints.values():
+            column.append(MISSING)
+        for buf, width, present in self.digests.values():
+            buf.extend(b"\0" * width)
+            present.append(0)
+        self.index = None
+        return i
+
+    def append_many(self, top, records):
+        """Append the entries given by (path, attrs) records below 'top'.
+
+        This is the bulk version of append() and setattrs(), used by
+        ColumnarManifest.add_many(). Attributes are stored in batches with
+        set_columns(). Records in depth-first order are checked for
+        duplicates against sets of the names below the directories currently
+        being filled, and 'lookup' and 'index' are only rebuilt (once) when
+        next needed. Any other record order falls back to keeping 'lookup' up
+        to date, as append() does.
+
+        Raise ValueError if a parent does not exist, or an entry already
+        exists. Return the number of added entries.
+        """
+        parents, names, name_ids = self.parents, self.names, self.name_ids
+        batch = [] # attributes of the entries from i - len(batch) to i
+        siblings = set()
+        if len(parents):
+            siblings.update(names[j] for j in self.children(top))
+        # (key, entry, names of children) of directories being filled
+        stack = [(None, top, siblings)]
+        self.lookup = self.index = None
+        lookup = mask = None
+        parent_key, parent = None, top # None: path has no parent
+        last_key, last = None, None
+        i = start = len(parents)
+        try:
+            for path, attrs in records:
+                if hasattr(path, "split"):
+                    key = path
+                    j = path.rfind("/")
+                    if j < 0:
+                        pkey, name = None, path
+                    else:
+                        pkey, name = path[:j], path[j + 1:]
+                else:
+                    if not path:
+                        raise ValueError("Cannot add null path")
+                    key = tuple(path)
+                    pkey, name = key[:-1] or None, key[-1]
+                if not name:
+                    raise ValueError("Cannot add empty path component")
+                if pkey != parent_key:
+                    if stack is not None:
+                        if pkey == last_key: # first child of the last entry
+                            stack.append((pkey, last, set()))
+                        else:
+                            while len(stack) > 1 and stack[-1][0] != pkey:
+                                stack.pop()
+                            if stack[-1][0] != pkey: # not depth-first
+                                stack = None
+                                self.build_lookup()
+                                lookup = self.lookup
+                                mask = len(lookup) - 1
+                        if stack is not None:
+                            parent_key, parent, siblings = stack[-1]
+                    if stack is None:
+                        if pkey is None:
+                            parent = top
+                        elif pkey == last_key:
+                            parent = last
+                        else:
+                            parent = top
+                            for component in (pkey.split("/") if hasattr(
+                                    pkey, "split") else pkey):
+                                if not component:
+                                    raise ValueError(
+                                        "Cannot add empty path component")
+                                parent = self.child(parent, component)
+                                if parent is None: # non-leafs must exist
+                                    raise ValueError(
+                                        "Cannot add child before parent")
+                        parent_key = pkey
+
+                name_id = name_ids.get(name)
+                if name_id is None:
+                    name_id = name_ids[name] = len(self.name_list)
+                    self.name_list.append(name)
+                if stack is not None:
+                    if name_id in siblings:
+                        raise ValueError("Cannot add existing entry %s" % (
+                            name))
+                    siblings.add(name_id)
+                else:
+                    if 2 * (i + 1) > len(lookup):
+                        self.build_lookup(2 * len(lookup))
+                        lookup = self.lookup
+                        mask = len(lookup) - 1
+                    h = hash((parent, name_id)) & mask
+                    while lookup[h]:
+                        j = lookup[h] - 1
+                        if names[j] == name_id and parents[j] == parent:
+                            raise ValueError(
+                                "Cannot add existing entry %s" % (name))
+                        h = (h + 1) & mask
+                    lookup[h] = i + 1
+                parents.append(parent)
+                names.append(name_id)
+
+                batch.append(attrs or EMPTY_ATTRS)
+                if len(batch) == COLUMN_BATCH:
+                    self.set_columns(i + 1 - COLUMN_BATCH, batch)
+                    batch = []
+                last_key, last = key, i
+                i += 1
+        finally:
+            self.set_columns(i - len(batch), batch)
+        return i - start
+
+    def set_columns(self, start, batch):
+        """Set the attributes of the new entries from 'start' on at once.
+
+        'batch' lists the attribute dicts of entries start, start + 1, etc,
+        which must be the last entries, and have no attributes yet. Each
+        attribute is converted for all of them at once, and only values that
+        setattrs() would not put in its column are handled one by one.
+        """
+        n = start + len(batch)
+        for k in set().union(*batch):
+            values = [attrs.get(k, ABSENT) for attrs in batch]
+            if k in INT_ATTRS:
+                part = None
+                if set(map(type, values)) <= INT_TYPES:
+                    try:
+                        part = array.array(INT64, [MISSING if v is ABSENT
+                                                   else v for v in values])
+                    except OverflowError:
+                        pass
+                if part is None or part.count(MISSING) != values.count(ABSENT):
+                    part = array.array(INT64, [MISSING]) * len(batch)
+                    for j, v in enumerate(values):
+                        if type(v) is int and MISSING < v < 2 ** 63:
+                            part[j] = v
+                        elif v is not ABSENT:
+                            self.extra.setdefault(start + j, {})[k] = v
+                column = self.int_column(k)
+                del column[start:]
+                column.extend(part)
+                continue
+            if k not in digests:
+                for j, v in enumerate(values):
+                    if v is not ABSENT:
+                        self.extra.setdefault(start + j, {})[k] = v
+                continue
+            hexlen = digests[k][1]
+            found = [v for v in values if v is not ABSENT]
+            raw = None
+            if set(map(type, found)) <= TEXT_TYPES \
+                    and set(map(len, found)) == set([hexlen]):
+                hexdigests = "".join([
+                    "0" * hexlen if v is ABSENT else v for v in values])
+                if hexdigests == hexdigests.lower():
+                    try:
+                        raw = binascii.unhexlify(hexdigests)
+                    except (TypeError, ValueError, binascii.Error):
+                        pass
+            if raw is not None:
+                present = bytearray([v is not ABSENT for v in values])
+            else:
+                raw, present = bytearray(), bytearray()
+                zeros = b"\0" * (hexlen // 2)
+                for j, v in enumerate(values):
+                    packed = None if v is ABSENT else self.packed(k, v)
+                    raw.extend(zeros if packed is None else packed)
+                    present.append(packed is not None)
+                    if packed is None and v is not ABSENT:
+                        self.extra.setdefault(start + j, {})[k] = v
+            buf, width, column = self.digest_column(k)
+            del buf[start * width:]
+            del column[start:]
+            buf.extend(raw)
+            column.extend(present)
+        missing = array.array(INT64, [MISSING])
+        for column in self.ints.values():
+            if len(column) < n:
+                column.extend(missing * (n - len(column)))
+        for buf, width, present in self.digests.values():
+            if len(present) < n:
+                buf.extend(b"\0" * (width * (n - len(present))))
+                present.extend(b"\0" * (n - len(present)))
+
+    def int_column(self, k):
+        """Return the integer column for 'k', creating it if needed."""
+        column = self.ints.get(k)
+        if column is None:
+            column = array.array(INT64, [MISSING]) * len(self.parents)
+            self.ints[k] = column
+        return column
+
+    def digest_column(self, k):
+        """Return the digest column for 'k', creating it if needed."""
+        column = self.digests.get(k)
+        if column is None:
+            width = digests[k][1] // 2
+            column = (bytearray(width * len(self.parents)), width,
+                      bytearray(len(self.parents)))
+            self.digests[k] = column
+        return column
+
+    def children(self, i):
+        """Return the children of entry 'i', sorted by name."""
+        if self.index is None:
+            self.build_index()
+        start, order = self.index
+        return order[start[i + 1]:start[i + 2]]
+
+    def build_index(self):
+        """Build the sorted lists of children of all entries."""
+        n = len(self.parents)
+        start = array.array(INT64, [0]) * (n + 2)
+        for p in self.parents:
+            start[p + 2] += 1
+        for i in range(2, n + 2):
+            start[i] += start[i - 1]
+        order = array.array(INT64, [0]) * n
+        fill = array.array(INT64, start)
+        for i, p in enumerate(self.parents):
+            order[fill[p + 1]] = i
+            fill[p + 1] += 1
+        names, name_list = self.names, self.name_list
+        for p in range(n + 1):
+            lo, hi = start[p], start[p + 1]
+            if hi - lo > 1:
+                order[lo:hi] = array.array(INT64, sorted(
+                    order[lo:hi], key = lambda i: name_list[names[i]]))
+        self.index = (start, order)
+
+    def getattrs(self, i):
+        attrs = {}
+        if i >= 0:
+            for k, column in self.ints.items():
+                v = column[i]
+                if v != MISSING:
+                    attrs[k] = v
+            for k, (buf, width, present) in self.digests.items():
+                if present[i]:
+                    attrs[k] = binascii.hexlify(
+                        bytes(buf[i * width:(i + 1) * width])).decode("ascii")
+        attrs.update(self.extra.get(i, ()))
+        return attrs
+
+    def setattrs(self, i, attrs, new = False):
+        """Set the attributes of entry 'i'.
+
+        If 'new' is true, entry 'i' was just appended, and has no attributes
+        to clear.
+        """
+        extra = {}
+        if i < 0:
+            extra = dict(attrs)
+            attrs = {}
+        elif not new:
+            for column in self.ints.values():
+                column[i] = MISSING
+            for buf, width, present in self.digests.values():
+                present[i] = 0
+        for k, v in attrs.items():
+            if k in INT_ATTRS and type(v) is int and MISSING < v < 2 ** 63:
+                self.int_column(k)[i] = v
+                continue
+            raw = self.packed(k, v)
+            if raw is not None:
+                buf, width, present = self.digest_column(k)
+                buf[i * width:(i + 1) * width] = raw
+                present[i] = 1
+            else:
+                extra[k] = v
+        if extra:
+            self.extra[i] = extra
+        elif not new:
+            self.extra.pop(i, None)
+
+    @staticmethod
+    def packed(k, v):
+        """Return digest 'v' of attribute 'k' in binary, or None.
+
+        None is returned unless 'k' is a digest attribute, and 'v' is a
+        lowercase hex digest of the right length (so that it survives the
+        round-trip to binary and back).
+        """
+        if k not in digests or not hasattr(v, "lower") \
+                or len(v) != digests[k][1] or v != v.lower():
+            return None
+        try:
+            return binascii.unhexlify(v)
+        except (TypeError, ValueError, binascii.Error):
+            return None
+
+def copy_entries(src, dst):
+    """Add copies of the entries below 'src' below 'dst'.
+
+    Both may be Manifest or ColumnarManifest objects.
+    """
+    stack = [(src, dst)]
+    while stack:
+        src, dst = stack.pop()
+        for name, child in src.items():
+            stack.append((child, dst.add([name], child.getattrs())))
+
+class ColumnarManifest(ManifestBase):
+    """A Manifest stored as parallel arrays instead of a graph of objects.
+
+    This stores each entry in a handful of array elements (see ColumnarStore)
+    instead of a dict object with an attribute dict, which makes it suitable
+    for trees with tens of millions of entries. A ColumnarManifest object is
+    a lightweight handle to one entry in a shared ColumnarStore, and offers
+    the same API as Manifest: it can be passed as the 'manifest_class' of a
+    builder, and its walk(), paths(), resolve(), merge() and diff() (shared
+    through ManifestBase) work as they do for a Manifest (also when merging
+    with Manifests).
+
+    Large trees are built much faster with add_many() than with add().
+
+    Handles are created on demand, so two handles for the same entry are
+    equal, but not necessarily identical. As for Manifests, equality compares
+    the entries below two nodes, not their attributes. Use from_manifest() and
+    to_manifest() to convert from and to Manifest objects.
+    """
+
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, _store = None, _index = -1):
+        self._store = _store if _store is not None else ColumnarStore()
+        self._index = _index
+
+    def _node(self, i):
+        return self.__class__(self._store, i)
+
+    @classmethod
+    def from_manifest(cls, m):
+        """Return a ColumnarManifest with the entries of Manifest 'm'."""
+        ret = cls()
+        ret.setattrs(m.getattrs())
+        copy_entries(m, ret)
+        return ret
+
+    def to_manifest(self, manifest_class = Manifest):
+        """Return a Manifest with the entries below this one."""
+        ret = manifest_class()
+        ret.setattrs(self.getattrs())
+        copy_entries(self, ret)
+        return ret
+
+    def compact(self):
+        """Drop the lookup structures, to save memory until they are needed."""
+        self._store.lookup = None
+        self._store.index = None
+
+    def __eq__(self, other):
+        """Compare entries (not attributes), like Manifest.__eq__()."""
+        if isinstance(other, ColumnarManifest) and \
+                self._store is other._store and self._index == other._index:
+            return True
+        if not isinstance(other, (ColumnarManifest, dict)):
+            return NotImplemented
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if len(a) != len(b):
+                return False
+            for name, child in a.items():
+                other_child = b.get(name)
+                if other_child is None:
+                    return False
+                stack.append((child, other_child))
+        return True
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __len__(self):
+        return len(self._store.children(self._index))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, name):
+        return self._store.child(self._index, name) is not None
+
+    def __getitem__(self, name):
+        i = self._store.child(self._index, name)
+        if i is None:
+            raise KeyError(name)
+        return self._node(i)
+
+    def get(self, name, default = None):
+        i = self._store.child(self._index, name)
+        return default if i is None else self._node(i)
+
+    def keys(self):
+        """Return the names of the children of this entry, in sorted order."""
+        store = self._store
+        return [store.name_list[store.names[i]]
+                for i in store.children(self._index)]
+
+    def items(self):
+        store = self._store
+        return [(store.name_list[store.names[i]], self._node(i))
+                for i in store.children(self._index)]
+
+    def add(self, path, attrs = None):
+        """Add the given path (a sequence of components) to this manifest."""
+        if not path:
+            raise ValueError("Cannot add null path")
+        store = self._store
+        i = self._index
+        if len(path) > 1:
+            key = (i, tuple(path[:-1]))
+            if store.last_parent[0] == key: # entries are never removed
+                i = store.last_parent[1]
+            else:
+                for component in key[1]:
+                    if not component:
+                        raise ValueError("Cannot add empty path component")
+                    i = store.child(i, component)
+                    if i is None: # non-leafs must already exist in manifest
+                        raise ValueError("Cannot add child before parent")
+                store.last_parent = (key, i)
+        component = path[-1]
+        if not component:
+            raise ValueError("Cannot add empty path component")
+        i = store.append(i, component)
+        assert i is not None
+        if attrs:
+            store.setattrs(i, attrs, new = True)
+        return self._node(i)
+
+    def add_many(self, records):
+        """Add the entries given by an iterable of (path, attrs) records.
+
+        This works like Manifest.add_many(), but appends the entries straight
+        to the columns of the store, which is much faster than add() for
+        building large trees. Return the number of added entries.
+        """
+        return self._store.append_many(self._index, records)
+
+    def getparent(self):
+        if self._index < 0:
+            return None
+        return self._node(self._store.parents[self._index])
+
+    def getattr(self, key, default = None):
+        """Return the value of the attribute 'key', computing it if needed."""
+        attrs = self._store.getattrs(self._index)
+        v = attrs.get(key, default)
+        if isinstance(v, LazyAttr):
+            v = v.func()
+            if v is None:
+                del attrs[key]
+                v = default
+            else:
+                attrs[key] = v
+            self._store.setattrs(self._index, attrs)
+        return v
+
+    def getattrs(self):
+        attrs = self._store.getattrs(self._index)
+        if any(isinstance(v, LazyAttr) for v in attrs.values()):
+            for k in list(attrs):
+                self.getattr(k)
+            attrs = self._store.getattrs(self._index)
+        return attrs
+
+    def setattrs(self, attrs):
+        self._store.setattrs(self._index, attrs)
+
+    def setattr(self, key, value):
+        """Set the attribute 'key' without computing any lazy attributes."""
+        attrs = self._store.getattrs(self._index)
+        attrs[key] = value
+        self._store.setattrs(self._index, attrs)
+
+    def graft(self, other):
+        """Add copies of the entries of the (Columnar)Manifest 'other'.
+
+        The entries must not already exist in this ColumnarManifest.
+        """
+        for name in other:
+            if name in self:
+                raise ValueError("Cannot graft existing entry %s" % (name))
+        copy_entries(other, self)
+
+    def _raw_attrs(self):
+        return self._store.getattrs(self._index)
+
+    def _attrs_view(self):
+        return self.getattrs() # already a fresh dict
+
+    def _listing(self):
+        """Return the sorted names of children, and a function to get them."""
+        store = self._store
+        children = store.children(self._index)
+        if not children:
+            return [], no_child
+        names = [store.name_list[store.names[i]] for i in children]
+        by_name = dict(zip(names, children))
+        return names, lambda name: self._node(by_name[name])
+
+    # ColumnarManifest does not maintain subtree digests or path indexes
+    _digest = None
+
+    def lookup(self, path):
+        return self.resolve(path)
+
+    def lookup_many(self, paths):
+        for path in paths:
+            yield path, self.resolve(path)
+
+    def restore_digest(self, digest = None):
+        return False
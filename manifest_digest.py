@@ -0,0 +1,148 @@
+import zlib
+import hashlib
+import threading
+try:
+    import queue
+except ImportError: # python2
+    import Queue as queue
+
+# Default number of bytes to read at a time when hashing file contents
+BUFSIZE = 64 * 1024
+
+def hash_stream(f, hashers, bufsize = BUFSIZE):
+    """Feed the contents of the file object 'f' through the given hashers.
+
+    The contents are read into a single buffer of 'bufsize' bytes that is
+    reused for the entire file, so memory usage does not grow with the size
+    of the file. Return the given list of hashers.
+    """
+    if not hasattr(f, "readinto"): # e.g. tar members in python 2
+        while True:
+            chunk = f.read(bufsize)
+            if not chunk:
+                break
+            for h in hashers:
+                h.update(chunk)
+        return hashers
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        chunk = view[:n]
+        for h in hashers:
+            h.update(chunk)
+    return hashers
+
+try:
+    zlib.crc32(memoryview(b""))
+    crc32 = zlib.crc32
+except TypeError: # python 2 does not take memoryviews
+    def crc32(data, crc):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return zlib.crc32(data, crc)
+
+class CRC32(object):
+    """hashlib-like interface to zlib.crc32()."""
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = crc32(data, self.crc) & 0xffffffff
+
+    def hexdigest(self):
+        return "%08x" % (self.crc)
+
+digests = {
+    # name: (hasher factory, length of hex digest)
+    "sha1": (hashlib.sha1, 40),
+    "sha256": (hashlib.sha256, 64),
+    "md5": (hashlib.md5, 32),
+    "crc32": (CRC32, 8),
+}
+if hasattr(hashlib, "blake2b"): # python >= 3.6
+    digests["blake2b"] = (hashlib.blake2b, 128)
+
+def register_digest(name, factory, hexlen):
+    """Make a new digest attribute available to builders and parsers.
+
+    The given 'factory' returns a hashlib-like object (with .update() and
+    .hexdigest() methods), whose hex digests are 'hexlen' characters long.
+    """
+    digests[name] = (factory, hexlen)
+
+def digest_stream(f, names, bufsize = BUFSIZE):
+    """Compute the named digests of the contents of 'f' in a single pass.
+
+    Return a dict mapping each of the given digest names to its hex digest.
+    """
+    hashers = hash_stream(f, [digests[name][0]() for name in names], bufsize)
+    return dict((name, h.hexdigest()) for name, h in zip(names, hashers))
+
+class HashPipeline(object):
+    """Hash streams in worker threads while the caller reads them.
+
+    The caller reads each stream (e.g. while decompressing it) in its own
+    thread, and passes the chunks on to one of 'jobs' worker threads, which
+    feeds them to the hashers. Streams are assigned to workers round-robin.
+    Each worker has a queue of at most 'depth' chunks, which bounds the
+    memory in flight to about jobs * depth * bufsize bytes, and makes the
+    caller wait when the workers fall behind.
+    """
+
+    def __init__(self, jobs, depth = 16):
+        self.queues = [queue.Queue(depth) for i in range(jobs)]
+        self.threads = [threading.Thread(target = self.work, args = (q,))
+                        for q in self.queues]
+        self.next = 0
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, f, names, bufsize = BUFSIZE):
+        """Read all of 'f' and have the named digests computed in a worker.
+
+        Return a Future that resolves to the same dict as digest_stream().
+        """
+        from concurrent.futures import Future # python 2: futures backport
+        q = self.queues[self.next]
+        self.next = (self.next + 1) % len(self.queues)
+        future = Future()
+        hashers = [digests[name][0]() for name in names]
+        while True:
+            chunk = f.read(bufsize)
+            if not chunk:
+                break
+            q.put((hashers, chunk))
+        q.put((None, (future, names, hashers)))
+        return future
+
+    @staticmethod
+    def work(q):
+        while True:
+            hashers, chunk = q.get()
+            if hashers is not None:
+                for h in hashers:
+                    h.update(chunk)
+            elif chunk is None: # close()
+                return
+            else: # end of stream
+                future, names, hashers = chunk
+                future.set_result(dict(
+                    (name, h.hexdigest()) for name, h in zip(names, hashers)))
+
+    def close(self):
+        """Finish all pending work, and stop the worker threads."""
+        for q in self.queues:
+            q.put((None, None))
+        for t in self.threads:
+            t.join()
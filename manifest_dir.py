@@ -1,14 +1,97 @@
 import os
+import sys
 import stat
-import hashlib
+import functools
+import array
+import collections
+import multiprocessing
+try:
+    from os import scandir
+except ImportError: # python < 3.5 needs the scandir backport to walk dirs
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-from manifest_builder import ManifestBuilder
+import manifest
+from manifest_builder import ManifestBuilder, mtime_ns_from_stat
+from manifest_digest import BUFSIZE, digests, digest_stream
+from manifest_archive import ARCHIVE_MAX_SIZE, nested_archive, \
+    walk_archive
 
-def sha1_from_path_stat(path, statinfo):
-    if stat.S_ISREG(statinfo.st_mode):
-        with open(path, "rb") as f:
-            return hashlib.sha1(f.read()).hexdigest()
-    return None # we consider non-files to have no SHA1
+def same_version(statinfo, other):
+    """Return True if two stat() results show the same version of a file."""
+    return (statinfo.st_ino == other.st_ino
+            and statinfo.st_size == other.st_size
+            and mtime_ns_from_stat(statinfo) == mtime_ns_from_stat(other))
+
+def unchanged_since(attrs, statinfo):
+    """Return True if 'statinfo' matches the attrs recorded by a previous walk.
+
+    The previous walk must have recorded at least 'mtime_ns', and also 'size'
+    for regular files. 'mode' is compared if it was recorded.
+    """
+    size = statinfo.st_size if stat.S_ISREG(statinfo.st_mode) else None
+    return (attrs.get("mtime_ns") == mtime_ns_from_stat(statinfo)
+            and attrs.get("size") == size
+            and attrs.get("mode", statinfo.st_mode) == statinfo.st_mode)
+
+def encode_tree(m):
+    """Encode the entries below Manifest 'm' for transfer between processes.
+
+    Return a (keys, parents, names, values) tuple, where the entries are
+    listed in an order where parents precede their children. For the entry at
+    index i, names[i] is its name, parents[i] is the index of its parent (or -1
+    for children of 'm'), and values[i] is a tuple of its attribute values,
+    corresponding to the attribute names in 'keys' (None for missing values).
+    """
+    keys, key_index = [], {}
+    parents, names, values = array.array("l"), [], []
+    stack = [(m, -1)]
+    while stack:
+        node, parent_index = stack.pop()
+        for name, child in node.items():
+            attrs = child.getattrs()
+            for k in attrs:
+                if k not in key_index:
+                    key_index[k] = len(keys)
+                    keys.append(k)
+            stack.append((child, len(names)))
+            parents.append(parent_index)
+            names.append(name)
+            values.append(tuple(attrs.get(k) for k in keys))
+    return keys, parents, names, values
+
+def decode_tree(m, data):
+    """Add the entries encoded by encode_tree() into the Manifest 'm'."""
+    keys, parents, names, values = data
+    nodes = []
+    for parent_index, name, vals in zip(parents, names, values):
+        attrs = dict((k, v) for k, v in zip(keys, vals) if v is not None)
+        parent = nodes[parent_index] if parent_index >= 0 else m
+        nodes.append(parent.add([name], attrs))
+
+def build_shard(config, path, attrkeys, previous, path_filter):
+    """Build the subtree at 'path' in a worker process. See build()."""
+    manifest_class, bufsize, jobs, cache_args, archive_args = config
+    cache = None
+    if cache_args is not None:
+        from manifest_cache import HashCache
+        cache = HashCache(*cache_args)
+    walker = ManifestDirWalker(manifest_class, bufsize, jobs, cache,
+                               1, *archive_args)
+    prev = None
+    if previous is not None:
+        prev = manifest_class()
+        prev.setattrs(previous[0])
+        decode_tree(prev, previous[1])
+    try:
+        m = walker.build(path, attrkeys, prev, path_filter = path_filter)
+    finally:
+        if cache is not None:
+            cache.close()
+    hits = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    return encode_tree(m), walker.stats, hits
 
 class ManifestDirWalker(ManifestBuilder):
     """Walk a directory structure to generate a Manifest."""
@@ -19,25 +102,221 @@ class ManifestDirWalker(ManifestBuilder):
         "uid": lambda p, s: s.st_uid,
         "gid": lambda p, s: s.st_gid,
         "size": lambda p, s: s.st_size if stat.S_ISREG(s.st_mode) else None,
-        "sha1": sha1_from_path_stat,
+        "mtime_ns": lambda p, s: mtime_ns_from_stat(s),
     }
 
+    # Attributes found when build() is not given 'attrkeys'
+    default_attrs = ("mode", "uid", "gid", "size", "sha1")
+
+    # Attributes that require reading the file contents. All content digests
+    # of a file are computed from a single read of the file. Only regular
+    # files have content attributes.
+    content_attrs = digests
+
+    # Subdirectories at this depth are sharded out to worker processes
+    shard_depth = 1
+
+    def __init__(self, manifest_class = manifest.Manifest, bufsize = BUFSIZE,
+                 jobs = 1, cache = None, processes = 1, archive_depth = 0,
+                 archive_max_size = ARCHIVE_MAX_SIZE):
+        """Create a directory walker.
+
+        File contents are read 'bufsize' bytes at a time while hashing. If
+        'jobs' is greater than 1, file contents are hashed by a pool of that
+        many worker threads while the directory structure is being walked.
+        On python 2, that needs the futures backport, just as walking at all
+        needs the scandir backport.
+
+        If 'cache' is given (a manifest_cache.HashCache object), the content
+        attributes of files whose stat() signature is found in the cache are
+        taken from there instead of reading the file, and newly computed
+        content attributes are stored in the cache.
+
+        If 'processes' is greater than 1, the subdirectories found at
+        'shard_depth' are walked by a pool of that many worker processes,
+        each building (and hashing, with 'jobs' threads) its own part of the
+        Manifest. The parts are sent back in the compact form produced by
+        encode_tree() and grafted into the resulting Manifest. The workers
+        are spawned, not forked, which needs python >= 3.7.
+
+        If 'archive_depth' is positive, files that are archives (see
+        manifest_archive.archive_type()) are walked as if they were
+        directories, down to 'archive_depth' levels of nesting. Archives
+        larger than 'archive_max_size' bytes (None: no limit) are not walked
+        into. Archives nested within archives are read into memory, never
+        extracted to disk.
+        """
+        ManifestBuilder.__init__(self, manifest_class)
+        self.bufsize = bufsize
+        self.jobs = jobs
+        self.cache = cache
+        self.processes = processes
+        self.archive_depth = archive_depth
+        self.archive_max_size = archive_max_size
+
     def supported_attrs(self):
-        return self.attr_handlers.keys()
+        return list(self.attr_handlers.keys()) + list(self.content_attrs.keys())
 
-    def find_attrs(self, path, attrkeys):
+    def find_attrs(self, path, attrkeys, statinfo = None):
         if not attrkeys:
             return {}
 
         attrs = {}
-        statinfo = os.lstat(path)
+        if statinfo is None:
+            statinfo = os.lstat(path)
+        content = []
         for k in attrkeys:
+            if k in self.content_attrs:
+                content.append(k)
+                continue
             v = self.attr_handlers[k](path, statinfo)
             if v is not None:
                 attrs[k] = v
+        if content and stat.S_ISREG(statinfo.st_mode):
+            with open(path, "rb") as f:
+                attrs.update(digest_stream(f, content, self.bufsize))
+        return attrs
+
+    def find_lazy_attrs(self, path, attrkeys, statinfo):
+        """Find the content attributes of the file at 'path' on first access.
+
+        The file must still be the one found by the walk (as 'statinfo'), or
+        its attributes would not match the rest of the Manifest, so raise
+        ValueError if its inode, size or mtime has changed since.
+        """
+        if not same_version(os.lstat(path), statinfo):
+            raise ValueError("'%s' changed since it was walked" % (path))
+        attrs = self.find_attrs(path, attrkeys, statinfo)
+        if not same_version(os.lstat(path), statinfo):
+            raise ValueError("'%s' changed while it was read" % (path))
         return attrs
 
-    def build(self, path, attrkeys = None):
+    def cached_attrs(self, statinfo, attrkeys):
+        """Return (attrs, missing) for the given content attributes.
+
+        'attrs' holds the attributes found in the cache, and 'missing' lists
+        the attribute keys that must be found by reading the file.
+        """
+        if self.cache is None:
+            return {}, attrkeys
+        attrs, missing = {}, []
+        for k in attrkeys:
+            v = self.cache.get(statinfo, k)
+            if v is None:
+                missing.append(k)
+            else:
+                attrs[k] = v
+        return attrs, missing
+
+    def reused_attrs(self, prev, statinfo, attrkeys):
+        """Return (attrs, missing) for content attributes from a previous walk.
+
+        'prev' is the corresponding Manifest node from the previous walk (or
+        None). Its content attributes are reused if the stat() info of the file
+        is unchanged since then. Lazy attributes of 'prev' that were never
+        computed count as missing, so 'prev' is never made to read the file.
+        """
+        if prev is None:
+            return {}, attrkeys
+        prev_attrs = prev._raw_attrs()
+        if not unchanged_since(prev_attrs, statinfo):
+            return {}, attrkeys
+        attrs, missing = {}, []
+        for k in attrkeys:
+            v = prev_attrs.get(k)
+            if v is None or isinstance(v, manifest.LazyAttr):
+                missing.append(k)
+            else:
+                attrs[k] = v
+        return attrs, missing
+
+    def list_dir(self, path, statinfo, prev, need_stat, accept = None):
+        """Return (name, path, statinfo, is_dir) for each entry in 'path'.
+
+        If 'prev' (the Manifest node for this directory from a previous walk)
+        recorded the same mtime as the given 'statinfo', the directory contents
+        are unchanged, and the entry names are taken from 'prev' instead of
+        listing the directory. Otherwise, the directory is listed, and each
+        entry is stat()ed only if 'need_stat' is true. Return None if the
+        directory cannot be listed.
+
+        If given, 'accept' is called with (name, is_dir) for each entry, and
+        entries for which it returns false are skipped before being stat()ed
+        (where possible).
+        """
+        if prev is not None and statinfo is not None \
+                and unchanged_since(prev._raw_attrs(), statinfo):
+            try:
+                ret = []
+                for name in prev:
+                    p = os.path.join(path, name)
+                    s = os.lstat(p)
+                    is_dir = stat.S_ISDIR(s.st_mode)
+                    if accept is None or accept(name, is_dir):
+                        ret.append((name, p, s, is_dir))
+                self.stats["dirs_reused"] += 1
+                return ret
+            except OSError: # entry vanished after all; list the directory
+                pass
+        try:
+            entries = list(scandir(path))
+        except OSError: # like os.walk(), skip unreadable dirs
+            return None
+        self.stats["dirs_listed"] += 1
+        ret = []
+        for e in entries:
+            is_dir = e.is_dir(follow_symlinks = False)
+            if accept is not None and not accept(e.name, is_dir):
+                continue
+            s = e.stat(follow_symlinks = False) if need_stat else None
+            ret.append((e.name, e.path, s, is_dir))
+        return ret
+
+    @staticmethod
+    def accept_entry(path_filter, rel_dir, depth, name, is_dir):
+        return path_filter.accept(rel_dir + name, name, depth, is_dir)
+
+    def store_attrs(self, statinfo, attrs):
+        """Store freshly computed content attributes in the cache."""
+        if self.cache is not None:
+            for k, v in attrs.items():
+                self.cache.put(statinfo, k, v)
+
+    def find_content(self, path, statinfo, prev, attrkeys, lazy, pool):
+        """Find the content attributes of the regular file at 'path'.
+
+        Reuse attributes from 'prev' (see reused_attrs()) or the cache when
+        possible. Return (attrs, future), where 'future' is not None if the
+        remaining attributes were sent to the given worker 'pool'.
+        """
+        attrs, missing = self.reused_attrs(prev, statinfo, attrkeys)
+        if attrs:
+            self.stats["files_reused"] += 1
+        cached, missing = self.cached_attrs(statinfo, missing)
+        attrs.update(cached)
+        if not missing:
+            return attrs, None
+        if lazy:
+            attrs.update(manifest.lazy_attrs(functools.partial(
+                self.find_lazy_attrs, path, missing, statinfo), missing))
+            return attrs, None
+        self.stats["files_hashed"] += 1
+        if pool is not None:
+            return attrs, pool.submit(self.find_attrs, path, missing, statinfo)
+        found = self.find_attrs(path, missing, statinfo)
+        self.store_attrs(statinfo, found)
+        attrs.update(found)
+        return attrs, None
+
+    def finish_attrs(self, node, future, statinfo):
+        """Merge the result of a pooled find_attrs() call into 'node', and
+        store it in the cache."""
+        found = ManifestBuilder.finish_attrs(self, node, future)
+        self.store_attrs(statinfo, found)
+        return found
+
+    def build(self, path, attrkeys = None, previous = None, lazy = False,
+              hardlinks = False, path_filter = None):
         """Generate a Manifest from the directory structure rooted at 'path'.
 
         Recursively walk the directory structure under 'path' and generate a
@@ -46,24 +325,174 @@ class ManifestDirWalker(ManifestBuilder):
 
         The optional 'attrkeys' specifies a set of known attributes to be
         populated in the generated manifest. This set must be a subset of
-        supported_attrs().
+        supported_attrs(). It defaults to default_attrs.
+
+        When hashing in a worker pool (jobs > 1), the stat()-based attributes
+        are still found during the walk, while the content attributes are
+        filled in as their hash jobs complete. The resulting Manifest is
+        identical to the one built without a worker pool.
+
+        The optional 'previous' is a Manifest from an earlier walk of the same
+        directory structure, which recorded (at least) the 'size', 'mode' and
+        'mtime_ns' attributes, e.g. as re-read by ManifestFileParser. Content
+        attributes are reused from 'previous' for files whose stat() info is
+        unchanged, and directories whose mtime is unchanged are not listed.
+        The result is otherwise identical to a build without 'previous'.
+        'previous' must have been built with the same 'path_filter'.
+
+        If 'lazy' is true, content attributes that are not reused from
+        'previous' or the cache are stored as LazyAttrs, and the files are only
+        read when those attributes are first accessed. Accessing them raises
+        ValueError if the file has changed since the walk (see
+        find_lazy_attrs()). Lazily computed attributes are not stored in the
+        cache.
+
+        The optional 'path_filter' (a PathFilter object) selects the entries to
+        include. Excluded entries are skipped before they are stat()ed, and
+        excluded directories are never listed.
+
+        Files with multiple hard links are only read once: all paths sharing
+        the same (st_dev, st_ino) share the content attributes found for the
+        first of them. If 'hardlinks' is true, the hard link grouping is also
+        recorded: every path but the first (in sorted order) of each group of
+        hard-linked paths is given a 'hardlink' attribute naming that first
+        path (relative to 'path').
+
+        Lazy attributes and hard link recording cannot be combined with
+        worker processes, and hard links are only detected within the part of
+        the tree walked by each process.
+
+        After each build, the 'stats' member records how many directories were
+        listed vs. reused from 'previous', and how many files were hashed vs.
+        had their content attributes reused from 'previous' or from another
+        hard link to the same file.
         """
         if attrkeys is not None:
             for k in attrkeys:
-                assert k in self.attr_handlers
+                assert k in self.attr_handlers or k in self.content_attrs
         else:
-            attrkeys = self.supported_attrs()
+            attrkeys = self.default_attrs
 
         if not os.path.isdir(path):
             raise ValueError("'%s' is not a directory" % (path))
+        if self.processes > 1 and (lazy or hardlinks):
+            raise ValueError("Cannot use lazy or hardlinks with processes")
+        if self.processes > 1 and sys.version_info < (3, 7):
+            raise ValueError("Worker processes need python >= 3.7")
+        if scandir is None:
+            raise ImportError("Walking directories on python < 3.5 needs the "
+                              "scandir backport")
+
+        self.stats = dict.fromkeys(["dirs_listed", "dirs_reused",
+            "files_hashed", "files_reused", "files_linked"], 0)
+        content = [k for k in attrkeys if k in self.content_attrs]
+        inline = [k for k in attrkeys if k not in self.content_attrs]
+        need_stat = bool(attrkeys) or previous is not None or hardlinks \
+            or self.archive_depth > 0
+        links = {} # (st_dev, st_ino) -> (attrs, future) for hard linked files
+        groups = {} # (st_dev, st_ino) -> [(rel_path, node), ...]
+        pool = None
+        if self.jobs > 1 and content and not lazy:
+            # python 2 needs the futures backport
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(self.jobs)
+        pending = collections.deque()
+        max_pending = self.jobs * self.pending_per_job
+        procs = None
+        if self.processes > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            # Don't fork() the thread pool or cache connection into workers
+            procs = ProcessPoolExecutor(self.processes,
+                mp_context = multiprocessing.get_context("spawn"))
+            cache_args = None
+            if self.cache is not None:
+                self.cache.flush()
+                cache_args = (self.cache.path, self.cache.generation)
+            config = (self.manifest_class, self.bufsize, self.jobs, cache_args,
+                      (self.archive_depth, self.archive_max_size))
+        shards = [] # (node, future) for subtrees built by worker processes
 
+        # Entries are stat()ed only when there are attributes to find (or to
+        # compare against 'previous'). Otherwise the entry type (needed for
+        # recursing into subdirs) comes for free from scandir().
         top = self.manifest_class()
-        top_path = path.rstrip(os.sep)
-        for dirpath, dirnames, filenames in os.walk(path):
-            assert dirpath.startswith(top_path)
-            rel_path = dirpath[len(top_path):].lstrip(os.sep)
-            components = rel_path.split(os.sep) if rel_path else []
-            for name in filenames + dirnames:
-                attrs = self.find_attrs(os.path.join(dirpath, name), attrkeys)
-                top.add(components + [name], attrs)
+        top_stat = os.stat(path) if previous is not None else None
+        dirs = [(path, "", 0, top, previous, top_stat)]
+        try:
+            while dirs:
+                dirpath, rel_dir, depth, parent, prev, dirstat = dirs.pop()
+                accept = None
+                if path_filter is not None:
+                    accept = functools.partial(
+                        self.accept_entry, path_filter, rel_dir, depth + 1)
+                entries = self.list_dir(
+                    dirpath, dirstat, prev, need_stat, accept)
+                if entries is None:
+                    continue
+                for name, fullpath, statinfo, is_dir in entries:
+                    prev_child = prev.get(name) if prev is not None else None
+                    attrs = self.find_attrs(fullpath, inline, statinfo)
+                    future = None
+                    link = None
+                    if need_stat and statinfo.st_nlink > 1 and not is_dir:
+                        link = (statinfo.st_dev, statinfo.st_ino)
+                    if content and stat.S_ISREG(statinfo.st_mode):
+                        if link in links:
+                            found, future = links[link]
+                            self.stats["files_linked"] += 1
+                        else:
+                            found, future = self.find_content(fullpath,
+                                statinfo, prev_child, content, lazy, pool)
+                            if link is not None:
+                                links[link] = (found, future)
+                        attrs.update(found)
+                    node = parent.add([name], attrs)
+                    if hardlinks and link is not None:
+                        groups.setdefault(link, []).append(
+                            (rel_dir + name, node))
+                    if future is not None:
+                        pending.append((node, future, statinfo))
+                        self.finish_pending(pending, max_pending)
+                    if need_stat and stat.S_ISREG(statinfo.st_mode):
+                        kind = nested_archive(self, name, statinfo.st_size)
+                        if kind is not None:
+                            walk_archive(self, node, kind, fullpath, attrkeys)
+                    if is_dir and path_filter is not None \
+                            and not path_filter.descend(depth + 1):
+                        continue
+                    if is_dir and procs is not None \
+                            and depth + 1 >= self.shard_depth:
+                        prev_data = sub_filter = None
+                        if prev_child is not None:
+                            prev_data = (prev_child.getattrs(),
+                                         encode_tree(prev_child))
+                        if path_filter is not None:
+                            sub_filter = path_filter.subtree(
+                                rel_dir + name, depth + 1)
+                        shards.append((node, procs.submit(build_shard, config,
+                            fullpath, attrkeys, prev_data, sub_filter)))
+                    elif is_dir:
+                        dirs.append((fullpath, rel_dir + name + "/",
+                                     depth + 1, node, prev_child, statinfo))
+            self.finish_pending(pending)
+            if self.cache is not None: # release the lock for the workers
+                self.cache.flush()
+            for node, future in shards:
+                data, stats, (hits, misses) = future.result()
+                decode_tree(node, data)
+                for k, v in stats.items():
+                    self.stats[k] += v
+                if self.cache is not None:
+                    self.cache.hits += hits
+                    self.cache.misses += misses
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if procs is not None:
+                procs.shutdown()
+
+        for group in groups.values():
+            group.sort(key = lambda t: t[0])
+            for rel_path, node in group[1:]:
+                node.setattr("hardlink", group[0][0])
         return top
@@ -2,6 +2,10 @@ from __future__ import print_function
 import re
 
 from manifest_builder import ManifestBuilder
+from manifest_digest import digests
+
+# Pseudo-attribute holding the Manifest.digest() of a directory entry
+TREE_DIGEST_ATTR = "tree_sha1"
 
 def parse_uint(s):
     ret = int(s, base=0)
@@ -9,12 +13,21 @@ def parse_uint(s):
         raise ValueError("Negative integer not allowed here: '%s'" % (s))
     return ret
 
+def parse_int(s):
+    return int(s, base=0)
+
 def parse_sha1sum(s, _sha1RE = re.compile(r'^[0-9a-f]{40}$')):
     sha1 = s.strip().lower()
     if not _sha1RE.match(sha1):
         raise ValueError("Not a valid SHA1 sum: '%s'" % (s))
     return sha1
 
+def parse_hexdigest(s, length, _hexRE = re.compile(r'^[0-9a-f]+$')):
+    digest = s.strip().lower()
+    if len(digest) != length or not _hexRE.match(digest):
+        raise ValueError("Not a valid %d-digit hex digest: '%s'" % (length, s))
+    return digest
+
 class ManifestFileParser(ManifestBuilder):
     """Parse a text file containing a manifest description.
 
@@ -33,6 +46,8 @@ class ManifestFileParser(ManifestBuilder):
      - Typical line format:
           entry name { attr1: value1, attr2: value2 } # comment
      - Whitespace is stripped from the start and end of all tokens
+     - The 'tree_sha1' attribute is not an attribute of the entry, but the
+       digest() of its children, as written by ManifestFileWriter
     """
 
     attr_handlers = {
@@ -41,16 +56,28 @@ class ManifestFileParser(ManifestBuilder):
         "uid": parse_uint,
         "gid": parse_uint,
         "size": parse_uint,
+        "mtime_ns": parse_int,
+        "compressed_size": parse_uint,
         "sha1": parse_sha1sum,
+        TREE_DIGEST_ATTR: parse_sha1sum,
     }
 
     def supported_attrs(self):
-        return self.attr_handlers.keys()
+        return list(self.attr_handlers.keys()) + [
+            k for k in digests.keys() if k not in self.attr_handlers]
 
     def parse_attr(self, key_s, value_s):
-        """Canonicalize the given attribute key and value strings."""
+        """Canonicalize the given attribute key and value strings.
+
+        Content digests from the manifest_digest registry that have no entry
+        in attr_handlers are parsed as hex digests of the registered length.
+        """
         key = key_s.strip().lower()
-        return (key, self.attr_handlers.get(key, str)(value_s.strip()))
+        value_s = value_s.strip()
+        handler = self.attr_handlers.get(key)
+        if handler is None and key in digests:
+            return (key, parse_hexdigest(value_s, digests[key][1]))
+        return (key, (handler or str)(value_s))
 
     def parse_token(self, token):
         """Parse the given token into a (entry, attrs) tuple.
@@ -112,6 +139,7 @@ class ManifestFileParser(ManifestBuilder):
         """
         prev = cur = top = self.manifest_class()
         level = 0
+        tree_digests = [] # (node, digest) in the order they were parsed
         for indent, token, attrs in self.parse_lines(f):
             if indent > level: # drill into the previous entry
                 cur = prev
@@ -124,7 +152,16 @@ class ManifestFileParser(ManifestBuilder):
                     level -= 1
                 assert indent == level
 
+            tree_digest = attrs.pop(TREE_DIGEST_ATTR, None)
             prev = cur.add([token], attrs)
+            if tree_digest is not None:
+                tree_digests.append((prev, tree_digest))
+
+        # restore digests bottom-up, once all children have been added
+        for node, tree_digest in reversed(tree_digests):
+            node.restore_digest(tree_digest)
+        if tree_digests:
+            top.restore_digest()
         return top
 
 class ManifestFileWriter(object):
@@ -149,17 +186,27 @@ class ManifestFileWriter(object):
             l.append("%s: %s" % (k, self.formatter.get(k, str)(v)))
         return " {%s}" % (", ".join(l))
 
-    def write(self, m, f, level = 0, indent = "\t", attrkeys = None):
+    def write(self, m, f, level = 0, indent = "\t", attrkeys = None,
+              tree_digests = False):
         """Write the given Manifest in a ManifestFileParser-compatible format.
 
         The given Manifest 'm' is written to the given file object 'f' in a text
         format that can be re-read with ManifestFileParser.
 
         'attrkeys' is the set of attributes to be output, defaults to all.
+
+        If 'tree_digests' is true, the digest() of each entry with children is
+        written as its 'tree_sha1' attribute, so that the parsed Manifest can
+        be diffed without walking into unchanged directories. As the digests
+        cover all attributes, this cannot be combined with 'attrkeys'.
         """
+        if tree_digests and attrkeys is not None:
+            raise ValueError("Cannot write tree digests of selected attrs")
         for name, child in sorted(m.items()):
             attrs = child.getattrs()
             if attrkeys is not None:
                 attrs = dict((k, v) for k, v in attrs.items() if k in attrkeys)
+            if tree_digests and child:
+                attrs[TREE_DIGEST_ATTR] = child.digest()
             print(indent * level + name + self.format_attrs(attrs), file=f)
-            self.write(child, f, level + 1, indent, attrkeys)
+            self.write(child, f, level + 1, indent, attrkeys, tree_digests)
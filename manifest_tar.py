@@ -1,8 +1,15 @@
+import io
 import tarfile
 import stat
-import hashlib
+import functools
+import collections
 
+import manifest
 from manifest_builder import ManifestBuilder
+from manifest_digest import BUFSIZE, digests, digest_stream, HashPipeline
+from manifest_tarindex import TarIndex
+from manifest_archive import ARCHIVE_MAX_SIZE, nested_archive, \
+    walk_archive
 
 def mode_from_tarinfo(tf, ti):
     ret = ti.mode
@@ -22,11 +29,6 @@ def mode_from_tarinfo(tf, ti):
         raise ValueError("Cannot deduce mode from %s/%s" % (tf, ti))
     return ret
 
-def sha1_from_tarinfo(tf, ti):
-    if ti.isfile():
-        return hashlib.sha1(tf.extractfile(ti).read()).hexdigest()
-    return None
-
 class ManifestTarWalker(ManifestBuilder):
     """Walk the contents of a tar file to generate a Manifest."""
 
@@ -36,46 +38,280 @@ class ManifestTarWalker(ManifestBuilder):
         "uid": lambda tf, ti: ti.uid,
         "gid": lambda tf, ti: ti.gid,
         "size": lambda tf, ti: ti.size if ti.isfile() else None,
-        "sha1": sha1_from_tarinfo,
     }
 
+    # Attributes found when build() is not given 'attrkeys'
+    default_attrs = ("mode", "uid", "gid", "size", "sha1")
+
+    # Attributes that require reading the member contents. All content
+    # digests of a member are computed from a single read of the member.
+    content_attrs = digests
+
+    def __init__(self, manifest_class = manifest.Manifest, bufsize = BUFSIZE,
+                 jobs = 1, archive_depth = 0,
+                 archive_max_size = ARCHIVE_MAX_SIZE):
+        """Create a tar walker.
+
+        Member contents are streamed through the hashers 'bufsize' bytes at a
+        time, so memory usage does not depend on the size of the members.
+
+        If 'jobs' is greater than 1, build() runs as a pipeline: the calling
+        thread decompresses the archive and parses its members, while a
+        HashPipeline of 'jobs' worker threads hashes the member contents. On
+        python 2, that needs the futures backport.
+
+        If 'archive_depth' is positive, members that are themselves archives
+        (see manifest_archive.archive_type()) are walked as if they were
+        directories, down to 'archive_depth' levels of nesting. Such members
+        are read into memory (so members larger than 'archive_max_size' bytes
+        are not walked into; None means no limit), and the Manifest of their
+        contents is grafted below their own entry.
+        """
+        ManifestBuilder.__init__(self, manifest_class)
+        self.bufsize = bufsize
+        self.jobs = jobs
+        self.archive_depth = archive_depth
+        self.archive_max_size = archive_max_size
+
     def supported_attrs(self):
-        return self.attr_handlers.keys()
+        return list(self.attr_handlers.keys()) + list(self.content_attrs.keys())
 
     def find_attrs(self, tf, ti, attrkeys):
         if not attrkeys:
             return {}
 
         attrs = {}
+        content = []
         for k in attrkeys:
+            if k in self.content_attrs:
+                content.append(k)
+                continue
             v = self.attr_handlers[k](tf, ti)
             if v is not None:
                 attrs[k] = v
+        if content and ti.isfile():
+            attrs.update(digest_stream(
+                tf.extractfile(ti), content, self.bufsize))
         return attrs
 
-    def build(self, tarpath, subdir = "./", attrkeys = None):
+    @staticmethod
+    def member_path(name, subdir):
+        """Return the path of member 'name' relative to 'subdir', or None.
+
+        If 'subdir' is None, all members are included, with any leading "./"
+        stripped from their names.
+        """
+        if subdir is None:
+            if name.startswith("./"):
+                name = name[len("./"):]
+            return name if name not in ("", ".") else None
+        if not name.startswith(subdir):
+            return None
+        return name[len(subdir):]
+
+    @staticmethod
+    def skip_member(rel_path, isdir, path_filter, pruned):
+        """Return True if 'path_filter' excludes the member at 'rel_path'.
+
+        Excluded directories are added to 'pruned', so that the members below
+        them are excluded too.
+        """
+        if path_filter is None:
+            return False
+        parent, _, name = rel_path.rpartition("/")
+        depth = rel_path.count("/") + 1
+        if parent in pruned or not path_filter.accept(
+                rel_path, name, depth, isdir):
+            if isdir:
+                pruned.add(rel_path)
+            return True
+        return False
+
+    def build_from_index(self, tarpath, tar_index, subdir, attrkeys, content,
+                         path_filter):
+        """Generate a Manifest from the entries of a valid TarIndex.
+
+        Digests missing from the index are computed by seeking straight to
+        the member data in the archive, as are nested archives (which are not
+        stored in the index). If the archive is compressed, this is not
+        possible, and None is returned instead.
+        """
+        top = self.manifest_class()
+        inserter = manifest.ManifestInserter(top)
+        pruned = set()
+        tf = None
+        try:
+            for entry in tar_index.members:
+                ti = tar_index.tarinfo(entry)
+                rel_path = self.member_path(ti.name, subdir)
+                if rel_path is None or self.skip_member(
+                        rel_path, ti.isdir(), path_filter, pruned):
+                    continue
+                attrs = self.find_attrs(None, ti, attrkeys)
+                missing, kind, data = [], None, None
+                if ti.isfile():
+                    missing = [k for k in content if k not in entry["digests"]]
+                    kind = nested_archive(self, ti.name, ti.size)
+                if missing or kind is not None:
+                    if tar_index.compressed:
+                        return None
+                    if tf is None:
+                        tf = tarfile.open(tarpath, mode="r:", errorlevel=1)
+                    tf.fileobj.seek(ti.offset)
+                    member = tarfile.TarInfo.fromtarfile(tf)
+                    if missing:
+                        tar_index.set_digests(
+                            entry, self.find_attrs(tf, member, missing))
+                    if kind is not None:
+                        data = io.BytesIO(tf.extractfile(member).read())
+                if content and ti.isfile():
+                    attrs.update((k, entry["digests"][k]) for k in content)
+                node = inserter.add(rel_path, attrs)
+                if data is not None:
+                    walk_archive(self, node, kind, data, attrkeys + content)
+        finally:
+            if tf is not None:
+                tf.close()
+        return top
+
+    def build(self, tarpath, subdir = "./", attrkeys = None, lazy = False,
+              path_filter = None, stream = None, index = None):
         """Generate a Manifest from the given tar file.
 
         The given 'tarpath' filename is processed (using python's built-in
         tarfile module), and a new manifest is built (and returned) based on
-        the contents of the tar archive.
+        the contents of the tar archive. 'tarpath' may also be a file object
+        opened for reading in binary mode. If 'subdir' is None, all members
+        are included, whether or not their names start with "./".
+
+        If 'stream' is true, the archive (possibly compressed) is read in a
+        single forward pass without seeking, and each member is hashed as it
+        is passed. This works on pipes and sockets, e.g. sys.stdin.buffer.
+        By default, streaming is used for non-seekable file objects only.
+
+        If 'lazy' is true, content attributes are stored as LazyAttrs, and the
+        members are only read when those attributes are first accessed. In
+        that case, the tar file is kept open until this walker is close()d
+        (e.g. by using it as a context manager).
+
+        The optional 'path_filter' (a PathFilter object) selects the members
+        to include, based on their path relative to 'subdir'. Excluded members
+        (and all members below excluded directories) are skipped before their
+        attributes are found, so they are never read or hashed.
+
+        If 'index' is given, it names a sidecar index file (see TarIndex) that
+        is used to speed up repeated scans of the same 'tarpath' (which must
+        be a filename). While the archive is unchanged, the Manifest is built
+        from the index alone. Once the archive has changed, it is scanned and
+        all its members are rehashed (as equal headers do not imply equal
+        contents), and the index is rewritten.
+
+        The index holds no entries of nested archives (see 'archive_depth'),
+        so these are read again from the archive. For a compressed archive,
+        that takes a full scan, so with a positive 'archive_depth' only the
+        stored digests of its members are reused.
         """
         # In python2.6, TarFile objects are not context managers, so we cannot
         # do "with tarfile.open(...) as tf:". Also, in python2.6 a TarFile's
         # .errorlevel defaults to 0, whereas later versions default to 1.
         if attrkeys is not None:
             for k in attrkeys:
-                assert k in self.attr_handlers
+                assert k in self.attr_handlers or k in self.content_attrs
         else:
-            attrkeys = self.supported_attrs()
+            attrkeys = self.default_attrs
+
+        is_fileobj = hasattr(tarpath, "read")
+        if stream is None:
+            stream = is_fileobj and not (
+                hasattr(tarpath, "seekable") and tarpath.seekable())
+        if stream and lazy:
+            raise ValueError("Cannot combine lazy attributes with streaming")
+        if index is not None and (is_fileobj or lazy):
+            raise ValueError("An index needs a tar filename and no lazy attrs")
+
+        all_attrkeys = list(attrkeys)
+        content = []
+        if lazy or self.jobs > 1 or index is not None or self.archive_depth:
+            content = [k for k in attrkeys if k in self.content_attrs]
+            attrkeys = [k for k in attrkeys if k not in self.content_attrs]
+
+        tar_index = None
+        if index is not None:
+            tar_index = TarIndex(index, tarpath)
+            if tar_index.valid and tar_index.compressed and self.archive_depth:
+                tar_index.rescan() # nested archives need a full scan anyway
+            if tar_index.valid:
+                top = self.build_from_index(tarpath, tar_index, subdir,
+                                            attrkeys, content, path_filter)
+                if top is not None:
+                    tar_index.save()
+                    return top
+                tar_index.rescan()
 
-        tf = tarfile.open(tarpath, errorlevel=1)
+        pipeline = None
+        if content and not lazy and self.jobs > 1:
+            pipeline = HashPipeline(self.jobs)
+        pending = collections.deque() # (node, future) being hashed
+
+        mode = "r|*" if stream else "r:*"
+        if is_fileobj:
+            tf = tarfile.open(fileobj=tarpath, mode=mode, errorlevel=1)
+        else:
+            tf = tarfile.open(tarpath, mode=mode, errorlevel=1)
         top = self.manifest_class()
-        for ti in tf:
-            if not ti.name.startswith(subdir):
-                continue
-            attrs = self.find_attrs(tf, ti, attrkeys)
-            rel_path = ti.name[len(subdir):]
-            top.add(rel_path.split('/'), attrs)
-        tf.close()
+        inserter = manifest.ManifestInserter(top)
+        pruned = set() # directories excluded by path_filter
+        keep_open = False # lazy attributes refer to tf
+        try:
+            for ti in tf:
+                if tar_index is not None:
+                    pos = tar_index.add(ti)
+                rel_path = self.member_path(ti.name, subdir)
+                if rel_path is None or self.skip_member(
+                        rel_path, ti.isdir(), path_filter, pruned):
+                    continue
+                attrs = self.find_attrs(tf, ti, attrkeys)
+                kind, data = None, None
+                if ti.isfile():
+                    kind = nested_archive(self, ti.name, ti.size)
+                if kind is not None: # hash and walk it from memory
+                    data = io.BytesIO(tf.extractfile(ti).read())
+                hashed = content and ti.isfile()
+                if hashed and tar_index is not None:
+                    reused = tar_index.digests(pos, content)
+                    if reused is not None:
+                        attrs.update(reused)
+                        hashed = False
+                if hashed and data is not None:
+                    attrs.update(digest_stream(data, content, self.bufsize))
+                    data.seek(0)
+                    hashed = False
+                elif hashed and lazy:
+                    attrs.update(manifest.lazy_attrs(functools.partial(
+                        self.find_attrs, tf, ti, content), content))
+                    hashed = False
+                    keep_open = True
+                if hashed and pipeline is None:
+                    attrs.update(self.find_attrs(tf, ti, content))
+                node = inserter.add(rel_path, attrs)
+                if hashed and pipeline is not None:
+                    pending.append((node, pipeline.submit(
+                        tf.extractfile(ti), content, self.bufsize)))
+                    while pending and pending[0][1].done():
+                        self.finish_attrs(*pending.popleft())
+                if tar_index is not None and content and ti.isfile():
+                    tar_index.set_node(pos, node, content)
+                if data is not None:
+                    walk_archive(self, node, kind, data, all_attrkeys)
+            self.finish_pending(pending)
+            if keep_open:
+                self.lazy_sources.append(tf)
+                tf = None
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            if tf is not None:
+                tf.close()
+        if tar_index is not None:
+            tar_index.save()
         return top
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import tarfile
+
+from manifest_builder import mtime_ns_from_stat
+
+# Magic numbers at the start of the compressed formats tarfile can read
+COMPRESSION_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+
+def archive_key(tarpath):
+    """Return the (key dict, compressed flag) identifying a tar archive.
+
+    The key holds the archive's size and mtime_ns, and the SHA1 of its first
+    record (which holds the header of the first member of an uncompressed
+    archive).
+    """
+    st = os.stat(tarpath)
+    with open(tarpath, "rb") as f:
+        head = f.read(512)
+    key = {
+        "size": st.st_size,
+        "mtime_ns": mtime_ns_from_stat(st),
+        "head": hashlib.sha1(head).hexdigest(),
+    }
+    return key, head.startswith(COMPRESSION_MAGIC)
+
+# TarInfo members stored for each archive member
+TARINFO_FIELDS = ("name", "type", "mode", "uid", "gid", "size", "mtime",
+                  "chksum", "linkname", "offset", "offset_data")
+
+class TarIndex(object):
+    """Sidecar index of the members of a tar archive.
+
+    The index is stored as JSON at 'path'. It records the header fields
+    (including the header and data offsets) of every member of the archive at
+    'tarpath', together with the content digests computed for its regular
+    files, and it is keyed on the size, mtime and first record of the
+    archive.
+
+    If the key of the stored index matches the archive, 'valid' is true, and
+    'members' holds the stored entries in archive order. Otherwise, 'members'
+    starts out empty, and none of the stored digests are used, as members
+    with unchanged headers may still have changed contents (e.g. in
+    reproducible builds that clamp mtimes). After rescan() of a valid index,
+    digests() returns the stored digests of the (unchanged) archive.
+    """
+
+    version = 1
+
+    def __init__(self, path, tarpath):
+        self.path = path
+        self.key, self.compressed = archive_key(tarpath)
+        self.valid = False
+        self.dirty = True
+        self.members = []
+        self.previous = [] # stored entries of the unchanged archive
+        self.nodes = {} # index in 'members' -> node holding new digests
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get("version") != self.version:
+            return
+        if data["archive"] == self.key:
+            self.valid = True
+            self.dirty = False
+            self.members = data["members"]
+
+    @staticmethod
+    def tarinfo(entry):
+        """Return a TarInfo object with the header fields of 'entry'."""
+        ti = tarfile.TarInfo()
+        for k in TARINFO_FIELDS:
+            setattr(ti, k, entry[k])
+        ti.type = ti.type.encode("latin-1")
+        return ti
+
+    def rescan(self):
+        """Start over with no entries, to rescan the archive with add().
+
+        If the index was valid, the archive is unchanged, so the stored
+        digests of its members remain available through digests().
+        """
+        if self.valid:
+            self.previous = self.members
+        self.valid = False
+        self.dirty = True
+        self.members = []
+
+    def add(self, ti):
+        """Record tarinfo 'ti' (without digests) while rescanning.
+
+        Return the position of the new entry, for use with set_node().
+        """
+        entry = dict((k, getattr(ti, k)) for k in TARINFO_FIELDS)
+        entry["type"] = ti.type.decode("latin-1")
+        entry["digests"] = self.stored_digests(len(self.members))
+        self.members.append(entry)
+        self.dirty = True
+        return len(self.members) - 1
+
+    def stored_digests(self, pos):
+        if pos < len(self.previous):
+            return dict(self.previous[pos]["digests"])
+        return {}
+
+    def digests(self, pos, names):
+        """Return the stored 'names' digests of entry 'pos', or None."""
+        digests = self.stored_digests(pos)
+        if not all(k in digests for k in names):
+            return None
+        return dict((k, digests[k]) for k in names)
+
+    def set_node(self, pos, node, names):
+        """Take the 'names' digests of entry 'pos' from 'node' on save()."""
+        self.nodes[pos] = (node, names)
+
+    def set_digests(self, entry, digests):
+        """Update the stored digests of 'entry', one of 'members'."""
+        entry["digests"].update(digests)
+        self.dirty = True
+
+    def save(self):
+        """Write the index to disk, if it has changed."""
+        for pos, (node, names) in self.nodes.items():
+            attrs = node.getattrs()
+            self.members[pos]["digests"].update(
+                (k, attrs[k]) for k in names if k in attrs)
+        self.nodes = {}
+        if self.previous and self.members == self.previous:
+            self.dirty = False # rescanned, but unchanged
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "version": self.version,
+                "archive": self.key,
+                "members": self.members,
+            }, f, separators = (",", ":"))
+        os.rename(tmp, self.path)
+        self.dirty = False
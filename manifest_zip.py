@@ -0,0 +1,239 @@
+import io
+import stat
+import zipfile
+import functools
+import collections
+
+import manifest
+from manifest_builder import ManifestBuilder
+from manifest_digest import BUFSIZE, digests, digest_stream
+from manifest_archive import ARCHIVE_MAX_SIZE, nested_archive, \
+    walk_archive
+
+def is_dir_from_zipinfo(zi):
+    return zi.filename.endswith("/")
+
+def mode_from_zipinfo(zf, zi):
+    """Return the unix mode of 'zi', or None if the zip file has none."""
+    mode = zi.external_attr >> 16
+    if zi.create_system == 3 and stat.S_IFMT(mode): # created on unix
+        return mode
+    return None
+
+class ManifestZipWalker(ManifestBuilder):
+    """Walk the contents of a zip file to generate a Manifest.
+
+    Apart from content digests, all attributes are taken from the zip file's
+    central directory, so building a Manifest does not decompress anything
+    unless a content digest (e.g. 'sha1') is requested. In particular, the
+    'crc32' attribute is the CRC-32 that the zip file stores for each member,
+    which equals the 'crc32' content digest found by the other builders. The
+    'mode' attribute is only found for members that carry unix mode bits
+    (i.e. that were added on unix).
+    """
+
+    attr_handlers = {
+        # name: handler (zipfile, zipinfo -> parsed value)
+        "mode": mode_from_zipinfo,
+        "size": lambda zf, zi: (
+            None if is_dir_from_zipinfo(zi) else zi.file_size),
+        "compressed_size": lambda zf, zi: (
+            None if is_dir_from_zipinfo(zi) else zi.compress_size),
+        "crc32": lambda zf, zi: (
+            None if is_dir_from_zipinfo(zi) else "%08x" % (zi.CRC)),
+    }
+
+    # Attributes found when build() is not given 'attrkeys'
+    default_attrs = ("mode", "size", "crc32")
+
+    # Attributes that require decompressing the member contents, unless they
+    # are also in attr_handlers. All content digests of a member are computed
+    # from a single read of the member.
+    content_attrs = digests
+
+    def __init__(self, manifest_class = manifest.Manifest, bufsize = BUFSIZE,
+                 jobs = 1, archive_depth = 0,
+                 archive_max_size = ARCHIVE_MAX_SIZE):
+        """Create a zip walker.
+
+        Member contents are decompressed and hashed 'bufsize' bytes at a time.
+        If 'jobs' is greater than 1, members are decompressed and hashed by a
+        pool of that many worker threads (which needs the futures backport on
+        python 2).
+
+        'archive_depth' and 'archive_max_size' control walking into members
+        that are themselves archives, as in ManifestTarWalker.
+        """
+        ManifestBuilder.__init__(self, manifest_class)
+        self.bufsize = bufsize
+        self.jobs = jobs
+        self.archive_depth = archive_depth
+        self.archive_max_size = archive_max_size
+
+    def supported_attrs(self):
+        return list(self.attr_handlers.keys()) + [
+            k for k in self.content_attrs if k not in self.attr_handlers]
+
+    def find_attrs(self, zf, zi, attrkeys):
+        if not attrkeys:
+            return {}
+
+        attrs = {}
+        content = []
+        for k in attrkeys:
+            if k not in self.attr_handlers:
+                content.append(k)
+                continue
+            v = self.attr_handlers[k](zf, zi)
+            if v is not None:
+                attrs[k] = v
+        if content and not is_dir_from_zipinfo(zi):
+            f = zf.open(zi)
+            try:
+                attrs.update(digest_stream(f, content, self.bufsize))
+            finally:
+                f.close()
+        return attrs
+
+    def find_parent(self, top, nodes, implied, parts, path_filter, pruned):
+        """Return the node for the parent directory of 'parts', or None.
+
+        Zip files need not contain entries for all directories, so missing
+        parent directories are added (without attributes) as needed, and
+        recorded in 'nodes' (rel_path -> node) and 'implied' (rel_paths). None
+        is returned if the parent directory is excluded by 'path_filter'.
+
+        Raise ValueError if a parent directory is already a file.
+        """
+        parent = top
+        for depth in range(1, len(parts)):
+            rel_path = "/".join(parts[:depth])
+            if rel_path in pruned:
+                return None
+            node = nodes.get(rel_path)
+            if node is None:
+                if parent.get(parts[depth - 1]) is not None:
+                    raise ValueError("Zip member %s is both a file and a "
+                                     "directory" % (rel_path))
+                if path_filter is not None and not path_filter.accept(
+                        rel_path, parts[depth - 1], depth, True):
+                    pruned.add(rel_path)
+                    return None
+                node = parent.add([parts[depth - 1]])
+                nodes[rel_path] = node
+                implied.add(rel_path)
+                if path_filter is not None and not path_filter.descend(depth):
+                    pruned.add(rel_path)
+                    return None
+            parent = node
+        return parent
+
+    def build(self, zippath, subdir = "", attrkeys = None, lazy = False,
+              path_filter = None):
+        """Generate a Manifest from the given zip file.
+
+        The given 'zippath' (a filename or a seekable file object opened for
+        reading in binary mode) is processed using python's built-in zipfile
+        module, and a new manifest is built (and returned) from the members
+        below 'subdir' (which must be "" or end with a "/").
+
+        If 'lazy' is true, content attributes are stored as LazyAttrs, and the
+        members are only decompressed when those attributes are first
+        accessed. In that case, the zip file is kept open until this walker
+        is close()d (e.g. by using it as a context manager).
+
+        The optional 'path_filter' (a PathFilter object) selects the members
+        to include, based on their path relative to 'subdir'.
+
+        Raise ValueError if the zip file holds more than one member with the
+        same name (which zipfile allows, but a Manifest cannot represent).
+        """
+        if attrkeys is not None:
+            for k in attrkeys:
+                assert k in self.attr_handlers or k in self.content_attrs
+        else:
+            attrkeys = self.default_attrs
+
+        content = [k for k in attrkeys if k not in self.attr_handlers]
+        inline = [k for k in attrkeys if k in self.attr_handlers]
+        pool = None
+        if self.jobs > 1 and content and not lazy:
+            # python 2 needs the futures backport
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(self.jobs)
+        pending = collections.deque()
+        max_pending = self.jobs * self.pending_per_job
+
+        zf = zipfile.ZipFile(zippath)
+        top = self.manifest_class()
+        nodes = {} # rel_path -> node for directories
+        implied = set() # directories added before (or without) their entry
+        pruned = set() # directories excluded by path_filter
+        keep_open = False # lazy attributes refer to zf
+        try:
+            for zi in zf.infolist():
+                if not zi.filename.startswith(subdir):
+                    continue
+                rel_path = zi.filename[len(subdir):].rstrip("/")
+                if not rel_path:
+                    continue
+                parts = rel_path.split("/")
+                parent = self.find_parent(
+                    top, nodes, implied, parts, path_filter, pruned)
+                if parent is None:
+                    continue
+                is_dir = is_dir_from_zipinfo(zi)
+                if path_filter is not None and not path_filter.accept(
+                        rel_path, parts[-1], len(parts), is_dir):
+                    if is_dir:
+                        pruned.add(rel_path)
+                    continue
+                attrs = self.find_attrs(zf, zi, inline)
+                future = data = kind = None
+                if not is_dir:
+                    kind = nested_archive(self, zi.filename, zi.file_size)
+                if kind is not None: # hash and walk it from memory
+                    data = io.BytesIO(zf.read(zi))
+                if content and not is_dir:
+                    if data is not None:
+                        attrs.update(digest_stream(data, content, self.bufsize))
+                        data.seek(0)
+                    elif lazy:
+                        attrs.update(manifest.lazy_attrs(functools.partial(
+                            self.find_attrs, zf, zi, content), content))
+                        keep_open = True
+                    elif pool is not None:
+                        future = pool.submit(self.find_attrs, zf, zi, content)
+                    else:
+                        attrs.update(self.find_attrs(zf, zi, content))
+                if is_dir and rel_path in implied: # added before its entry
+                    implied.remove(rel_path)
+                    node = nodes[rel_path]
+                    node.setattrs(attrs)
+                elif parent.get(parts[-1]) is not None:
+                    if is_dir != (rel_path in nodes):
+                        raise ValueError("Zip member %s is both a file and a "
+                                         "directory" % (rel_path))
+                    raise ValueError("Duplicate zip member %s" % (zi.filename))
+                else:
+                    node = parent.add([parts[-1]], attrs)
+                if is_dir:
+                    nodes[rel_path] = node
+                    if path_filter is not None \
+                            and not path_filter.descend(len(parts)):
+                        pruned.add(rel_path)
+                if data is not None:
+                    walk_archive(self, node, kind, data, attrkeys)
+                if future is not None:
+                    pending.append((node, future))
+                    self.finish_pending(pending, max_pending)
+            self.finish_pending(pending)
+            if keep_open:
+                self.lazy_sources.append(zf)
+                zf = None
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if zf is not None:
+                zf.close()
+        return top
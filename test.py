@@ -6,6 +6,10 @@ from test_ManifestFileParser import *
 from test_ManifestFileWriter import *
 from test_ManifestDirWalker import *
 from test_ManifestTarWalker import *
+from test_HashCache import *
+from test_ManifestZipWalker import *
+from test_ColumnarManifest import *
+from test_PathFilter import *
 from test_Manifest_misc import *
 from test_Manifest_walk import *
 from test_Manifest_merge_diff import *
@@ -0,0 +1,258 @@
+import unittest
+
+from manifest import Manifest, LazyAttr
+from manifest_columnar import ColumnarManifest
+from manifest_dir import ManifestDirWalker
+from manifest_file import ManifestFileParser, ManifestFileWriter
+from manifest_tar import ManifestTarWalker
+from test_utils import TEST_TARS, unpacked_tar, walk_all
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+class Test_ColumnarManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.m = ColumnarManifest()
+        self.foo = self.m.add(["foo"], {"mode": 0o40755})
+        self.bar = self.foo.add(["bar"], {"size": 3})
+        self.m.add(["foo", "baz"])
+
+    def test_empty(self):
+        m = ColumnarManifest()
+        self.assertEqual(len(m), 0)
+        self.assertEqual(list(m.walk()), [([], [], {})])
+        self.assertEqual(list(m.paths()), [])
+
+    def test_structure(self):
+        self.assertEqual(self.m.keys(), ["foo"])
+        self.assertEqual(self.m["foo"].keys(), ["bar", "baz"])
+        self.assertTrue("foo" in self.m)
+        self.assertFalse("bar" in self.m)
+        self.assertEqual(len(self.foo), 2)
+        self.assertEqual(self.m.to_manifest(),
+                         {"foo": {"bar": {}, "baz": {}}})
+
+    def test_add_errors(self):
+        self.assertRaises(ValueError, self.m.add, [])
+        self.assertRaises(ValueError, self.m.add, [""])
+        self.assertRaises(ValueError, self.m.add, ["xyzzy", "foo"])
+        self.assertRaises(AssertionError, self.m.add, ["foo"])
+
+    def test_add_many(self):
+        self.m.add_many([("foo/bar/x", None), ("foo/bar/x/y", {"size": 1}),
+                         ("qux", None)])
+        self.assertEqual(self.m.to_manifest(),
+                         {"foo": {"bar": {"x": {"y": {}}}, "baz": {}},
+                          "qux": {}})
+        self.assertEqual(self.m.resolve("foo/bar/x/y").getattrs(), {"size": 1})
+        self.assertRaises(ValueError, self.m.add_many, [("a/b", None)])
+
+    def test_add_many_matches_Manifest(self):
+        sha1 = "0123456789abcdef0123456789abcdef01234567"
+        records = [("a", {"mode": 0o40755}),
+                   ("a/x", {"size": 1, "sha1": sha1, "other": None}),
+                   ("a/y", None),
+                   ("a/y/z", {"sha1": "ABCDEF" * 6 + "ABCD", "uid": True}),
+                   ("a/w", {"size": 2 ** 64, "md5": "short",
+                            "gid": -(2 ** 63)}),
+                   ("b", {"crc32": "0123abcd", "mode": "0644"}),
+                   ("a/v", {"size": 0, "sha1": sha1}),
+                   (("a", "y", "q"), {"mtime_ns": 5})]
+        records.extend(("b/f%d" % (i), {"size": i} if i % 3 else {})
+                       for i in range(2500))
+        m = ColumnarManifest()
+        self.assertEqual(m.add_many(records), len(records))
+        expect = Manifest()
+        expect.add_many(records)
+        self.assertEqual(walk_all(m), walk_all(expect))
+        self.assertEqual(m.add_many(iter([])), 0)
+
+    def test_add_many_after_add(self):
+        self.m.add_many([("foo/qux", {"size": 1}), ("new", {"size": 2})])
+        self.m.add(["new", "sub"], {"size": 3})
+        self.assertEqual(walk_all(self.m), [
+            ([], {}), (["foo"], {"mode": 0o40755}),
+            (["foo", "bar"], {"size": 3}), (["foo", "baz"], {}),
+            (["foo", "qux"], {"size": 1}),
+            (["new"], {"size": 2}), (["new", "sub"], {"size": 3})])
+        self.foo.add_many([("x", None), ("x/y", None)])
+        self.assertSameNode(self.m.resolve("foo/x/y").getparent().getparent(),
+                            self.foo)
+
+    def test_add_many_duplicates_raise_ValueError(self):
+        for records in ([("foo", None)], [("foo/bar", None)],
+                        [("a", None), ("a", None)],
+                        [("a", None), ("a/b", None), ("a/b", None)],
+                        [("a", None), ("b", None), ("a/c", None),
+                         ("a/c", None)]):
+            m = ColumnarManifest.from_manifest(self.m.to_manifest())
+            self.assertRaises(ValueError, m.add_many, records)
+            self.assertEqual(walk_all(ColumnarManifest.from_manifest(
+                m.to_manifest())), walk_all(m))
+
+    def test_add_many_in_any_order(self):
+        records = [("a", None), ("b", None), ("a/x", {"size": 1}),
+                   ("b/y", None), ("a/x/z", None), ("b/y/w", {"size": 2})]
+        m = ColumnarManifest()
+        m.add_many(records)
+        expect = Manifest()
+        expect.add_many(records)
+        self.assertEqual(walk_all(m), walk_all(expect))
+        self.assertRaises(ValueError, m.add_many, [("c", None), ("a/q", None),
+                                                   ("d/e", None)])
+
+    def test_walk_prune_and_attrs_view(self):
+        walked = []
+        for path, names, attrs in self.m.walk(attrs_view = True):
+            walked.append(("/".join(path), attrs))
+            if "bar" in names:
+                names.remove("bar")
+        self.assertEqual(walked, [("", {}), ("foo", {"mode": 0o40755}),
+                                  ("foo/baz", {})])
+        paths = self.m.paths()
+        self.assertEqual(next(paths), "foo")
+        self.assertRaises(StopIteration, paths.send, False)
+
+    def assertSameNode(self, a, b):
+        self.assertEqual((a._store, a._index), (b._store, b._index))
+
+    def test_resolve_and_getparent(self):
+        self.assertSameNode(self.m.resolve("foo/bar"), self.bar)
+        self.assertSameNode(self.m.resolve("foo/bar/.."), self.foo)
+        self.assertSameNode(self.m.resolve("./foo/"), self.foo)
+        self.assertEqual(self.m.resolve("foo/xyzzy"), None)
+        self.assertSameNode(self.bar.getparent(), self.foo)
+        self.assertSameNode(self.foo.getparent(), self.m)
+        self.assertEqual(self.m.getparent(), None)
+
+    def test_eq_compares_entries(self):
+        m = self.m.to_manifest()
+        self.assertTrue(self.m == m)
+        self.assertTrue(m == self.m)
+        self.assertFalse(self.m != m)
+        self.assertEqual(ColumnarManifest.from_manifest(m),
+                         ColumnarManifest.from_manifest(m))
+        self.assertEqual(self.m, {"foo": {"bar": {}, "baz": {}}})
+        self.assertEqual(self.bar, ColumnarManifest())
+        self.assertNotEqual(self.m, self.foo)
+        m["foo"]["bar"].add(["new"])
+        self.assertNotEqual(self.m, m)
+        self.assertNotEqual(m, self.m)
+        self.assertNotEqual(self.m, None)
+
+    def test_attrs(self):
+        sha1 = "0123456789abcdef0123456789abcdef01234567"
+        attrs = {"mode": 0o100644, "uid": 0, "size": 2 ** 40,
+                 "mtime_ns": -5, "sha1": sha1, "crc32": "0123abcd",
+                 "other": "value"}
+        node = self.m.add(["file"], attrs)
+        self.assertEqual(node.getattrs(), attrs)
+        self.assertEqual(node.getattr("sha1"), sha1)
+        self.assertEqual(node.getattr("gid", 7), 7)
+        node.setattr("uid", 1000)
+        attrs["uid"] = 1000
+        self.assertEqual(self.m.resolve("file").getattrs(), attrs)
+        node.setattrs({"size": 1})
+        self.assertEqual(node.getattrs(), {"size": 1})
+        self.assertEqual(self.bar.getattrs(), {"size": 3})
+
+    def test_unpackable_attrs_are_kept_as_is(self):
+        attrs = {"sha1": "ABCDEF" * 6 + "ABCD", "md5": "short",
+                 "size": 2 ** 64, "uid": True, "mode": "0644"}
+        node = self.m.add(["file"], attrs)
+        self.assertEqual(node.getattrs(), attrs)
+
+    def test_top_level_attrs(self):
+        self.m.setattrs({"size": 1, "sha1": "ab" * 20})
+        self.assertEqual(self.m.getattrs(), {"size": 1, "sha1": "ab" * 20})
+
+    def test_lazy_attrs(self):
+        calls = []
+        def func():
+            calls.append(1)
+            return "ab" * 20
+        node = self.m.add(["lazy"], {"size": 1, "sha1": LazyAttr(func)})
+        self.assertEqual(calls, [])
+        self.assertEqual(node.getattrs(), {"size": 1, "sha1": "ab" * 20})
+        self.assertEqual(node.getattr("sha1"), "ab" * 20)
+        self.assertEqual(calls, [1])
+
+    def test_compact(self):
+        self.m.compact()
+        self.assertEqual(self.m.resolve("foo/baz").getattrs(), {})
+        self.m.compact()
+        self.m.add(["foo", "xyzzy"])
+        self.assertEqual(self.m["foo"].keys(), ["bar", "baz", "xyzzy"])
+
+    def test_graft(self):
+        other = Manifest()
+        other.add(["sub"]).add(["file"], {"size": 4})
+        self.bar.graft(other)
+        self.assertEqual(self.m.resolve("foo/bar/sub/file").getattrs(),
+                         {"size": 4})
+        self.assertRaises(ValueError, self.foo.graft, self.m["foo"])
+
+class Test_ColumnarManifest_compat(unittest.TestCase):
+
+    attrkeys = ["mode", "uid", "gid", "size", "mtime_ns", "sha1", "md5"]
+
+    def test_round_trip(self):
+        for tar in TEST_TARS:
+            with unpacked_tar(tar) as d:
+                m = ManifestDirWalker().build(d, self.attrkeys)
+            c = ColumnarManifest.from_manifest(m)
+            self.assertEqual(walk_all(c), walk_all(m))
+            self.assertEqual(list(c.paths()), list(m.paths()))
+            self.assertEqual(walk_all(c.to_manifest()), walk_all(m))
+
+    def test_as_builder_manifest_class(self):
+        for tar in TEST_TARS:
+            expect = ManifestTarWalker().build(tar)
+            m = ManifestTarWalker(ColumnarManifest, jobs = 2).build(tar)
+            self.assertEqual(walk_all(m), walk_all(expect))
+            with unpacked_tar(tar) as d:
+                expect = ManifestDirWalker().build(d, self.attrkeys)
+                m = ManifestDirWalker(ColumnarManifest).build(
+                    d, self.attrkeys)
+            self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_file_round_trip(self):
+        for tar in TEST_TARS:
+            m = ManifestTarWalker().build(tar)
+            f = StringIO()
+            ManifestFileWriter().write(m, f)
+            text = f.getvalue()
+            c = ManifestFileParser(ColumnarManifest).build(
+                StringIO(text).readlines())
+            self.assertEqual(walk_all(c), walk_all(m))
+            f = StringIO()
+            ManifestFileWriter().write(c, f)
+            self.assertEqual(f.getvalue(), text)
+
+    def test_merge_and_diff(self):
+        mfp = ManifestFileParser(Manifest)
+        m1 = mfp.build(["foo", "\tbar", "baz"])
+        m2 = mfp.build(["foo", "\txyzzy", "qux"])
+        c1, c2 = map(ColumnarManifest.from_manifest, (m1, m2))
+        for a, b in [(c1, c2), (c1, m2), (m1, c2)]:
+            self.assertEqual(list(ColumnarManifest.merge(a, b)),
+                             list(Manifest.merge(m1, m2)))
+            self.assertEqual(list(Manifest.diff(a, b)),
+                             list(Manifest.diff(m1, m2)))
+            self.assertEqual(list(ColumnarManifest.diff(a, b,
+                                                        recursive = True)),
+                             list(Manifest.diff(m1, m2, recursive = True)))
+        self.assertEqual(list(ColumnarManifest.diff(c1, m1)), [])
+
+    def test_diff_attrs(self):
+        mfp = ManifestFileParser(Manifest)
+        m1 = mfp.build(["foo {size: 1}", "\tbar", "baz {mode: 0o644}"])
+        m2 = mfp.build(["foo {size: 2}", "\txyzzy", "baz {mode: 0o644}"])
+        c1, c2 = map(ColumnarManifest.from_manifest, (m1, m2))
+        expect = list(Manifest.diff_attrs(m1, m2))
+        self.assertEqual(expect[0], ("modified", "foo", ["size"]))
+        for a, b in [(c1, c2), (c1, m2), (m1, c2)]:
+            self.assertEqual(list(Manifest.diff_attrs(a, b)), expect)
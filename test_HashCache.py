@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from manifest_cache import HashCache
+from manifest_dir import ManifestDirWalker
+from test_utils import unpacked_tar, walk_all
+
+class Test_HashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tempdir, "cache.db")
+        self.file = os.path.join(self.tempdir, "file")
+        with open(self.file, "w") as f:
+            f.write("foo\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_empty(self):
+        with HashCache(self.db) as c:
+            self.assertEqual(len(c), 0)
+            self.assertTrue(c.get(os.lstat(self.file), "sha1") is None)
+            self.assertEqual((c.hits, c.misses), (0, 1))
+
+    def test_put_get(self):
+        with HashCache(self.db) as c:
+            c.put(os.lstat(self.file), "sha1", "abc")
+            self.assertEqual(c.get(os.lstat(self.file), "sha1"), "abc")
+            self.assertTrue(c.get(os.lstat(self.file), "md5") is None)
+            self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def test_persists(self):
+        with HashCache(self.db) as c:
+            c.put(os.lstat(self.file), "sha1", "abc")
+        with HashCache(self.db) as c:
+            self.assertEqual(c.generation, 2)
+            self.assertEqual(c.get(os.lstat(self.file), "sha1"), "abc")
+
+    def test_changed_file_misses(self):
+        with HashCache(self.db) as c:
+            c.put(os.lstat(self.file), "sha1", "abc")
+            with open(self.file, "a") as f:
+                f.write("bar\n")
+            self.assertTrue(c.get(os.lstat(self.file), "sha1") is None)
+
+    def test_compact_evicts_unused(self):
+        other = os.path.join(self.tempdir, "other")
+        with open(other, "w") as f:
+            f.write("other\n")
+        with HashCache(self.db) as c:
+            c.put(os.lstat(self.file), "sha1", "abc")
+            c.put(os.lstat(other), "sha1", "def")
+        with HashCache(self.db) as c:
+            self.assertEqual(c.get(os.lstat(self.file), "sha1"), "abc")
+            self.assertEqual(c.compact(), 1)
+            self.assertEqual(len(c), 1)
+        with HashCache(self.db) as c:
+            self.assertEqual(c.compact(keep = 2), 0)
+            self.assertEqual(c.compact(), 1)
+            self.assertEqual(len(c), 0)
+
+class Test_ManifestDirWalker_w_HashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tempdir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_second_walk_hits(self):
+        for jobs in (1, 2):
+            self.db = os.path.join(self.tempdir, "cache%d.db" % (jobs))
+            with unpacked_tar("files_with_contents.tar") as d:
+                expect = ManifestDirWalker().build(d)
+                with HashCache(self.db) as c:
+                    m = ManifestDirWalker(jobs = jobs, cache = c).build(d)
+                    self.assertEqual((c.hits, c.misses), (0, 2))
+                self.assertEqual(walk_all(m), walk_all(expect))
+                with HashCache(self.db) as c:
+                    m = ManifestDirWalker(jobs = jobs, cache = c).build(d)
+                    self.assertEqual((c.hits, c.misses), (2, 0))
+                self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_changed_file_is_rehashed(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            with HashCache(self.db) as c:
+                ManifestDirWalker(cache = c).build(d)
+            with open(os.path.join(d, "foo"), "a") as f:
+                f.write("more\n")
+            expect = ManifestDirWalker().build(d)
+            with HashCache(self.db) as c:
+                m = ManifestDirWalker(cache = c).build(d)
+                self.assertEqual((c.hits, c.misses), (1, 1))
+        self.assertEqual(walk_all(m), walk_all(expect))
+
+if __name__ == '__main__':
+    unittest.main()
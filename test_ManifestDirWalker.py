@@ -1,8 +1,23 @@
+import os
+import zlib
+import shutil
+import hashlib
+import tarfile
+import tempfile
 import unittest
-
-from manifest import Manifest
-from manifest_dir import ManifestDirWalker
-from test_utils import t_path, unpacked_tar, Manifest_from_walking_unpacked_tar
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from manifest import Manifest, LazyAttr
+from manifest_cache import HashCache
+from manifest_digest import digests
+from manifest_dir import ManifestDirWalker, encode_tree, decode_tree
+from manifest_file import ManifestFileParser, ManifestFileWriter
+from manifest_tar import ManifestTarWalker
+from test_utils import t_path, TEST_TARS, unpacked_tar, \
+    Manifest_from_walking_unpacked_tar, needs_processes, walk_all
 
 class Test_ManifestDirWalker(unittest.TestCase):
 
@@ -56,6 +71,14 @@ class Test_ManifestDirWalker(unittest.TestCase):
             }
         })
 
+    def test_symlink_to_dir_is_not_followed(self):
+        with unpacked_tar("file_and_subdir.tar") as d:
+            os.symlink("subdir", os.path.join(d, "link"))
+            m = self.mdw.build(d)
+            self.assertEqual(m, {"file": {}, "subdir": {"foo": {}}, "link": {}})
+            m = self.mdw.build(d, [])
+            self.assertEqual(m, {"file": {}, "subdir": {"foo": {}}, "link": {}})
+
     def test_files_with_contents(self):
         self.must_equal("files_with_contents.tar",{
             "foo": {},
@@ -159,10 +182,293 @@ class Test_ManifestDirWalker_w_attrs(unittest.TestCase):
                 "mode": 0o120777 },
         })
 
+class Test_ManifestDirWalker_bufsize(unittest.TestCase):
+
+    def test_small_bufsize_gives_same_digests(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            expect = ManifestDirWalker().build(d, ["sha1"])
+            for bufsize in (1, 5, 12, 13):
+                m = ManifestDirWalker(bufsize = bufsize).build(d, ["sha1"])
+                for path in ("foo", "bar/baz"):
+                    self.assertEqual(m.resolve(path).getattrs(),
+                                     expect.resolve(path).getattrs())
+
+class Test_ManifestDirWalker_digests(unittest.TestCase):
+
+    def test_all_digests(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            m = ManifestDirWalker().build(d, list(digests) + ["size"])
+            with open(d + "/foo", "rb") as f:
+                data = f.read()
+        expect = {"size": 12, "crc32": "%08x" % (zlib.crc32(data) & 0xffffffff)}
+        for name in digests:
+            if name != "crc32":
+                expect[name] = hashlib.new(name, data).hexdigest()
+        self.assertEqual(m.resolve("foo").getattrs(), expect)
+        self.assertEqual(m.resolve("bar").getattrs(), {})
+        self.assertEqual(m.resolve("symlink_to_bar_baz").getattrs(), {})
+
+class Test_ManifestDirWalker_hardlinks(unittest.TestCase):
+
+    def make_links(self, d):
+        os.link(os.path.join(d, "foo"), os.path.join(d, "link"))
+        os.link(os.path.join(d, "foo"), os.path.join(d, "bar", "a_link"))
+
+    def test_linked_files_are_read_once(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            self.make_links(d)
+            expect = None
+            for kwargs in ({}, {"jobs": 2}, {"lazy": True}):
+                mdw = ManifestDirWalker(jobs = kwargs.pop("jobs", 1))
+                m = mdw.build(d, ["size", "sha1"], **kwargs)
+                self.assertEqual(mdw.stats["files_linked"], 2)
+                expect = expect or walk_all(m)
+                self.assertEqual(walk_all(m), expect)
+        sha1 = "fc6da897c87c7b9c3b67d1d5af32085e561db793"
+        for path in ("foo", "link", "bar/a_link"):
+            self.assertEqual(m.resolve(path).getattrs(),
+                             {"size": 12, "sha1": sha1})
+
+    def test_record_hardlinks(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            self.make_links(d)
+            m = ManifestDirWalker().build(d, ["size"], hardlinks = True)
+        self.assertEqual(m.resolve("bar/a_link").getattrs(), {"size": 12})
+        self.assertEqual(m.resolve("foo").getattrs(),
+                         {"size": 12, "hardlink": "bar/a_link"})
+        self.assertEqual(m.resolve("link").getattrs(),
+                         {"size": 12, "hardlink": "bar/a_link"})
+        self.assertEqual(m.resolve("bar/baz").getattrs(), {"size": 12})
+
+class Test_ManifestDirWalker_jobs(unittest.TestCase):
+
+    def test_jobs_give_same_result(self):
+        for tar in TEST_TARS:
+            with unpacked_tar(tar) as d:
+                expect = ManifestDirWalker().build(d)
+                for jobs in (2, 4):
+                    m = ManifestDirWalker(jobs = jobs).build(d)
+                    self.assertEqual(m, expect)
+                    self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_jobs_with_few_pending(self):
+        mdw = ManifestDirWalker(jobs = 2)
+        mdw.pending_per_job = 0
+        with unpacked_tar("files_at_many_levels.tar") as d:
+            expect = ManifestDirWalker().build(d)
+            m = mdw.build(d)
+        self.assertEqual(walk_all(m), walk_all(expect))
+
+class Test_ManifestDirWalker_incremental(unittest.TestCase):
+
+    attrkeys = ["mode", "size", "mtime_ns", "sha1"]
+
+    def rebuild(self, d, previous):
+        mdw = ManifestDirWalker()
+        m = mdw.build(d, self.attrkeys, previous)
+        expect = ManifestDirWalker().build(d, self.attrkeys)
+        self.assertEqual(walk_all(m), walk_all(expect))
+        return m, mdw.stats
+
+    def test_unchanged(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, self.attrkeys)
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(stats, {"dirs_listed": 1, "dirs_reused": 1,
+                                 "files_hashed": 0, "files_reused": 2,
+                                 "files_linked": 0})
+
+    def test_previous_from_file(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            s = StringIO()
+            prev = ManifestDirWalker().build(d, self.attrkeys)
+            ManifestFileWriter().write(prev, s)
+            prev = ManifestFileParser().build(StringIO(s.getvalue()))
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(stats["files_reused"], 2)
+
+    def test_changed_file(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, self.attrkeys)
+            with open(os.path.join(d, "bar", "baz"), "a") as f:
+                f.write("more\n")
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(stats, {"dirs_listed": 1, "dirs_reused": 1,
+                                 "files_hashed": 1, "files_reused": 1,
+                                 "files_linked": 0})
+
+    def test_added_file(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, self.attrkeys)
+            with open(os.path.join(d, "bar", "new"), "w") as f:
+                f.write("new\n")
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(m, {"foo": {}, "bar": {"baz": {}, "new": {}},
+                             "symlink_to_bar_baz": {}})
+        self.assertEqual(stats, {"dirs_listed": 2, "dirs_reused": 0,
+                                 "files_hashed": 1, "files_reused": 2,
+                                 "files_linked": 0})
+
+    def test_removed_file(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, self.attrkeys)
+            os.unlink(os.path.join(d, "bar", "baz"))
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(m, {"foo": {}, "bar": {}, "symlink_to_bar_baz": {}})
+
+    def test_previous_without_mtime(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, ["mode", "size", "sha1"])
+            m, stats = self.rebuild(d, prev)
+        self.assertEqual(stats, {"dirs_listed": 2, "dirs_reused": 0,
+                                 "files_hashed": 2, "files_reused": 0,
+                                 "files_linked": 0})
+
+    def test_lazy_previous_is_not_read(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            prev = ManifestDirWalker().build(d, self.attrkeys, lazy = True)
+            prev.resolve("foo").getattr("sha1")
+            with open(os.path.join(d, "bar", "baz"), "a") as f:
+                f.write("more\n")
+            m, stats = self.rebuild(d, prev)
+            self.assertTrue(isinstance(
+                prev.resolve("bar/baz")._raw_attrs()["sha1"], LazyAttr))
+        self.assertEqual(stats, {"dirs_listed": 1, "dirs_reused": 1,
+                                 "files_hashed": 1, "files_reused": 1,
+                                 "files_linked": 0})
+
+class Test_ManifestDirWalker_lazy(unittest.TestCase):
+
+    def test_lazy_gives_same_result(self):
+        for tar in TEST_TARS:
+            with unpacked_tar(tar) as d:
+                expect = ManifestDirWalker().build(d)
+                m = ManifestDirWalker().build(d, lazy = True)
+                self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_lazy_does_not_read_until_needed(self):
+        with unpacked_tar("files_with_contents.tar") as d:
+            expect = ManifestDirWalker().build(d)
+            m = ManifestDirWalker().build(d, lazy = True)
+            self.assertEqual(list(Manifest.diff(m, m)), [])
+            with open(os.path.join(d, "foo"), "w") as f:
+                f.write("changed\n")
+            self.assertEqual(m.resolve("foo").getattr("size"), 12)
+            self.assertRaises(ValueError, m.resolve("foo").getattr, "sha1")
+            self.assertEqual(m.resolve("bar/baz").getattr("sha1"),
+                             expect.resolve("bar/baz").getattr("sha1"))
+
+class Test_ManifestDirWalker_processes(unittest.TestCase):
+
+    attrkeys = ["mode", "size", "mtime_ns", "sha1"]
+
+    def test_encode_decode_tree(self):
+        for tar in TEST_TARS:
+            with unpacked_tar(tar) as d:
+                expect = ManifestDirWalker().build(d, self.attrkeys)
+            m = Manifest()
+            decode_tree(m, encode_tree(expect))
+            self.assertEqual(walk_all(m), walk_all(expect))
+
+    @needs_processes
+    def test_processes_give_same_result(self):
+        for tar in TEST_TARS:
+            with unpacked_tar(tar) as d:
+                expect = ManifestDirWalker().build(d)
+                for shard_depth in (1, 2):
+                    mdw = ManifestDirWalker(processes = 2, jobs = 2)
+                    mdw.shard_depth = shard_depth
+                    m = mdw.build(d)
+                    self.assertEqual(walk_all(m), walk_all(expect))
+
+    @needs_processes
+    def test_processes_w_previous_and_cache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tempdir, "cache.db")
+            with unpacked_tar("files_at_many_levels.tar") as d:
+                with HashCache(db) as c:
+                    mdw = ManifestDirWalker(cache = c, processes = 2)
+                    prev = mdw.build(d, self.attrkeys)
+                    self.assertEqual((c.hits, c.misses), (0, 7))
+                with HashCache(db) as c:
+                    mdw = ManifestDirWalker(cache = c, processes = 2)
+                    m = mdw.build(d, self.attrkeys)
+                    self.assertEqual((c.hits, c.misses), (7, 0))
+                mdw = ManifestDirWalker(processes = 2)
+                m = mdw.build(d, self.attrkeys, prev)
+                self.assertEqual(mdw.stats["files_reused"], 7)
+                self.assertEqual(mdw.stats["files_hashed"], 0)
+                self.assertEqual(walk_all(m), walk_all(prev))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_lazy_or_hardlinks_fail(self):
+        mdw = ManifestDirWalker(processes = 2)
+        with unpacked_tar("empty.tar") as d:
+            self.assertRaises(ValueError, mdw.build, d, lazy = True)
+            self.assertRaises(ValueError, mdw.build, d, hardlinks = True)
+
+class Test_ManifestDirWalker_archives(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tempdir, "top")
+        os.mkdir(self.top)
+        shutil.copy(t_path("files_with_contents.tar"),
+                    os.path.join(self.top, "contents.tar"))
+        # outer.tar.gz holds two_files.tar
+        tf = tarfile.open(os.path.join(self.top, "outer.tar.gz"), "w:gz")
+        tf.add(t_path("two_files.tar"), "./two_files.tar")
+        tf.close()
+        with open(os.path.join(self.top, "bad.tar"), "w") as f:
+            f.write("not a tar file\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_no_archive_depth(self):
+        m = ManifestDirWalker().build(self.top)
+        self.assertEqual(m, {"contents.tar": {}, "outer.tar.gz": {},
+                             "bad.tar": {}})
+
+    def test_archives_as_dirs(self):
+        plain = ManifestDirWalker().build(self.top)
+        m = ManifestDirWalker(archive_depth = 1).build(self.top)
+        self.assertEqual(m, {
+            "contents.tar": {"bar": {"baz": {}}, "foo": {},
+                             "symlink_to_bar_baz": {}},
+            "outer.tar.gz": {"two_files.tar": {}},
+            "bad.tar": {}})
+        for name in m:
+            self.assertEqual(m[name].getattrs(), plain[name].getattrs())
+        self.assertEqual(walk_all(m["contents.tar"])[1:], walk_all(
+            ManifestTarWalker().build(t_path("files_with_contents.tar")))[1:])
+
+    def test_nested_archives(self):
+        m = ManifestDirWalker(archive_depth = 2).build(self.top, ["size"])
+        self.assertEqual(m["outer.tar.gz"],
+                         {"two_files.tar": {"foo": {}, "bar": {}}})
+        self.assertEqual(m.resolve("outer.tar.gz/two_files.tar").getattrs(),
+                         {"size": 10240})
+
+    def test_archive_max_size(self):
+        size = os.path.getsize(os.path.join(self.top, "outer.tar.gz"))
+        m = ManifestDirWalker(archive_depth = 2, archive_max_size = size) \
+            .build(self.top, [])
+        self.assertEqual(m["contents.tar"], {})
+        self.assertEqual(m["outer.tar.gz"], {"two_files.tar": {}})
+
+    @needs_processes
+    def test_archives_w_processes(self):
+        expect = ManifestDirWalker(archive_depth = 2).build(self.tempdir)
+        m = ManifestDirWalker(processes = 2, archive_depth = 2).build(
+            self.tempdir)
+        self.assertEqual(walk_all(m), walk_all(expect))
+
 class Test_ManifestDirWalker_w_all_attrs(unittest.TestCase):
 
     def test_files_with_contents(self):
-        import os
         s = os.stat(t_path("files_with_contents.tar"))
         expect_uid, expect_gid = s.st_uid, s.st_gid
         m = Manifest_from_walking_unpacked_tar("files_with_contents.tar")
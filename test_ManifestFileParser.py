@@ -1,3 +1,4 @@
+import hashlib
 import unittest
 try:
     from cStringIO import StringIO # Most python2
@@ -8,6 +9,7 @@ except ImportError:
         from io import StringIO # python3
 
 from manifest import Manifest
+from manifest_digest import digests, register_digest
 from manifest_file import ManifestFileParser
 
 class Test_ManifestFileParser_parse_lines(unittest.TestCase):
@@ -85,6 +87,34 @@ class Test_ManifestFileParser_parse_lines(unittest.TestCase):
     def test_size_attr(self):
         self.must_equal("foo {size: 1}", [(0, "foo", {"size": 1})])
 
+    def test_compressed_size_attr(self):
+        self.must_equal("foo {size: 10, compressed_size: 4}",
+                        [(0, "foo", {"size": 10, "compressed_size": 4})])
+
+    def test_digest_attrs(self):
+        attrs = {"sha256": "ab" * 32, "md5": "cd" * 16, "crc32": "0123abcd"}
+        self.must_equal("foo {sha256: %s, md5: %s, crc32: %s}" % (
+                            "AB" * 32, "cd" * 16, "0123abcd"),
+                        [(0, "foo", attrs)])
+
+    def test_invalid_digest_attrs_raise(self):
+        self.must_raise("foo {sha256: %s}" % ("ab" * 31), ValueError)
+        self.must_raise("foo {md5: %s}" % ("xy" * 16), ValueError)
+        self.must_raise("foo {crc32: 123}", ValueError)
+
+    def test_registered_digest_attr(self):
+        register_digest("sha224", hashlib.sha224, 56)
+        try:
+            self.must_equal("foo {sha224: %s}" % ("ef" * 28),
+                            [(0, "foo", {"sha224": "ef" * 28})])
+            self.must_raise("foo {sha224: %s}" % ("ef" * 20), ValueError)
+        finally:
+            del digests["sha224"]
+
+    def test_mtime_ns_attr(self):
+        self.must_equal("foo {mtime_ns: 1400000000123456789}",
+                        [(0, "foo", {"mtime_ns": 1400000000123456789})])
+
     def test_two_attrs(self):
         sha1 = "deadbeefdeadbeefdeadbeefdeadbeefdeadbeef"
         self.must_equal("foo {size: 1, sha1: %s}" % (sha1),
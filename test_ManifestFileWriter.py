@@ -59,5 +59,46 @@ foo {gid: 321, uid: 1234}
         baz {a: b, mode: 0o100644, xyzzy: z}
 """)
 
+    def test_digest_attrs_round_trip(self):
+        attrs = {"sha1": "12" * 20, "sha256": "ab" * 32, "md5": "cd" * 16,
+                 "crc32": "0123abcd"}
+        m = Manifest()
+        m.add(["foo"], attrs)
+        s = StringIO()
+        ManifestFileWriter().write(m, s)
+        m2 = ManifestFileParser().build(StringIO(s.getvalue()))
+        self.assertEqual(m2["foo"].getattrs(), attrs)
+
+    def test_tree_digests(self):
+        m = ManifestFileParser().build(["foo {size: 1}", "bar", "\tbaz",
+                                        "\t\tfile {mode: 0o100644}", "empty"])
+        s = StringIO()
+        ManifestFileWriter().write(m, s, tree_digests = True)
+        self.assertEqual(s.getvalue(), """\
+bar {tree_sha1: %s}
+\tbaz {tree_sha1: %s}
+\t\tfile {mode: 0o100644}
+empty
+foo {size: 1}
+""" % (m["bar"].digest(), m["bar"]["baz"].digest()))
+
+    def test_tree_digests_round_trip(self):
+        m = ManifestFileParser().build(["foo {size: 1}", "bar", "\tbaz",
+                                        "\t\tfile {mode: 0o100644}"])
+        s = StringIO()
+        ManifestFileWriter().write(m, s, tree_digests = True)
+        m2 = ManifestFileParser().build(StringIO(s.getvalue()))
+        self.assertEqual(m2["bar"].getattrs(), {})
+        self.assertEqual(m2._digest, m.digest())
+        self.assertEqual(m2["bar"]["baz"]._digest, m["bar"]["baz"].digest())
+        self.assertTrue(m2 == m)
+        m2["bar"]["baz"]._invalidate()
+        self.assertEqual(m2.digest(), m.digest())
+
+    def test_tree_digests_w_attrkeys_fails(self):
+        m = ManifestFileParser().build(["foo", "\tbar"])
+        self.assertRaises(ValueError, ManifestFileWriter().write, m,
+                          StringIO(), attrkeys = ["size"], tree_digests = True)
+
 if __name__ == '__main__':
     unittest.main()
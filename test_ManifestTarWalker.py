@@ -1,8 +1,21 @@
+import io
+import os
+import gzip
+import shutil
+import tarfile
+import subprocess
+import tempfile
 import unittest
+import zipfile
+import warnings
 
-from manifest import Manifest
+from manifest import Manifest, LazyAttr
+from manifest_archive import ARCHIVE_MAX_SIZE
+from manifest_builder import PathFilter
+from manifest_digest import digests
 from manifest_tar import ManifestTarWalker
-from test_utils import t_path, TEST_TARS, Manifest_from_walking_unpacked_tar
+from test_utils import t_path, TEST_TARS, Manifest_from_walking_unpacked_tar, \
+    walk_all
 
 class Test_ManifestTarWalker(unittest.TestCase):
 
@@ -156,10 +169,333 @@ class Test_ManifestTarWalker_w_attrs(unittest.TestCase):
                 "mode": 0o120777 },
         })
 
+class Test_ManifestTarWalker_digests(unittest.TestCase):
+
+    def test_all_digests_match_dir_walker(self):
+        attrkeys = list(digests) + ["size", "mode"]
+        for tar in TEST_TARS:
+            m_tar = ManifestTarWalker().build(tar, attrkeys = attrkeys)
+            m_walk = Manifest_from_walking_unpacked_tar(tar, attrkeys)
+            self.assertEqual(
+                [(path, attrs) for path, names, attrs in m_tar.walk()],
+                [(path, attrs) for path, names, attrs in m_walk.walk()])
+
+class Test_ManifestTarWalker_bufsize(unittest.TestCase):
+
+    def test_small_bufsize_gives_same_digests(self):
+        tar = t_path("files_with_contents.tar")
+        attrkeys = ["sha1", "md5", "crc32"]
+        expect = ManifestTarWalker().build(tar, attrkeys = attrkeys)
+        for bufsize in (1, 5, 12, 13):
+            for stream in (False, True):
+                m = ManifestTarWalker(bufsize = bufsize).build(
+                    tar, attrkeys = attrkeys, stream = stream)
+                for path in ("foo", "bar/baz"):
+                    self.assertEqual(m.resolve(path).getattrs(),
+                                     expect.resolve(path).getattrs())
+
+class Test_ManifestTarWalker_stream(unittest.TestCase):
+
+    def test_stream_from_path(self):
+        for tar in TEST_TARS:
+            expect = ManifestTarWalker().build(tar)
+            m = ManifestTarWalker().build(tar, stream = True)
+            self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_from_file_object(self):
+        for tar in TEST_TARS:
+            expect = ManifestTarWalker().build(tar)
+            for stream in (None, True, False):
+                with open(tar, "rb") as f:
+                    m = ManifestTarWalker().build(f, stream = stream)
+                self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_from_compressed_pipe(self):
+        tar = t_path("files_with_contents.tar")
+        expect = ManifestTarWalker().build(tar)
+        p = subprocess.Popen(["gzip", "-c", tar], stdout = subprocess.PIPE)
+        try:
+            m = ManifestTarWalker().build(p.stdout)
+        finally:
+            p.stdout.close()
+            p.wait()
+        self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_stream_and_lazy_fails(self):
+        self.assertRaises(ValueError, ManifestTarWalker().build,
+                          t_path("single_file.tar"), stream = True, lazy = True)
+
+class Test_ManifestTarWalker_jobs(unittest.TestCase):
+
+    def test_jobs_give_same_result(self):
+        attrkeys = ["mode", "size", "sha1", "sha256"]
+        for tar in TEST_TARS:
+            expect = ManifestTarWalker().build(tar, attrkeys = attrkeys)
+            for jobs in (2, 3):
+                for stream in (False, True):
+                    m = ManifestTarWalker(bufsize = 5, jobs = jobs).build(
+                        tar, attrkeys = attrkeys, stream = stream)
+                    self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_jobs_on_compressed_pipe(self):
+        tar = t_path("files_at_many_levels.tar")
+        expect = ManifestTarWalker().build(tar)
+        p = subprocess.Popen(["gzip", "-c", tar], stdout = subprocess.PIPE)
+        try:
+            m = ManifestTarWalker(jobs = 2).build(p.stdout)
+        finally:
+            p.stdout.close()
+            p.wait()
+        self.assertEqual(walk_all(m), walk_all(expect))
+
+class Test_ManifestTarWalker_index(unittest.TestCase):
+
+    class CountingWalker(ManifestTarWalker):
+        hashed = 0
+
+        def find_attrs(self, tf, ti, attrkeys):
+            if any(k in self.content_attrs for k in attrkeys):
+                self.hashed += 1
+            return ManifestTarWalker.find_attrs(self, tf, ti, attrkeys)
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = os.path.join(self.tempdir, "index.json")
+        self.tar = os.path.join(self.tempdir, "test.tar")
+        shutil.copy(t_path("files_at_many_levels.tar"), self.tar)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def build(self, attrkeys = None, **kwargs):
+        mtw = self.CountingWalker(**kwargs)
+        m = mtw.build(self.tar, attrkeys = attrkeys, index = self.index)
+        return m, mtw.hashed
+
+    def test_index_gives_same_result(self):
+        for tar in TEST_TARS:
+            if os.path.exists(self.index):
+                os.unlink(self.index)
+            expect = ManifestTarWalker().build(tar)
+            for i in range(2):
+                m = ManifestTarWalker().build(tar, index = self.index)
+                self.assertEqual(m, expect)
+                self.assertTrue(os.path.exists(self.index))
+
+    def test_unchanged_archive_is_not_rehashed(self):
+        expect = ManifestTarWalker().build(self.tar)
+        m, hashed = self.build()
+        self.assertEqual((m, hashed), (expect, 7))
+        m, hashed = self.build()
+        self.assertEqual((m, hashed), (expect, 0))
+
+    def test_index_with_subdir_and_filter(self):
+        self.build()
+        mtw = self.CountingWalker()
+        m = mtw.build(self.tar, "./baz/", path_filter = PathFilter(
+            exclude = ["bar"]), index = self.index)
+        self.assertEqual(m, ManifestTarWalker().build(
+            self.tar, "./baz/", path_filter = PathFilter(exclude = ["bar"])))
+        self.assertEqual(mtw.hashed, 0)
+
+    def test_missing_digests_are_added(self):
+        attrkeys = ["sha1", "sha256"]
+        expect = ManifestTarWalker().build(self.tar, attrkeys = attrkeys)
+        self.build(["sha1"])
+        m, hashed = self.build(attrkeys)
+        self.assertEqual((m, hashed), (expect, 7))
+        m, hashed = self.build(attrkeys, jobs = 2)
+        self.assertEqual((m, hashed), (expect, 0))
+
+    def test_changed_archive_is_rehashed(self):
+        self.build()
+        src = os.path.join(self.tempdir, "new")
+        with open(src, "w") as f:
+            f.write("new\n")
+        tf = tarfile.open(self.tar, "a")
+        tf.add(src, "./new")
+        tf.close()
+        m, hashed = self.build()
+        self.assertEqual((m, hashed), (ManifestTarWalker().build(self.tar), 8))
+        m, hashed = self.build()
+        self.assertEqual(hashed, 0)
+
+    def make_tar(self, content):
+        """Write a single-member tar with fixed headers and 'content'."""
+        ti = tarfile.TarInfo("./file")
+        ti.size, ti.mtime = len(content), 1234567890
+        tf = tarfile.open(self.tar, "w")
+        tf.addfile(ti, io.BytesIO(content))
+        tf.close()
+
+    def test_same_headers_different_content(self):
+        self.make_tar(b"old contents")
+        self.build(["sha1"])
+        self.make_tar(b"new contents")
+        os.utime(self.tar, (1, 1)) # archive key differs only in mtime
+        m, hashed = self.build(["sha1"])
+        self.assertEqual(hashed, 1)
+        self.assertEqual(m.resolve("file").getattrs(), ManifestTarWalker()
+                         .build(self.tar, attrkeys = ["sha1"])
+                         .resolve("file").getattrs())
+
+    def test_compressed_archive(self):
+        gz = self.tar + ".gz"
+        with open(self.tar, "rb") as f_in:
+            with gzip.open(gz, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        self.tar = gz
+        attrkeys = ["sha1", "md5"]
+        expect = ManifestTarWalker().build(gz, attrkeys = attrkeys)
+        for keys, count in [(attrkeys, 7), (attrkeys, 0), (["md5"], 0),
+                            (["sha256"], 7), (attrkeys, 0)]:
+            m, hashed = self.build(keys)
+            self.assertEqual(hashed, count)
+        self.assertEqual(m, expect)
+
+    def test_compressed_archive_w_nested_archives(self):
+        tf = tarfile.open(self.tar, "a")
+        tf.add(t_path("two_files.tar"), "./nested.tar")
+        tf.close()
+        gz = self.tar + ".gz"
+        with open(self.tar, "rb") as f_in:
+            with gzip.open(gz, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        self.tar = gz
+        expect = ManifestTarWalker(archive_depth = 1).build(gz)
+        m, hashed = self.build(archive_depth = 1) # nested.tar is hashed
+        self.assertEqual((walk_all(m), hashed), (walk_all(expect), 7))
+        os.utime(self.index, (1, 1))
+        m, hashed = self.build(archive_depth = 1)
+        self.assertEqual((walk_all(m), hashed), (walk_all(expect), 0))
+        self.assertEqual(os.stat(self.index).st_mtime, 1) # not rewritten
+
+    def test_index_needs_filename(self):
+        with open(self.tar, "rb") as f:
+            self.assertRaises(ValueError, ManifestTarWalker().build, f,
+                              index = self.index)
+        self.assertRaises(ValueError, ManifestTarWalker().build, self.tar,
+                          lazy = True, index = self.index)
+
+class Test_ManifestTarWalker_archives(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tar = os.path.join(self.tempdir, "outer.tar")
+        inner_zip = os.path.join(self.tempdir, "inner.zip")
+        zf = zipfile.ZipFile(inner_zip, "w")
+        zf.writestr("dir/file", b"zipped\n")
+        zf.write(t_path("two_files.tar"), "two_files.tar")
+        zf.close()
+        # Member names without a leading "./"
+        tf = tarfile.open(self.tar, "w")
+        tf.add(self.tempdir, "sub", recursive = False)
+        tf.add(t_path("file_and_subdir.tar"), "sub/file_and_subdir.tar")
+        tf.add(inner_zip, "sub/inner.zip")
+        tf.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_subdir_none(self):
+        m = ManifestTarWalker().build(self.tar, None)
+        self.assertEqual(m, {"sub": {"file_and_subdir.tar": {},
+                                     "inner.zip": {}}})
+        m = ManifestTarWalker().build(t_path("two_files.tar"), None)
+        self.assertEqual(m, {"foo": {}, "bar": {}})
+
+    def test_archives_as_dirs(self):
+        m = ManifestTarWalker(archive_depth = 1).build(self.tar, None)
+        self.assertEqual(m, {"sub": {
+            "file_and_subdir.tar": {"file": {}, "subdir": {"foo": {}}},
+            "inner.zip": {"dir": {"file": {}}, "two_files.tar": {}}}})
+        plain = ManifestTarWalker().build(self.tar, None)
+        for path in ("sub/file_and_subdir.tar", "sub/inner.zip"):
+            self.assertEqual(m.resolve(path).getattrs(),
+                             plain.resolve(path).getattrs())
+        self.assertEqual(
+            m.resolve("sub/inner.zip/dir/file").getattrs()["sha1"],
+            "1fc579a29d7d2a4f2f9a2a9818227188af05a738")
+
+    def test_nested_archives(self):
+        m = ManifestTarWalker(archive_depth = 2).build(self.tar, None)
+        self.assertEqual(m.resolve("sub/inner.zip/two_files.tar"),
+                         {"foo": {}, "bar": {}})
+        m = ManifestTarWalker(archive_depth = 2, archive_max_size = 10240) \
+            .build(self.tar, None)
+        self.assertEqual(m.resolve("sub/inner.zip"), {})
+        self.assertEqual(m.resolve("sub/file_and_subdir.tar/subdir"),
+                         {"foo": {}})
+
+    def test_nested_archives_with_duplicates_are_unreadable(self):
+        dup_tar = os.path.join(self.tempdir, "dup.tar")
+        tf = tarfile.open(dup_tar, "w")
+        tf.add(t_path("two_files.tar"), "same")
+        tf.add(t_path("two_files.tar"), "same")
+        tf.close()
+        dup_zip = os.path.join(self.tempdir, "dup.zip")
+        zf = zipfile.ZipFile(dup_zip, "w")
+        zf.writestr("same", b"1")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # zipfile warns of duplicates
+            zf.writestr("same", b"2")
+        zf.close()
+        self.assertRaises(ValueError, ManifestTarWalker().build, dup_tar, None)
+        tf = tarfile.open(self.tar, "a")
+        tf.add(dup_tar, "sub/dup.tar")
+        tf.add(dup_zip, "sub/dup.zip")
+        tf.add(t_path("two_files.tar"), "sub/last.tar")
+        tf.close()
+        m = ManifestTarWalker(archive_depth = 1).build(self.tar, None)
+        self.assertEqual(m.resolve("sub/dup.tar"), {})
+        self.assertEqual(m.resolve("sub/dup.zip"), {})
+        self.assertEqual(m.resolve("sub/last.tar"), {"foo": {}, "bar": {}})
+
+    def test_default_archive_max_size(self):
+        self.assertEqual(ManifestTarWalker().archive_max_size,
+                         ARCHIVE_MAX_SIZE)
+
+    def test_stream_jobs_and_index_give_same_result(self):
+        expect = ManifestTarWalker(archive_depth = 2).build(self.tar, None)
+        index = os.path.join(self.tempdir, "index.json")
+        for jobs, stream in [(1, True), (2, False), (2, True)]:
+            m = ManifestTarWalker(jobs = jobs, archive_depth = 2).build(
+                self.tar, None, stream = stream)
+            self.assertEqual(walk_all(m), walk_all(expect))
+        for i in range(2):
+            m = ManifestTarWalker(archive_depth = 2).build(
+                self.tar, None, index = index)
+            self.assertEqual(walk_all(m), walk_all(expect))
+
+class Test_ManifestTarWalker_lazy(unittest.TestCase):
+
+    def test_lazy_gives_same_result(self):
+        for tar in TEST_TARS:
+            expect = ManifestTarWalker().build(tar)
+            with ManifestTarWalker() as mtw:
+                m = mtw.build(tar, lazy = True)
+                self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_lazy_attrs_are_deferred(self):
+        with ManifestTarWalker() as mtw:
+            m = mtw.build(t_path("files_with_contents.tar"), lazy = True)
+            self.assertTrue(
+                isinstance(m.resolve("foo")._attrs["sha1"], LazyAttr))
+            self.assertEqual(m.resolve("foo").getattr("sha1"),
+                             "fc6da897c87c7b9c3b67d1d5af32085e561db793")
+            self.assertEqual(len(mtw.lazy_sources), 1)
+        self.assertEqual(mtw.lazy_sources, [])
+
+    def test_lazy_without_lazy_attrs_is_closed(self):
+        mtw = ManifestTarWalker()
+        mtw.build(t_path("empty.tar"), lazy = True)
+        mtw.build(t_path("files_with_contents.tar"), attrkeys = ["size"],
+                  lazy = True)
+        self.assertEqual(mtw.lazy_sources, [])
+
 class Test_ManifestTarWalker_w_all_attrs(unittest.TestCase):
 
     def test_files_with_contents(self):
-        import tarfile
         tf = tarfile.open(t_path("files_with_contents.tar"), errorlevel=1)
         ti = tf.next()
         expect_uid, expect_gid = ti.uid, ti.gid
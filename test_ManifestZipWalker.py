@@ -0,0 +1,205 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import warnings
+
+from manifest_builder import PathFilter
+from manifest_tar import ManifestTarWalker
+from manifest_zip import ManifestZipWalker
+from test_utils import t_path, TEST_TARS, walk_all
+
+def zip_from_tar(tar_path, zip_path, dirs = True):
+    """Write the dirs and regular files of the given tar file to a zip file.
+
+    If 'dirs' is false, the zip file gets no directory entries.
+    """
+    tf = tarfile.open(tar_path)
+    zf = zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED)
+    for ti in tf:
+        name = ti.name[len("./"):]
+        if not name or not (ti.isdir() or ti.isfile()):
+            continue
+        if ti.isdir():
+            if not dirs:
+                continue
+            zi = zipfile.ZipInfo(name.rstrip("/") + "/")
+            data = b""
+        else:
+            zi = zipfile.ZipInfo(name)
+            zi.compress_type = zipfile.ZIP_DEFLATED
+            data = tf.extractfile(ti).read()
+        zi.create_system = 3
+        zi.external_attr = ManifestTarWalker.attr_handlers["mode"](tf, ti) << 16
+        zf.writestr(zi, data)
+    zf.close()
+    tf.close()
+
+class Test_ManifestZipWalker(unittest.TestCase):
+
+    attrkeys = ["mode", "size", "crc32", "sha1", "md5"]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.zip = os.path.join(self.tempdir, "test.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_missing_raises(self):
+        self.assertRaises(Exception, ManifestZipWalker().build,
+                          t_path("missing.zip"))
+
+    def test_not_a_zip(self):
+        self.assertRaises(zipfile.BadZipfile, ManifestZipWalker().build,
+                          t_path("plain_file"))
+
+    def test_matches_tar_walker(self):
+        for tar in TEST_TARS:
+            zip_from_tar(tar, self.zip)
+            expect = ManifestTarWalker().build(tar, attrkeys = self.attrkeys)
+            for path, names, attrs in list(expect.walk()):
+                if attrs.get("mode", 0) & 0o170000 == 0o120000: # symlink
+                    expect.resolve("/".join(path[:-1])).pop(path[-1])
+            m = ManifestZipWalker().build(self.zip, attrkeys = self.attrkeys)
+            self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_default_attrs_from_central_directory(self):
+        zip_from_tar(t_path("files_with_contents.tar"), self.zip)
+        opened = []
+        class Walker(ManifestZipWalker):
+            def find_attrs(self, zf, zi, attrkeys):
+                if any(k not in self.attr_handlers for k in attrkeys):
+                    opened.append(zi.filename)
+                return ManifestZipWalker.find_attrs(self, zf, zi, attrkeys)
+        m = Walker().build(self.zip)
+        self.assertEqual(opened, [])
+        expect = ManifestTarWalker().build(t_path("files_with_contents.tar"),
+                                           attrkeys = ["mode", "size", "crc32"])
+        self.assertEqual(m.resolve("foo").getattrs(),
+                         expect.resolve("foo").getattrs())
+        m = Walker().build(self.zip, attrkeys = ["compressed_size", "sha1"])
+        self.assertEqual(sorted(opened), ["bar/baz", "foo"])
+        with zipfile.ZipFile(self.zip) as zf:
+            self.assertEqual(m.resolve("foo").getattr("compressed_size"),
+                             zf.getinfo("foo").compress_size)
+
+    def test_mode_needs_unix_mode_bits(self):
+        zf = zipfile.ZipFile(self.zip, "w")
+        for name, create_system, mode in [("dos_dir/", 0, 0),
+                                          ("dos_file", 0, 0),
+                                          ("no_mode", 3, 0),
+                                          ("unix_file", 3, 0o100600)]:
+            zi = zipfile.ZipInfo(name)
+            zi.create_system = create_system
+            zi.external_attr = mode << 16
+            zf.writestr(zi, b"")
+        zf.close()
+        m = ManifestZipWalker().build(self.zip, attrkeys = ["mode"])
+        self.assertEqual(walk_all(m), [
+            ([], {}), (["dos_dir"], {}), (["dos_file"], {}), (["no_mode"], {}),
+            (["unix_file"], {"mode": 0o100600})])
+
+    def test_duplicate_members_raise_ValueError(self):
+        zf = zipfile.ZipFile(self.zip, "w")
+        zf.writestr("dir/file", b"1")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # zipfile warns of duplicates
+            zf.writestr("dir/file", b"2")
+        zf.close()
+        self.assertRaises(ValueError, ManifestZipWalker().build, self.zip)
+
+    def test_duplicate_dir_members_raise_ValueError(self):
+        zf = zipfile.ZipFile(self.zip, "w")
+        zf.writestr("dir/", b"")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # zipfile warns of duplicates
+            zf.writestr("dir/", b"")
+        zf.close()
+        self.assertRaises(ValueError, ManifestZipWalker().build, self.zip)
+
+    def test_file_and_dir_members_raise_ValueError(self):
+        for names in [("a", "a/b"), ("a/b", "a"), ("a", "a/"), ("a/", "a")]:
+            zf = zipfile.ZipFile(self.zip, "w")
+            for name in names:
+                zf.writestr(name, b"")
+            zf.close()
+            self.assertRaises(ValueError, ManifestZipWalker().build, self.zip)
+
+    def test_conflicting_nested_zip_is_not_walked(self):
+        inner = os.path.join(self.tempdir, "inner.zip")
+        zf = zipfile.ZipFile(inner, "w")
+        zf.writestr("a", b"")
+        zf.writestr("a/b", b"")
+        zf.close()
+        zf = zipfile.ZipFile(self.zip, "w")
+        zf.write(inner, "inner.zip")
+        zf.writestr("foo", b"foo")
+        zf.close()
+        m = ManifestZipWalker(archive_depth = 1).build(self.zip, attrkeys = [])
+        self.assertEqual(m, {"inner.zip": {}, "foo": {}})
+
+    def test_implicit_parent_dirs(self):
+        tar = t_path("files_at_many_levels.tar")
+        zip_from_tar(tar, self.zip, dirs = False)
+        m = ManifestZipWalker().build(self.zip, attrkeys = ["size"])
+        expect = ManifestTarWalker().build(tar, attrkeys = ["size"])
+        self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_subdir(self):
+        zip_from_tar(t_path("files_at_many_levels.tar"), self.zip)
+        m = ManifestZipWalker().build(self.zip, "baz/", attrkeys = [])
+        self.assertEqual(m, {"baz": {"baz": {}, "bar": {}, "foo": {}},
+                             "bar": {}, "foo": {}})
+
+    def test_path_filter(self):
+        for dirs in (True, False):
+            zip_from_tar(t_path("files_at_many_levels.tar"), self.zip, dirs)
+            mzw = ManifestZipWalker()
+            m = mzw.build(self.zip, attrkeys = [],
+                          path_filter = PathFilter(exclude = ["bar"]))
+            self.assertEqual(m, {"baz": {"baz": {"baz": {}, "foo": {}},
+                                         "foo": {}}, "foo": {}})
+            m = mzw.build(self.zip, attrkeys = [],
+                          path_filter = PathFilter(max_depth = 2))
+            self.assertEqual(m, {"baz": {"baz": {}, "bar": {}, "foo": {}},
+                                 "bar": {}, "foo": {}})
+
+    def test_jobs_give_same_result(self):
+        for tar in TEST_TARS:
+            zip_from_tar(tar, self.zip)
+            expect = ManifestZipWalker().build(
+                self.zip, attrkeys = self.attrkeys)
+            for jobs in (2, 3):
+                m = ManifestZipWalker(bufsize = 5, jobs = jobs).build(
+                    self.zip, attrkeys = self.attrkeys)
+                self.assertEqual(walk_all(m), walk_all(expect))
+
+    def test_lazy_gives_same_result(self):
+        for tar in TEST_TARS:
+            zip_from_tar(tar, self.zip)
+            expect = ManifestZipWalker().build(
+                self.zip, attrkeys = self.attrkeys)
+            with ManifestZipWalker() as mzw:
+                m = mzw.build(self.zip, attrkeys = self.attrkeys, lazy = True)
+                self.assertEqual(walk_all(m), walk_all(expect))
+            self.assertEqual(mzw.lazy_sources, [])
+
+    def test_archives_as_dirs(self):
+        inner = os.path.join(self.tempdir, "inner.zip")
+        zip_from_tar(t_path("files_at_many_levels.tar"), inner)
+        zf = zipfile.ZipFile(self.zip, "w")
+        zf.write(inner, "lib/inner.jar")
+        zf.write(t_path("two_files.tar"), "two_files.tar")
+        zf.close()
+        m = ManifestZipWalker().build(self.zip, attrkeys = [])
+        self.assertEqual(m, {"lib": {"inner.jar": {}}, "two_files.tar": {}})
+        m = ManifestZipWalker(archive_depth = 1).build(self.zip)
+        self.assertEqual(m["two_files.tar"], {"foo": {}, "bar": {}})
+        self.assertEqual(walk_all(m.resolve("lib/inner.jar"))[1:],
+                         walk_all(ManifestZipWalker().build(inner))[1:])
+        self.assertEqual(m.resolve("two_files.tar").getattrs(),
+                         ManifestZipWalker().build(self.zip).resolve(
+                             "two_files.tar").getattrs())
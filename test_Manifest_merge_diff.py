@@ -1,6 +1,6 @@
 import unittest
 
-from manifest import Manifest
+from manifest import Manifest, LazyAttr
 from manifest_file import ManifestFileParser
 from test_utils import TEST_TARS, Manifest_from_walking_unpacked_tar
 
@@ -111,6 +111,87 @@ class Test_Manifest_merge(unittest.TestCase):
             (None, None, "foo/foo/foo"),
             (None, "xyzzy", None)])
 
+    def test_key_called_once_per_path(self):
+        m1 = self.mfp.build(["bar", "foo", "  bar", "  foo"])
+        m2 = self.mfp.build(["foo", "  foo", "xyzzy"])
+        calls = []
+        def key(px):
+            calls.append(px)
+            return px
+        list(Manifest.merge(m1, m2, key = key))
+        self.assertEqual(sorted(calls), sorted(
+            list(m1.paths()) + list(m2.paths())))
+
+    def test_many_manifests(self):
+        ms = [self.mfp.build(["common"] + ["f%02d" % (j) for j in range(i)])
+              for i in range(40)]
+        result = list(Manifest.merge(*ms))
+        self.assertEqual(result[0], ("common",) * 40)
+        for j, t in enumerate(result[1:]):
+            path = "f%02d" % (j)
+            self.assertEqual(t, (None,) * (j + 1) + (path,) * (39 - j))
+        self.assertEqual(len(result), 40)
+
+    def test_sorted_output(self):
+        ms = [self.mfp.build(names) for names in (
+            ["b", "d", "  x"], ["a", "d", "  y"], ["c", "d", "  x", "e"])]
+        result = list(Manifest.merge(*ms))
+        keys = [[p for p in t if p is not None][0] for t in result]
+        self.assertEqual(keys, ["a", "b", "c", "d", "d/x", "d/y", "e"])
+        self.assertEqual(result[4], ("d/x", None, "d/x"))
+
+class Test_Manifest_merge_nodes(unittest.TestCase):
+
+    def setUp(self):
+        self.mfp = ManifestFileParser(Manifest)
+        self.m1 = self.mfp.build(["bar", "foo", "  bar", "  foo"])
+        self.m2 = self.mfp.build(["foo", "  foo", "xyzzy"])
+
+    def test_nothing(self):
+        self.assertEqual(list(Manifest.merge_nodes()), [])
+        self.assertEqual(list(Manifest.merge_nodes(Manifest())), [])
+
+    def test_same_as_merge(self):
+        expect = list(Manifest.merge(self.m1, self.m2))
+        actual = list(Manifest.merge_nodes(self.m1, self.m2))
+        self.assertEqual(len(actual), len(expect))
+        for (path, nodes), paths in zip(actual, expect):
+            self.assertEqual(tuple(p and "/".join(path) for p in paths),
+                             paths)
+            self.assertEqual(nodes, tuple(
+                p and m.resolve(p) for m, p in zip((self.m1, self.m2), paths)))
+
+    def test_yields_visited_nodes(self):
+        result = dict(Manifest.merge_nodes(self.m1, self.m2))
+        self.assertTrue(result[("foo", "foo")][0] is self.m1["foo"]["foo"])
+        self.assertTrue(result[("foo", "foo")][1] is self.m2["foo"]["foo"])
+        self.assertEqual(result[("xyzzy",)], (None, self.m2["xyzzy"]))
+
+    def test_compares_components(self):
+        m1 = self.mfp.build(["a", "  b", "a-b"])
+        m2 = self.mfp.build(["a-b"])
+        self.assertEqual([p for p, nodes in Manifest.merge_nodes(m1, m2)],
+                         [("a",), ("a", "b"), ("a-b",)])
+        self.assertEqual(list(Manifest.merge_nodes(m1, m2))[2][1],
+                         (m1["a-b"], m2["a-b"]))
+
+    def test_recursion_control(self):
+        self.assertEqual(
+            [p for p, nodes in Manifest.merge_nodes(self.m1, self.m2,
+                                                    recursive = False)],
+            [("bar",), ("foo",), ("xyzzy",)])
+        gen = Manifest.merge_nodes(self.m1, self.m2, recursive = False)
+        self.assertEqual(next(gen)[0], ("bar",))
+        self.assertEqual(next(gen)[0], ("foo",))
+        self.assertEqual(gen.send(True)[0], ("foo", "bar"))
+
+    def test_custom_key(self):
+        m1 = self.mfp.build(["1foo", "2bar"])
+        m2 = self.mfp.build(["abc", "def"])
+        key = lambda px: 0
+        self.assertEqual([p for p, nodes in Manifest.merge_nodes(
+            m1, m2, key = key)], [("1foo",), ("2bar",)])
+
 class Test_Manifest_diff(unittest.TestCase):
 
     def test_diff_empties(self):
@@ -222,5 +303,167 @@ class Test_Manifest_diff(unittest.TestCase):
             (None, "4diff/1diff"),
         ])
 
+class Test_Manifest_diff_w_digests(unittest.TestCase):
+
+    def setUp(self):
+        lines = ["same", "\tsub", "\t\tfile {size: 1}", "changed",
+                 "\tfile {size: 2}"]
+        self.m1 = ManifestFileParser().build(lines)
+        self.m2 = ManifestFileParser().build(lines + ["\tnew"])
+
+    def walked(self, *args, **kwargs):
+        """Return the paths visited by diff()ing the given manifests."""
+        visited = []
+        key = lambda px: visited.append(px) or px
+        result = list(Manifest.diff(key = key, *args, **kwargs))
+        return result, sorted(set(visited))
+
+    def test_unchanged_subtrees_are_not_walked(self):
+        self.m1.digest()
+        self.m2.digest()
+        result, visited = self.walked(self.m1, self.m2)
+        self.assertEqual(result, [(None, "changed/new")])
+        self.assertEqual(visited, ["changed", "changed/file", "changed/new",
+                                   "same"])
+
+    def test_without_digests_everything_is_walked(self):
+        result, visited = self.walked(self.m1, self.m2)
+        self.assertEqual(result, [(None, "changed/new")])
+        self.assertEqual(visited, ["changed", "changed/file", "changed/new",
+                                   "same", "same/sub", "same/sub/file"])
+
+    def test_dict_mutation_is_walked_into(self):
+        self.m1.digest()
+        self.m2.digest()
+        self.m2["same"]["sub"].pop("file")
+        result, visited = self.walked(self.m1, self.m2)
+        self.assertEqual(result, [(None, "changed/new"),
+                                  ("same/sub/file", None)])
+
+    def test_prune_equal_false(self):
+        self.m1.digest()
+        self.m2.digest()
+        result, visited = self.walked(self.m1, self.m2, prune_equal = False)
+        self.assertEqual(len(visited), 6)
+
+    def test_attr_change_is_walked_into(self):
+        self.m2.resolve("same/sub/file").setattr("size", 5)
+        self.m1.digest()
+        self.m2.digest()
+        result, visited = self.walked(self.m1, self.m2)
+        self.assertTrue("same/sub/file" in visited)
+
+    def test_merge_does_not_prune_by_default(self):
+        self.m1.digest()
+        self.m2.digest()
+        self.assertEqual(len(list(Manifest.merge(self.m1, self.m2))), 6)
+        self.assertEqual(len(list(Manifest.merge(self.m1, self.m2,
+                                                 prune_equal = True))), 4)
+
+class Test_Manifest_diff_attrs(unittest.TestCase):
+
+    def setUp(self):
+        self.mfp = ManifestFileParser()
+        self.m1 = self.mfp.build([
+            "dir {mode: 0o40755}",
+            "\tfile {mode: 0o100644, size: 1}",
+            "\tgone",
+            "\t\tsub",
+            "same {size: 2}",
+            "x {size: 3, uid: 0}"])
+        self.m2 = self.mfp.build([
+            "dir {mode: 0o40700}",
+            "\tfile {mode: 0o100644, size: 2}",
+            "new",
+            "\tsub",
+            "same {size: 2}",
+            "x {size: 3, gid: 0}"])
+
+    def test_nothing(self):
+        self.assertEqual(list(Manifest.diff_attrs(Manifest(), Manifest())),
+                         [])
+        self.assertEqual(list(Manifest.diff_attrs(self.m1, self.m1)), [])
+
+    def test_diff_attrs(self):
+        self.assertEqual(list(Manifest.diff_attrs(self.m1, self.m2)), [
+            ("modified", "dir", ["mode"]),
+            ("modified", "dir/file", ["size"]),
+            ("removed", "dir/gone", []),
+            ("added", "new", []),
+            ("modified", "x", ["uid", "gid"]),
+        ])
+
+    def test_recursive(self):
+        self.assertEqual(
+            list(Manifest.diff_attrs(self.m1, self.m2, recursive = True)), [
+                ("modified", "dir", ["mode"]),
+                ("modified", "dir/file", ["size"]),
+                ("removed", "dir/gone", []),
+                ("removed", "dir/gone/sub", []),
+                ("added", "new", []),
+                ("added", "new/sub", []),
+                ("modified", "x", ["uid", "gid"]),
+            ])
+
+    def test_attrkeys(self):
+        self.assertEqual(
+            list(Manifest.diff_attrs(self.m1, self.m2, ["size", "gid"])), [
+                ("modified", "dir/file", ["size"]),
+                ("removed", "dir/gone", []),
+                ("added", "new", []),
+                ("modified", "x", ["gid"]),
+            ])
+
+    def test_matches_diff(self):
+        for recursive in (False, True):
+            expect = [p or q for p, q in Manifest.diff(
+                self.m1, self.m2, recursive = recursive)]
+            actual = [path for change, path, keys in Manifest.diff_attrs(
+                self.m1, self.m2, recursive = recursive)
+                if change != "modified"]
+            self.assertEqual(actual, expect)
+
+    def test_cheap_attrs_first_and_size_implies_digests(self):
+        calls = []
+        def lazy(value):
+            return LazyAttr(lambda: calls.append(value) or value)
+        m1, m2 = Manifest(), Manifest()
+        m1.add(["a"], {"sha1": lazy("1" * 40), "size": 1, "other": "x"})
+        m2.add(["a"], {"sha1": lazy("2" * 40), "size": 2, "other": "y"})
+        m1.add(["b"], {"sha1": lazy("3" * 40), "size": 1})
+        m2.add(["b"], {"sha1": lazy("4" * 40), "size": 1})
+        self.assertEqual(list(Manifest.diff_attrs(m1, m2)), [
+            ("modified", "a", ["size", "other", "sha1"]),
+            ("modified", "b", ["sha1"]),
+        ])
+        self.assertEqual(calls, ["3" * 40, "4" * 40])
+
+    def test_one_sided_size_does_not_imply_digests(self):
+        m1, m2 = Manifest(), Manifest()
+        m1.add(["a"], {"size": 5, "sha1": "1" * 40})
+        m2.add(["a"], {"sha1": "1" * 40})
+        self.assertEqual(list(Manifest.diff_attrs(m1, m2)), [
+            ("modified", "a", ["size"]),
+        ])
+
+    def test_equal_digests_are_skipped(self):
+        self.m1["dir"].add(["more"])
+        m3 = self.mfp.build(["dir {mode: 0o40700}", "\tfile", "\tmore"])
+        m3.digest()
+        self.m1.digest()
+        self.assertEqual(list(Manifest.diff_attrs(self.m1, m3)), [
+            ("modified", "dir", ["mode"]),
+            ("modified", "dir/file", ["size", "mode"]),
+            ("removed", "dir/gone", []),
+            ("removed", "same", []),
+            ("removed", "x", []),
+        ])
+        del self.m1["dir"]["gone"]
+        m3["dir"].restore_digest(self.m1["dir"].digest()) # claim no changes
+        self.assertEqual(list(Manifest.diff_attrs(self.m1, m3))[:2], [
+            ("modified", "dir", ["mode"]),
+            ("removed", "same", []),
+        ])
+
 if __name__ == '__main__':
     unittest.main()
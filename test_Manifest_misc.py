@@ -1,6 +1,9 @@
+import gc
 import unittest
+import weakref
 
-from manifest import Manifest
+from manifest import Manifest, ManifestInserter, LazyAttr, lazy_attrs, \
+    EMPTY_ATTRS
 from manifest_file import ManifestFileParser
 
 class Test_Manifest_add(unittest.TestCase):
@@ -52,6 +55,365 @@ class Test_Manifest_add(unittest.TestCase):
         self.assertEqual(self.m["foo"]["bar"].getattrs(),
                          {"size": 123, "bar": "baz"})
 
+    def test_add_does_not_modify_path(self):
+        path = ["foo"]
+        self.m.add(path)
+        path.append("bar")
+        self.m.add(path)
+        self.assertEqual(path, ["foo", "bar"])
+        self.assertEqual(self.m, {"foo": {"bar": {}}})
+
+    def test_add_returns_new_node(self):
+        foo = self.m.add(["foo"])
+        self.assertTrue(self.m.add(("foo", "bar")) is foo["bar"])
+        self.assertTrue(foo["bar"].getparent() is foo)
+
+class Test_Manifest_add_many(unittest.TestCase):
+
+    def setUp(self):
+        self.m = Manifest()
+
+    def test_add_many(self):
+        n = self.m.add_many([
+            ("foo", {"size": 1}),
+            ("foo/bar", None),
+            ("foo/bar/baz", {"size": 2}),
+            ("foo/xyzzy", None),
+            ("qux", None),
+            (["qux", "quux"], None),
+        ])
+        self.assertEqual(n, 6)
+        self.assertEqual(self.m, {"foo": {"bar": {"baz": {}}, "xyzzy": {}},
+                                  "qux": {"quux": {}}})
+        self.assertEqual(self.m["foo"].getattrs(), {"size": 1})
+        self.assertEqual(self.m.resolve("foo/bar/baz").getattrs(), {"size": 2})
+        self.assertTrue(self.m.resolve("foo/bar/baz").getparent() is
+                        self.m["foo"]["bar"])
+
+    def test_add_many_out_of_order(self):
+        self.m.add_many([("a", None), ("b", None), ("b/c", None),
+                         ("a/d", None), ("b/c/e", None), ("a/d/f", None)])
+        self.assertEqual(self.m, {"a": {"d": {"f": {}}},
+                                  "b": {"c": {"e": {}}}})
+
+    def test_add_many_matches_add(self):
+        mfp = ManifestFileParser()
+        expect = mfp.build(["foo", "\tbar", "\t\tbaz", "\tqux", "xyzzy"])
+        self.m.add_many((p, None) for p in expect.paths())
+        self.assertEqual(self.m, expect)
+
+    def test_add_many_child_before_parent_fails(self):
+        self.assertRaises(ValueError, self.m.add_many,
+                          [("foo", None), ("foo/bar/baz", None)])
+        self.assertEqual(self.m, {"foo": {}})
+
+    def test_add_many_existing_entry_fails(self):
+        self.assertRaises(ValueError, self.m.add_many,
+                          [("foo", None), ("foo/bar", None), ("foo/bar", None)])
+        self.assertEqual(self.m, {"foo": {"bar": {}}})
+
+    def test_add_many_empty_component_fails(self):
+        self.assertRaises(ValueError, self.m.add_many, [("", None)])
+        self.assertRaises(ValueError, self.m.add_many,
+                          [("foo", None), ("foo//bar", None)])
+        self.assertRaises(ValueError, self.m.add_many, [([], None)])
+
+    def test_inserter_below_subtree(self):
+        foo = self.m.add(["foo"])
+        inserter = ManifestInserter(foo)
+        bar = inserter.add("bar")
+        self.assertTrue(inserter.add(["bar", "baz"]).getparent() is bar)
+        self.assertEqual(self.m, {"foo": {"bar": {"baz": {}}}})
+
+class Test_Manifest_compact(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        m = Manifest()
+        self.assertFalse(hasattr(m, "__dict__"))
+        self.assertRaises(AttributeError, setattr, m, "foo", 1)
+
+    def test_empty_attrs_are_shared(self):
+        m = Manifest()
+        foo = m.add(["foo"])
+        bar = m.add(["bar"], {})
+        self.assertTrue(foo._attrs is EMPTY_ATTRS and bar._attrs is EMPTY_ATTRS)
+        foo.setattr("size", 1)
+        bar.setattrs({})
+        self.assertEqual(EMPTY_ATTRS, {})
+        self.assertEqual(foo.getattrs(), {"size": 1})
+        self.assertTrue(bar._attrs is EMPTY_ATTRS)
+
+    def test_parent_outlives_references(self):
+        m = Manifest()
+        sub = m.add(["foo"]).add(["bar"])
+        ref = weakref.ref(m)
+        del m
+        self.assertTrue(sub.getparent().getparent() is ref())
+        del sub
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+class Test_Manifest_graft(unittest.TestCase):
+
+    def test_graft(self):
+        m = Manifest()
+        node = m.add(["foo.tar"], {"size": 1})
+        other = Manifest()
+        other.setattrs({"size": 2})
+        other.add(["bar"]).add(["baz"], {"size": 3})
+        node.graft(other)
+        self.assertEqual(m, {"foo.tar": {"bar": {"baz": {}}}})
+        self.assertEqual(other, {})
+        self.assertEqual(node.getattrs(), {"size": 1})
+        self.assertTrue(m.resolve("foo.tar/bar").getparent() is node)
+        self.assertEqual(m.resolve("foo.tar/bar/baz").getattrs(), {"size": 3})
+
+    def test_graft_existing_raises(self):
+        m = Manifest()
+        m.add(["foo"])
+        other = Manifest()
+        other.add(["foo"])
+        self.assertRaises(ValueError, m.graft, other)
+
+class Test_Manifest_lazy_attrs(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def func(self, value):
+        self.calls.append(value)
+        return value
+
+    def lazy(self, value):
+        return LazyAttr(lambda: self.func(value))
+
+    def test_getattr(self):
+        m = Manifest()
+        m.add(["foo"], {"size": 1, "sha1": self.lazy("abc")})
+        self.assertEqual(m["foo"].getattr("size"), 1)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(m["foo"].getattr("sha1"), "abc")
+        self.assertEqual(m["foo"].getattr("sha1"), "abc")
+        self.assertEqual(self.calls, ["abc"])
+        self.assertEqual(m["foo"].getattr("missing", 5), 5)
+
+    def test_getattrs(self):
+        m = Manifest()
+        m.add(["foo"], {"size": 1, "sha1": self.lazy("abc")})
+        self.assertEqual(m["foo"].getattrs(), {"size": 1, "sha1": "abc"})
+        self.assertEqual(m["foo"].getattrs(), {"size": 1, "sha1": "abc"})
+        self.assertEqual(self.calls, ["abc"])
+
+    def test_setattr_does_not_compute(self):
+        m = Manifest()
+        m.add(["foo"], {"sha1": self.lazy("abc")})
+        m["foo"].setattr("size", 3)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(m["foo"].getattrs(), {"size": 3, "sha1": "abc"})
+
+    def test_None_is_missing(self):
+        m = Manifest()
+        m.add(["foo"], {"size": 1, "sha1": self.lazy(None)})
+        self.assertEqual(m["foo"].getattr("sha1", "default"), "default")
+        self.assertEqual(m["foo"].getattrs(), {"size": 1})
+
+    def test_lazy_attrs_share_one_call(self):
+        attrs = lazy_attrs(lambda: self.func({"a": 1, "b": 2}), ["a", "b"])
+        m = Manifest()
+        m.add(["foo"], attrs)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(m["foo"].getattrs(), {"a": 1, "b": 2})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_paths_and_diff_do_not_compute(self):
+        m1, m2 = Manifest(), Manifest()
+        m1.add(["foo"], {"sha1": self.lazy("abc")})
+        m2.add(["bar"], {"sha1": self.lazy("def")})
+        self.assertEqual(list(m1.paths()), ["foo"])
+        self.assertEqual(list(Manifest.diff(m1, m2)),
+                         [(None, "bar"), ("foo", None)])
+        self.assertEqual(self.calls, [])
+
+class Test_Manifest_digest(unittest.TestCase):
+
+    def setUp(self):
+        self.mfp = ManifestFileParser()
+        self.lines = ["foo {size: 1}", "bar", "\tbaz", "\t\tfile {size: 2}",
+                      "\txyzzy"]
+        self.m = self.mfp.build(self.lines)
+
+    def test_equal_trees_have_equal_digests(self):
+        m2 = self.mfp.build(list(reversed(self.lines[:1])) + self.lines[1:])
+        self.assertEqual(self.m.digest(), m2.digest())
+        self.assertEqual(self.m["bar"].digest(), m2["bar"].digest())
+        self.assertNotEqual(self.m.digest(), self.m["bar"].digest())
+        self.assertEqual(Manifest().digest(), self.m["foo"].digest())
+
+    def test_digest_covers_names_and_attrs(self):
+        before = self.m.digest()
+        for lines in (["foo {size: 2}"] + self.lines[1:],
+                      self.lines[:3] + ["\t\tfile {size: 3}", "\txyzzy"],
+                      self.lines[:3] + ["\t\tfile2 {size: 2}", "\txyzzy"],
+                      self.lines[:4]):
+            self.assertNotEqual(self.mfp.build(lines).digest(), before)
+
+    def test_digest_is_cached(self):
+        digest = self.m.digest()
+        self.assertEqual(self.m._digest, digest)
+        self.assertEqual(self.m.resolve("bar/baz")._digest,
+                         self.m["bar"]["baz"].digest())
+
+    def test_add_invalidates_ancestors_only(self):
+        before = self.m.digest()
+        self.m.resolve("bar/xyzzy").add(["new"])
+        self.assertTrue(self.m._digest is None)
+        self.assertTrue(self.m["bar"]._digest is None)
+        self.assertTrue(self.m["bar"]["baz"]._digest is not None)
+        self.assertNotEqual(self.m.digest(), before)
+
+    def test_setattr_invalidates(self):
+        before = self.m.digest()
+        node = self.m.resolve("bar/baz/file")
+        node.setattr("size", 3)
+        self.assertNotEqual(self.m.digest(), before)
+        node.setattrs({"size": 2})
+        self.assertEqual(self.m.digest(), before)
+
+    def test_graft_invalidates(self):
+        other = self.mfp.build(["sub"])
+        before = (self.m.digest(), other.digest())
+        self.m["foo"].graft(other)
+        self.assertNotEqual(self.m.digest(), before[0])
+        self.assertNotEqual(other.digest(), before[1])
+
+    def test_digest_computes_lazy_attrs(self):
+        m = Manifest()
+        m.add(["foo"], {"size": LazyAttr(lambda: 1)})
+        expect = self.mfp.build(["foo {size: 1}"])
+        self.assertEqual(m.digest(), expect.digest())
+
+    def test_restore_digest(self):
+        m = self.mfp.build(self.lines)
+        self.assertFalse(m.restore_digest("0" * 40)) # children not known
+        self.assertTrue(m["bar"]["baz"].restore_digest("1" * 40))
+        self.assertTrue(m["bar"].restore_digest("2" * 40))
+        self.assertTrue(m.restore_digest())
+        self.assertEqual(m["bar"].digest(), "2" * 40)
+        self.assertEqual(m["foo"].digest(), Manifest().digest())
+
+    def test_eq(self):
+        m2 = self.mfp.build(self.lines)
+        self.assertTrue(self.m == m2)
+        self.assertFalse(self.m != m2)
+        self.assertFalse(self.m == self.mfp.build(self.lines[:4]))
+        self.assertEqual(self.m, {"foo": {}, "bar": {"baz": {"file": {}},
+                                                     "xyzzy": {}}})
+
+    def test_same_entries_with_matching_digests_is_shortcut(self):
+        m2 = self.mfp.build(self.lines)
+        self.m.digest()
+        m2.digest()
+        self.assertTrue(self.m.same_entries(m2))
+        m2["bar"]["baz"].pop("file")
+        m2._digest = self.m.digest()
+        self.assertTrue(self.m.same_entries(m2)) # trusts the digests
+        self.assertFalse(self.m == m2)
+        m2.add(["foo", "new"])
+        self.assertFalse(self.m.same_entries(m2))
+        m2["foo"].pop("new")
+        self.assertTrue(self.m.same_entries(m2) is (self.m == m2))
+        self.assertTrue(self.m["foo"].same_entries(Manifest()))
+
+    def test_dict_mutators_invalidate(self):
+        mutators = [
+            lambda m: m.__setitem__("new", Manifest()),
+            lambda m: m.__delitem__("file"),
+            lambda m: m.pop("file"),
+            lambda m: m.popitem(),
+            lambda m: m.clear(),
+            lambda m: m.update({"new": Manifest()}),
+            lambda m: m.setdefault("new", Manifest()),
+        ]
+        for mutate in mutators:
+            m = self.mfp.build(self.lines)
+            before = m.digest()
+            mutate(m["bar"]["baz"])
+            self.assertTrue(m._digest is None)
+            self.assertTrue(m["bar"]._digest is None)
+            self.assertNotEqual(m.digest(), before)
+
+class Test_Manifest_lookup(unittest.TestCase):
+
+    def setUp(self):
+        self.m = ManifestFileParser().build(
+            ["foo", "\tbar", "\t\tbaz", "xyzzy"])
+
+    def tearDown(self):
+        self.m.drop_index()
+
+    def test_lookup(self):
+        self.assertTrue(self.m.lookup("foo") is self.m["foo"])
+        self.assertTrue(self.m.lookup("foo/bar/baz") is
+                        self.m["foo"]["bar"]["baz"])
+        self.assertTrue(self.m.lookup("missing") is None)
+        self.assertTrue(self.m.lookup("foo/missing") is None)
+        self.assertTrue(self.m._path_index is not None)
+
+    def test_lookup_falls_back_to_resolve(self):
+        self.assertTrue(self.m.lookup("") is self.m)
+        self.assertTrue(self.m.lookup("./foo/bar/") is self.m["foo"]["bar"])
+        self.assertTrue(self.m.lookup("foo/bar/..") is self.m["foo"])
+        foo = self.m["foo"]
+        self.assertTrue(foo.lookup("bar/baz") is foo["bar"]["baz"])
+        self.assertTrue(foo._path_index is self.m._path_index)
+
+    def test_lookup_many(self):
+        paths = ["xyzzy", "nope", "foo/bar", "foo/bar/baz/nope"]
+        self.assertEqual([(p, n) for p, n in self.m.lookup_many(iter(paths))],
+                         [("xyzzy", self.m["xyzzy"]), ("nope", None),
+                          ("foo/bar", self.m["foo"]["bar"]),
+                          ("foo/bar/baz/nope", None)])
+        self.assertTrue(list(self.m.lookup_many(["foo/bar"]))[0][1] is
+                        self.m["foo"]["bar"])
+        self.assertEqual(list(self.m["foo"].lookup_many(["bar/baz"])),
+                         [("bar/baz", self.m["foo"]["bar"]["baz"])])
+
+    def test_add_updates_index(self):
+        self.m.lookup("foo")
+        new = self.m["foo"]["bar"].add(["new"])
+        self.assertTrue(self.m.lookup("foo/bar/new") is new)
+        self.m.add_many([("top", None), ("top/sub", None)])
+        self.assertTrue(self.m.lookup("top/sub") is self.m["top"]["sub"])
+        new.add(["deeper"])
+        self.assertTrue(self.m.lookup("foo/bar/new/deeper") is
+                        new["deeper"])
+
+    def test_graft_drops_index(self):
+        self.m.lookup("foo")
+        other = ManifestFileParser().build(["sub"])
+        self.m["xyzzy"].graft(other)
+        self.assertTrue(self.m._path_index.nodes is None)
+        self.assertTrue(self.m.lookup("xyzzy/sub") is self.m["xyzzy"]["sub"])
+
+    def test_dict_mutators_drop_index(self):
+        for mutate in [lambda m: m.__delitem__("foo"),
+                       lambda m: m.pop("foo"),
+                       lambda m: m.clear(),
+                       lambda m: m["foo"].__setitem__("bar", Manifest())]:
+            m = ManifestFileParser().build(["foo", "\tbar", "\t\tbaz"])
+            baz = m.lookup("foo/bar/baz")
+            mutate(m)
+            self.assertTrue(m.lookup("foo/bar/baz") is None)
+            self.assertTrue(baz._path_index.nodes is None)
+
+    def test_unindexed_add_is_unaffected(self):
+        self.m.lookup("foo")
+        other = ManifestFileParser().build(["foo"])
+        new = other["foo"].add(["new"])
+        self.assertTrue(other._path_index is None)
+        self.assertTrue(new._path_index is None)
+        self.assertTrue(self.m.lookup("foo/new") is None)
+
 class Test_Manifest_resolve(unittest.TestCase):
 
     def setUp(self):
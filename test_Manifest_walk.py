@@ -1,6 +1,9 @@
 import unittest
 
-from manifest import Manifest
+import sys
+import operator
+
+from manifest import Manifest, LazyAttr
 from manifest_file import ManifestFileParser
 from manifest_dir import ManifestDirWalker
 from test_utils import unpacked_tar, Manifest_from_walking_unpacked_tar
@@ -320,5 +323,51 @@ class Test_Manifest_paths(unittest.TestCase):
         self.assertEqual(list(m.paths(recursive = False)),
                          ["bar", "baz", "foo"])
 
+class Test_Manifest_walk_deep(unittest.TestCase):
+
+    def setUp(self):
+        self.depth = sys.getrecursionlimit() + 100
+        self.m = Manifest()
+        self.m.add_many(("/".join(["d"] * (i + 1)), {"size": i})
+                        for i in range(self.depth))
+
+    def test_walk_deeper_than_recursion_limit(self):
+        walked = list(self.m.walk())
+        self.assertEqual(len(walked), self.depth + 1)
+        path, names, attrs = walked[-1]
+        self.assertEqual(path, ["d"] * self.depth)
+        self.assertEqual(attrs, {"size": self.depth - 1})
+
+    def test_paths_deeper_than_recursion_limit(self):
+        paths = list(self.m.paths())
+        self.assertEqual(len(paths), self.depth)
+        self.assertEqual(paths[-1], "/".join(["d"] * self.depth))
+
+class Test_Manifest_walk_attrs_view(unittest.TestCase):
+
+    def setUp(self):
+        self.m = Manifest()
+        self.m.add(["foo"], {"size": 1, "sha1": LazyAttr(lambda: "abc")})
+        self.m.add(["bar"])
+
+    def test_same_attrs_as_walk(self):
+        self.assertEqual(
+            [(p, n, dict(a)) for p, n, a in self.m.walk(attrs_view = True)],
+            list(self.m.walk()))
+
+    def test_view_computes_lazy_attrs(self):
+        attrs = dict((tuple(p), a)
+                     for p, n, a in self.m.walk(attrs_view = True))
+        self.assertEqual(attrs[("foo",)]["sha1"], "abc")
+        self.assertEqual(self.m["foo"].getattrs(), {"size": 1, "sha1": "abc"})
+
+    def test_view_is_read_only(self):
+        for path, names, attrs in self.m.walk(attrs_view = True):
+            if sys.version_info >= (3, 3):
+                self.assertRaises(TypeError, operator.setitem, attrs,
+                                  "size", 2)
+        self.assertEqual(self.m["foo"].getattr("size"), 1)
+        self.assertEqual(self.m["bar"].getattrs(), {})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+import re
+import unittest
+
+from manifest_builder import PathFilter
+from manifest_dir import ManifestDirWalker
+from manifest_tar import ManifestTarWalker
+from test_utils import t_path, unpacked_tar, HAVE_PROCESSES
+
+class Test_PathFilter(unittest.TestCase):
+
+    def test_no_patterns_accepts_all(self):
+        f = PathFilter()
+        self.assertTrue(f.accept("foo/bar", "bar", 2, False))
+        self.assertTrue(f.descend(100))
+
+    def test_exclude_name_glob(self):
+        f = PathFilter(exclude = [".git", "*.pyc"])
+        self.assertFalse(f.accept(".git", ".git", 1, True))
+        self.assertFalse(f.accept("sub/.git", ".git", 2, True))
+        self.assertFalse(f.accept("sub/foo.pyc", "foo.pyc", 2, False))
+        self.assertTrue(f.accept("sub/foo.py", "foo.py", 2, False))
+
+    def test_exclude_path_glob(self):
+        f = PathFilter(exclude = ["sub/*.pyc"])
+        self.assertFalse(f.accept("sub/foo.pyc", "foo.pyc", 2, False))
+        self.assertTrue(f.accept("foo.pyc", "foo.pyc", 1, False))
+
+    def test_exclude_regex(self):
+        f = PathFilter(exclude = [re.compile(r"(^|/)node_modules$")])
+        self.assertFalse(f.accept("a/node_modules", "node_modules", 2, True))
+        self.assertTrue(f.accept("a/node_modules_x", "node_modules_x", 2, True))
+
+    def test_include_applies_to_non_dirs(self):
+        f = PathFilter(include = ["*.py"])
+        self.assertTrue(f.accept("foo.py", "foo.py", 1, False))
+        self.assertFalse(f.accept("foo.c", "foo.c", 1, False))
+        self.assertTrue(f.accept("src", "src", 1, True))
+
+    def test_exclude_beats_include(self):
+        f = PathFilter(include = ["*.py"], exclude = ["setup.py"])
+        self.assertFalse(f.accept("setup.py", "setup.py", 1, False))
+
+    def test_max_depth(self):
+        f = PathFilter(max_depth = 2)
+        self.assertTrue(f.accept("a/b", "b", 2, True))
+        self.assertFalse(f.accept("a/b/c", "c", 3, False))
+        self.assertTrue(f.descend(1))
+        self.assertFalse(f.descend(2))
+
+    def test_subtree(self):
+        f = PathFilter(exclude = ["a/b/c"], max_depth = 3).subtree("a/b", 2)
+        self.assertFalse(f.accept("c", "c", 1, False))
+        self.assertTrue(f.accept("d", "d", 1, True))
+        self.assertFalse(f.descend(1))
+
+class Test_builders_w_PathFilter(unittest.TestCase):
+
+    cases = [
+        (PathFilter(exclude = ["baz"]), {"foo": {}, "bar": {}}),
+        (PathFilter(exclude = ["baz/baz"]),
+         {"foo": {}, "bar": {}, "baz": {"foo": {}, "bar": {}}}),
+        (PathFilter(include = ["foo"]),
+         {"foo": {}, "baz": {"foo": {}, "baz": {"foo": {}}}}),
+        (PathFilter(max_depth = 2),
+         {"foo": {}, "bar": {}, "baz": {"foo": {}, "bar": {}, "baz": {}}}),
+        (PathFilter(exclude = [re.compile("^baz/baz/")]),
+         {"foo": {}, "bar": {}, "baz": {"foo": {}, "bar": {}, "baz": {}}}),
+    ]
+
+    def test_dir_walker(self):
+        with unpacked_tar("files_at_many_levels.tar") as d:
+            for path_filter, expect in self.cases:
+                for processes in (1, 2) if HAVE_PROCESSES else (1,):
+                    mdw = ManifestDirWalker(processes = processes)
+                    m = mdw.build(d, path_filter = path_filter)
+                    self.assertEqual(m, expect)
+
+    def test_tar_walker(self):
+        mtw = ManifestTarWalker()
+        for path_filter, expect in self.cases:
+            m = mtw.build(t_path("files_at_many_levels.tar"),
+                          path_filter = path_filter)
+            self.assertEqual(m, expect)
+
+if __name__ == '__main__':
+    unittest.main()
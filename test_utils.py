@@ -1,6 +1,8 @@
 import os
+import sys
 import glob
 import tempfile
+import unittest
 import subprocess
 import shutil
 from contextlib import contextmanager
@@ -14,6 +16,10 @@ def t_path(path):
 
 TEST_TARS = glob.glob(t_path("*.tar"))
 
+# ManifestDirWalker's worker processes need python >= 3.7
+HAVE_PROCESSES = sys.version_info >= (3, 7)
+needs_processes = unittest.skipUnless(HAVE_PROCESSES, "needs python >= 3.7")
+
 @contextmanager
 def unpacked_tar(tar_path):
     try:
@@ -23,6 +29,10 @@ def unpacked_tar(tar_path):
     finally:
         shutil.rmtree(tempdir)
 
+def walk_all(m):
+    """Return the (path, attrs) of every entry of 'm', in walk() order."""
+    return [(path, attrs) for path, names, attrs in m.walk()]
+
 def Manifest_from_walking_unpacked_tar(tar_path, attrkeys = None):
     """Create a Manifest from the given tar file.
 